@@ -0,0 +1,147 @@
+"""Compare the validated (pydantic) and the direct way MongoLogger builds log documents
+
+    python benchmarks/logger_serialization.py --number 20000
+"""
+from typing import (
+    Any,
+    Dict,
+    List,
+)
+import argparse
+import datetime
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jinja2  # noqa: E402
+import pytz  # noqa: E402
+from aiogram import types  # noqa: E402
+
+from tgstarter import MongoLogger  # noqa: E402
+from tgstarter.models.storage import LogLevel, LogType  # noqa: E402
+
+from tests.fake_motor import FakeMotorClient  # noqa: E402
+
+
+USER = {
+    'id': 123456789,
+    'is_bot': False,
+    'first_name': 'Ivan',
+    'last_name': 'Petrov',
+    'username': 'ivan_petrov',
+    'language_code': 'ru',
+}
+PRIVATE_CHAT = {
+    'id': 123456789,
+    'first_name': 'Ivan',
+    'last_name': 'Petrov',
+    'username': 'ivan_petrov',
+    'type': 'private',
+}
+GROUP_CHAT = {
+    'id': -1001234567890,
+    'title': 'Support',
+    'type': 'supergroup',
+}
+
+UPDATES: Dict[str, Dict[str, Any]] = {
+    'command': {
+        'update_id': 1,
+        'message': {
+            'message_id': 10,
+            'from': USER,
+            'chat': PRIVATE_CHAT,
+            'date': 1600000000,
+            'text': '/start referral',
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        },
+    },
+    'group_reply': {
+        'update_id': 2,
+        'message': {
+            'message_id': 11,
+            'from': USER,
+            'chat': GROUP_CHAT,
+            'date': 1600000001,
+            'text': 'Thanks, that helped! See https://example.com for details',
+            'entities': [{'type': 'url', 'offset': 25, 'length': 19}],
+            'reply_to_message': {
+                'message_id': 9,
+                'from': {**USER, 'id': 42, 'first_name': 'Support', 'username': 'support_bot', 'is_bot': True},
+                'chat': GROUP_CHAT,
+                'date': 1599999990,
+                'text': 'Try restarting the app',
+            },
+        },
+    },
+    'callback_query': {
+        'update_id': 3,
+        'callback_query': {
+            'id': '4382bfdwdsb323b2d9',
+            'from': USER,
+            'chat_instance': '-8342342342342',
+            'data': 'menu:settings:language',
+            'message': {
+                'message_id': 12,
+                'from': {**USER, 'id': 42, 'first_name': 'Bot', 'username': 'tgstarter_bot', 'is_bot': True},
+                'chat': PRIVATE_CHAT,
+                'date': 1600000002,
+                'text': 'Choose a section',
+                'reply_markup': {
+                    'inline_keyboard': [
+                        [{'text': 'Settings', 'callback_data': 'menu:settings'}],
+                        [{'text': 'Help', 'callback_data': 'menu:help'}],
+                    ],
+                },
+            },
+        },
+    },
+}
+
+
+def make_logger(validate: bool) -> MongoLogger:
+    client = FakeMotorClient()
+    return MongoLogger(
+        mongo_client=client,
+        mongo_database=client['tgstarter_benchmark'],
+        message_format=jinja2.Template(''),
+        timezone=pytz.utc,
+        validate=validate
+    )
+
+
+def build(logger: MongoLogger, updates: List[types.Update]) -> None:
+    date_time = datetime.datetime.utcnow()
+    for update in updates:
+        logger.build_document(
+            date_time=date_time,
+            level=LogLevel.INFO,
+            type=LogType.EVENT,
+            from_bot=False,
+            update=update,
+            task=None,
+            exception=None
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=5000, help='documents built per payload and path')
+    arguments = parser.parse_args()
+
+    loggers = {validate: make_logger(validate) for validate in (True, False)}
+    print(f'{"payload":<16}{"validated us":>14}{"direct us":>12}{"speedup":>10}')
+    for name, payload in UPDATES.items():
+        updates = [types.Update(**payload)]
+        timings = [
+            timeit.timeit(lambda: build(loggers[validate], updates), number=arguments.number)
+            for validate in (True, False)
+        ]
+        validated, direct = (timing / arguments.number * 1e6 for timing in timings)
+        print(f'{name:<16}{validated:>14.1f}{direct:>12.1f}{validated / direct:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Compare the linear scan and the routing index on a bot with many FSM states
+
+    python benchmarks/routing.py --states 300 --number 2000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import types  # noqa: E402
+from aiogram.contrib.fsm_storage.memory import MemoryStorage  # noqa: E402
+
+from tgstarter import Bot, Dispatcher  # noqa: E402
+
+
+def make_dispatcher(states: int, indexed_routing: bool) -> Dispatcher:
+    dispatcher = Dispatcher(Bot(token='123456:' + 'a' * 35), storage=MemoryStorage(), indexed_routing=indexed_routing)
+
+    async def handler(message: types.Message) -> None:
+        pass
+
+    dispatcher.register_message_handler(handler, commands=['start', 'help', 'cancel'], state='*')
+    for number in range(states):
+        state = f'form:{number}'
+        dispatcher.register_message_handler(handler, content_types=types.ContentType.PHOTO, state=state)
+        dispatcher.register_message_handler(handler, state=state)
+    dispatcher.register_message_handler(handler, content_types=types.ContentType.ANY, state='*')
+    return dispatcher
+
+
+async def measure(dispatcher: Dispatcher, states: int, number: int) -> float:
+    updates = [
+        types.Update(**{
+            'update_id': index,
+            'message': {
+                'message_id': index,
+                'date': 0,
+                'chat': {'id': index % 100 + 1, 'type': 'private'},
+                'from': {'id': index % 100 + 1, 'is_bot': False, 'first_name': 'user'},
+                'text': 'answer',
+            },
+        })
+        for index in range(number)
+    ]
+    for chat in range(1, 101):
+        await dispatcher.storage.set_state(chat=chat, user=chat, state=f'form:{chat * 7 % states}')
+
+    started_at = time.perf_counter()
+    for update in updates:
+        await asyncio.ensure_future(dispatcher.process_update(update))
+    return time.perf_counter() - started_at
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--states', type=int, default=300)
+    parser.add_argument('--number', type=int, default=2000, help='updates processed per routing')
+    arguments = parser.parse_args()
+
+    async def run() -> None:
+        timings = {}
+        for indexed_routing in (False, True):
+            dispatcher = make_dispatcher(arguments.states, indexed_routing)
+            timings[indexed_routing] = await measure(dispatcher, arguments.states, arguments.number)
+        linear, indexed = (timings[key] / arguments.number * 1e6 for key in (False, True))
+        print(f'{"linear us":>12}{"indexed us":>12}{"speedup":>10}')
+        print(f'{linear:>12.1f}{indexed:>12.1f}{linear / indexed:>9.1f}x')
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    main()
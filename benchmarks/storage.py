@@ -0,0 +1,165 @@
+"""Drive every storage method at a given concurrency and report ops/sec with p50/p99 latency
+
+    python benchmarks/storage.py --backend fake --concurrency 100 --operations 5000
+    python benchmarks/storage.py --backend mongo --uri mongodb://localhost:27017 --cache --write-mode WRITE_BEHIND
+"""
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Tuple,
+)
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tgstarter import MongoStorage, SQLiteStorage  # noqa: E402
+from tgstarter.models.storage import WriteMode  # noqa: E402
+from tgstarter.storage.cache import LRUCache  # noqa: E402
+from tgstarter.storage.document_storage import DocumentStorage  # noqa: E402
+
+from tests.fake_motor import FakeMotorClient  # noqa: E402
+
+
+Operation = Callable[[DocumentStorage, int, int], Awaitable[Any]]
+
+OPERATIONS: Dict[str, Operation] = {
+    'set_state': lambda storage, chat, user: storage.set_state(chat=chat, user=user, state='state'),
+    'get_state': lambda storage, chat, user: storage.get_state(chat=chat, user=user),
+    'set_data': lambda storage, chat, user: storage.set_data(chat=chat, user=user, data={'step': 1, 'items': []}),
+    'get_data': lambda storage, chat, user: storage.get_data(chat=chat, user=user),
+    'update_data': lambda storage, chat, user: storage.update_data(chat=chat, user=user, data={'step': 2}),
+    'increment_data': lambda storage, chat, user: storage.increment_data(chat=chat, user=user, counter=1),
+    'push_data': lambda storage, chat, user: storage.push_data(chat=chat, user=user, items='item'),
+    'set_bucket': lambda storage, chat, user: storage.set_bucket(chat=chat, user=user, bucket={'visits': 0}),
+    'get_bucket': lambda storage, chat, user: storage.get_bucket(chat=chat, user=user),
+    'update_bucket': lambda storage, chat, user: storage.update_bucket(chat=chat, user=user, bucket={'seen': True}),
+    'increment_bucket': lambda storage, chat, user: storage.increment_bucket(chat=chat, user=user, visits=1),
+    'reset_bucket': lambda storage, chat, user: storage.reset_bucket(chat=chat, user=user),
+    'reset_data': lambda storage, chat, user: storage.reset_data(chat=chat, user=user),
+    'reset_state': lambda storage, chat, user: storage.reset_state(chat=chat, user=user),
+    'finish': lambda storage, chat, user: storage.finish(chat=chat, user=user),
+}
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def open_storage(arguments: argparse.Namespace) -> Tuple[DocumentStorage, Callable[[], Awaitable[None]]]:
+    if arguments.backend == 'sqlite':
+        directory = tempfile.TemporaryDirectory()
+        storage = SQLiteStorage(path=os.path.join(directory.name, 'benchmark.sqlite3'))
+
+        async def cleanup() -> None:
+            directory.cleanup()
+
+        return storage, cleanup
+
+    if arguments.backend == 'fake':
+        client = FakeMotorClient(latency=arguments.latency)
+    else:
+        from motor.motor_asyncio import AsyncIOMotorClient
+        client = AsyncIOMotorClient(arguments.uri)
+
+    database = client[f'tgstarter_benchmark_{uuid.uuid4().hex}']
+    storage = MongoStorage(
+        client,
+        database,
+        cache=LRUCache(max_size=arguments.users) if arguments.cache else None,
+        write_mode=WriteMode(arguments.write_mode)
+    )
+    await storage.ensure_indexes()
+
+    async def cleanup() -> None:
+        await client.drop_database(database.name)
+        client.close()
+
+    return storage, cleanup
+
+
+async def measure(
+    storage: DocumentStorage,
+    operation: Operation,
+    addresses: List[Tuple[int, int]],
+    operations: int,
+    concurrency: int
+) -> Tuple[float, List[float]]:
+
+    latencies: List[float] = []
+    remaining = iter(range(operations))
+
+    async def worker() -> None:
+        for _ in remaining:
+            chat, user = random.choice(addresses)
+            started = time.perf_counter()
+            await operation(storage, chat, user)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    # buffered writes are only done once they reach the backend
+    await storage.flush()
+    return time.perf_counter() - started, sorted(latencies)
+
+
+async def run(arguments: argparse.Namespace) -> None:
+    storage, cleanup = await open_storage(arguments)
+    addresses = [(chat, chat) for chat in range(1, arguments.users + 1)]
+    methods = arguments.methods or list(OPERATIONS)
+
+    print(
+        f'backend={arguments.backend} concurrency={arguments.concurrency} operations={arguments.operations} '
+        f'users={arguments.users} cache={arguments.cache} write_mode={arguments.write_mode}'
+    )
+    print(f'{"method":<18}{"ops/sec":>12}{"p50 ms":>10}{"p99 ms":>10}')
+    try:
+        for method in methods:
+            elapsed, latencies = await measure(
+                storage=storage,
+                operation=OPERATIONS[method],
+                addresses=addresses,
+                operations=arguments.operations,
+                concurrency=arguments.concurrency
+            )
+            print(
+                f'{method:<18}{arguments.operations / elapsed:>12.0f}'
+                f'{percentile(latencies, 0.5) * 1000:>10.3f}{percentile(latencies, 0.99) * 1000:>10.3f}'
+            )
+    finally:
+        await storage.close()
+        await storage.wait_closed()
+        await cleanup()
+
+
+def parse_arguments() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backend', choices=('fake', 'mongo', 'sqlite'), default='fake')
+    parser.add_argument('--uri', default='mongodb://localhost:27017')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--operations', type=int, default=2000, help='operations per method')
+    parser.add_argument('--users', type=int, default=1000, help='distinct (chat, user) addresses')
+    parser.add_argument('--cache', action='store_true')
+    parser.add_argument(
+        '--write-mode',
+        choices=[mode.value for mode in WriteMode],
+        default=WriteMode.WRITE_THROUGH.value
+    )
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated round trip of the fake client, seconds')
+    parser.add_argument('--methods', nargs='*', choices=list(OPERATIONS))
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(run(parse_arguments()))
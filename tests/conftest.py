@@ -0,0 +1,42 @@
+import pytest
+from aiogram import types
+
+from tgstarter import Bot, Dispatcher
+
+
+TOKEN = '123456:' + 'a' * 35
+
+
+@pytest.fixture
+def make_bot():
+    """A factory rather than a Bot, so tests make it inside their own event loop"""
+    def make(**kwargs):
+        return Bot(token=TOKEN, **kwargs)
+
+    return make
+
+
+@pytest.fixture
+def make_dispatcher(make_bot):
+    def make(**kwargs):
+        return Dispatcher(make_bot(), **kwargs)
+
+    return make
+
+
+@pytest.fixture
+def message_update():
+    """A text message update from a private chat, the text is the update_id unless given"""
+    def make(update_id, chat_id=1, text=None):
+        return types.Update(**{
+            'update_id': update_id,
+            'message': {
+                'message_id': update_id,
+                'date': 0,
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': 'user'},
+                'text': str(update_id) if text is None else text,
+            },
+        })
+
+    return make
@@ -0,0 +1,523 @@
+"""In-process stand-in for the parts of Motor that tgstarter uses, for tests and benchmarks without mongod"""
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+import asyncio
+import copy
+
+from bson.objectid import ObjectId
+from pymongo import DeleteOne, InsertOne, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError
+from pymongo.results import (
+    BulkWriteResult,
+    DeleteResult,
+    InsertManyResult,
+    InsertOneResult,
+    UpdateResult,
+)
+
+from tgstarter.storage.updates import apply_update
+
+
+Document = Dict[str, Any]
+IndexKeys = Sequence[Tuple[str, int]]
+WriteRequest = Union[InsertOne, UpdateOne, ReplaceOne, DeleteOne]
+
+
+class _Missing:
+    pass
+
+
+MISSING: Any = _Missing()
+
+
+def get_path(document: Any, path: str) -> Any:
+    for key in path.split('.'):
+        if not isinstance(document, dict) or key not in document:
+            return MISSING
+        document = document[key]
+    return document
+
+
+def is_operator_condition(condition: Any) -> bool:
+    return isinstance(condition, dict) and bool(condition) and all(key.startswith('$') for key in condition)
+
+
+def compare(value: Any, operator: str, operand: Any) -> bool:
+    if operator == '$eq':
+        return value == operand if value is not MISSING else operand is None
+    if operator == '$ne':
+        return not compare(value, '$eq', operand)
+    if operator == '$exists':
+        return (value is not MISSING) == bool(operand)
+    if operator == '$in':
+        return any(compare(value, '$eq', item) for item in operand)
+    if operator == '$nin':
+        return not compare(value, '$in', operand)
+    if value is MISSING or value is None:
+        return False
+    try:
+        if operator == '$lt':
+            return value < operand
+        if operator == '$lte':
+            return value <= operand
+        if operator == '$gt':
+            return value > operand
+        if operator == '$gte':
+            return value >= operand
+    except TypeError:
+        return False
+    raise ValueError(f'unsupported query operator {operator}')
+
+
+def matches(document: Document, filter: Optional[Document]) -> bool:
+    for key, condition in (filter or {}).items():
+        if key == '$or':
+            if not any(matches(document, item) for item in condition):
+                return False
+        elif key == '$and':
+            if not all(matches(document, item) for item in condition):
+                return False
+        elif is_operator_condition(condition):
+            value = get_path(document, key)
+            if not all(compare(value, operator, operand) for operator, operand in condition.items()):
+                return False
+        elif not compare(get_path(document, key), '$eq', condition):
+            return False
+    return True
+
+
+def project(document: Document, projection: Optional[Document]) -> Document:
+    document = copy.deepcopy(document)
+    if not projection:
+        return document
+
+    include_id = bool(projection.get('_id', True))
+    included = [key for key, value in projection.items() if value and key != '_id']
+    if included:
+        result = {key: document[key] for key in included if key in document}
+        if include_id and '_id' in document:
+            result['_id'] = document['_id']
+        return result
+
+    for key, value in projection.items():
+        if not value:
+            document.pop(key, None)
+    return document
+
+
+def sort_key(value: Any) -> Tuple[int, Any]:
+    return (0, 0) if value is MISSING or value is None else (1, value)
+
+
+def equality_fields(filter: Optional[Document]) -> Dict[str, Any]:
+    return {
+        key: condition
+        for key, condition in (filter or {}).items()
+        if not key.startswith('$') and not is_operator_condition(condition)
+    }
+
+
+class FakeMotorCursor:
+    def __init__(
+        self,
+        collection: 'FakeMotorCollection',
+        filter: Optional[Document] = None,
+        projection: Optional[Document] = None,
+        limit: int = 0
+    ) -> None:
+        self.collection = collection
+        self.filter = filter
+        self.projection = projection
+        self._sort: List[Tuple[str, int]] = []
+        self._limit = limit
+        self._results: Optional[Iterator[Document]] = None
+
+    def sort(self, key_or_list: Union[str, IndexKeys], direction: int = 1) -> 'FakeMotorCursor':
+        if isinstance(key_or_list, str):
+            self._sort = [(key_or_list, direction)]
+        else:
+            self._sort = list(key_or_list)
+        return self
+
+    def limit(self, limit: int) -> 'FakeMotorCursor':
+        self._limit = limit
+        return self
+
+    def _evaluate(self) -> List[Document]:
+        documents = self.collection._find(self.filter)
+        for key, direction in reversed(self._sort):
+            documents.sort(key=lambda document: sort_key(get_path(document, key)), reverse=direction < 0)
+        if self._limit:
+            documents = documents[:self._limit]
+        return [project(document, self.projection) for document in documents]
+
+    def __aiter__(self) -> 'FakeMotorCursor':
+        return self
+
+    async def __anext__(self) -> Document:
+        if self._results is None:
+            await self.collection._round_trip()
+            self._results = iter(self._evaluate())
+        try:
+            return next(self._results)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length: Optional[int] = None) -> List[Document]:
+        await self.collection._round_trip()
+        documents = self._evaluate()
+        return documents[:length] if length else documents
+
+    async def explain(self) -> Document:
+        await self.collection._round_trip()
+        return {'queryPlanner': {'winningPlan': self.collection._plan(self.filter, self._sort)}}
+
+
+class FakeMotorCollection:
+    def __init__(self, database: 'FakeMotorDatabase', name: str, options: Optional[Document] = None) -> None:
+        self.database = database
+        self.name = name
+        self._reset(options)
+
+    def _reset(self, options: Optional[Document] = None) -> None:
+        self.options = options or {}
+        # like in Mongo, a collection exists once it is created explicitly or written to
+        self.exists = options is not None
+        self._documents: Dict[Any, Document] = {}
+        self._indexes: Dict[str, Tuple[IndexKeys, bool]] = {'_id_': ([('_id', 1)], True)}
+        self._unique: Dict[str, Dict[Tuple, Any]] = {}
+
+    async def _round_trip(self) -> None:
+        await asyncio.sleep(self.database.client.latency)
+
+    def _index_key(self, keys: IndexKeys, document: Document) -> Tuple:
+        return tuple(
+            None if value is MISSING else value
+            for value in (get_path(document, field) for field, _ in keys)
+        )
+
+    def _lookup(self, filter: Optional[Document]) -> Optional[List[Document]]:
+        equalities = equality_fields(filter)
+        if not filter or len(equalities) != len(filter):
+            return None
+        for name, entries in self._unique.items():
+            keys, _ = self._indexes[name]
+            if {field for field, _ in keys} == set(equalities):
+                document_id = entries.get(self._index_key(keys, equalities))
+                return [self._documents[document_id]] if document_id is not None else []
+        return None
+
+    def _find(self, filter: Optional[Document]) -> List[Document]:
+        found = self._lookup(filter)
+        if found is None:
+            found = [document for document in self._documents.values() if matches(document, filter)]
+        return list(found)
+
+    def _plan(self, filter: Optional[Document], sort: IndexKeys = ()) -> Document:
+        fields = set(equality_fields(filter)) | {key for key in (filter or {}) if not key.startswith('$')}
+        for name, (keys, _) in self._indexes.items():
+            first_field = keys[0][0]
+            if first_field in fields or (sort and sort[0][0] == first_field):
+                return {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': name}}
+        return {'stage': 'COLLSCAN'}
+
+    def _store(self, document: Document, previous: Optional[Document] = None) -> None:
+        document_id = document['_id']
+        for name, (keys, _) in self._indexes.items():
+            entries = self._unique.get(name)
+            if entries is None:
+                continue
+            key = self._index_key(keys, document)
+            owner = entries.get(key)
+            if owner is not None and owner != document_id:
+                raise DuplicateKeyError(f'E11000 duplicate key error collection: {self.name} index: {name}')
+
+        for name, (keys, _) in self._indexes.items():
+            entries = self._unique.get(name)
+            if entries is None:
+                continue
+            if previous is not None:
+                entries.pop(self._index_key(keys, previous), None)
+            entries[self._index_key(keys, document)] = document_id
+        self._documents[document_id] = document
+        self.exists = True
+
+    def _remove(self, document: Document) -> None:
+        for name, (keys, _) in self._indexes.items():
+            entries = self._unique.get(name)
+            if entries is not None:
+                entries.pop(self._index_key(keys, document), None)
+        del self._documents[document['_id']]
+
+    def _insert(self, document: Document) -> Any:
+        document = copy.deepcopy(document)
+        document.setdefault('_id', ObjectId())
+        if document['_id'] in self._documents:
+            raise DuplicateKeyError(f'E11000 duplicate key error collection: {self.name} index: _id_')
+        self._store(document)
+
+        maximum = self.options.get('max')
+        if self.options.get('capped') and maximum:
+            while len(self._documents) > maximum:
+                self._remove(next(iter(self._documents.values())))
+        return document['_id']
+
+    def _update(self, filter: Document, update: Document, upsert: bool, replace: bool = False) -> Document:
+        found = self._find(filter)
+        if not found:
+            if not upsert:
+                return {'n': 0, 'nModified': 0}
+            document = {
+                key: copy.deepcopy(value)
+                for key, value in equality_fields(filter).items()
+                if '.' not in key
+            }
+            if replace:
+                document.update(copy.deepcopy(update))
+            else:
+                operators = dict(update)
+                apply_update(document, {'$set': operators.pop('$setOnInsert', {})})
+                apply_update(document, operators)
+            document_id = self._insert(document)
+            return {'n': 1, 'nModified': 0, 'upserted': document_id}
+
+        previous = found[0]
+        document = copy.deepcopy(previous)
+        if replace:
+            document = {'_id': previous['_id'], **copy.deepcopy(update)}
+        else:
+            operators = dict(update)
+            operators.pop('$setOnInsert', None)
+            apply_update(document, operators)
+        if document == previous:
+            return {'n': 1, 'nModified': 0}
+        self._store(document, previous=previous)
+        return {'n': 1, 'nModified': 1}
+
+    async def create_index(self, keys: Union[str, IndexKeys], unique: bool = False, **kwargs: Any) -> str:
+        await self._round_trip()
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        keys = list(keys)
+        self.exists = True
+        name = kwargs.get('name') or '_'.join(f'{field}_{direction}' for field, direction in keys)
+        self._indexes[name] = (keys, unique)
+        if unique:
+            entries: Dict[Tuple, Any] = {}
+            for document in self._documents.values():
+                key = self._index_key(keys, document)
+                if key in entries:
+                    del self._indexes[name]
+                    raise DuplicateKeyError(f'E11000 duplicate key error collection: {self.name} index: {name}')
+                entries[key] = document['_id']
+            self._unique[name] = entries
+        return name
+
+    async def find_one(
+        self,
+        filter: Optional[Document] = None,
+        projection: Optional[Document] = None,
+        **kwargs: Any
+    ) -> Optional[Document]:
+
+        await self._round_trip()
+        found = self._find(filter)
+        return project(found[0], projection) if found else None
+
+    def find(
+        self,
+        filter: Optional[Document] = None,
+        projection: Optional[Document] = None,
+        limit: int = 0,
+        **kwargs: Any
+    ) -> FakeMotorCursor:
+        return FakeMotorCursor(self, filter=filter, projection=projection, limit=limit)
+
+    async def count_documents(self, filter: Document, **kwargs: Any) -> int:
+        await self._round_trip()
+        return len(self._find(filter))
+
+    async def insert_one(self, document: Document, **kwargs: Any) -> InsertOneResult:
+        await self._round_trip()
+        inserted_id = self._insert(document)
+        document.setdefault('_id', inserted_id)
+        return InsertOneResult(inserted_id, True)
+
+    async def insert_many(self, documents: Iterable[Document], ordered: bool = True, **kwargs: Any) -> InsertManyResult:
+        result = await self.bulk_write([InsertOne(document) for document in documents], ordered=ordered)
+        return InsertManyResult(
+            [document_id for _, document_id in sorted(result.bulk_api_result['insertedIds'])],
+            True
+        )
+
+    async def update_one(self, filter: Document, update: Document, upsert: bool = False, **kwargs: Any) -> UpdateResult:
+        await self._round_trip()
+        return UpdateResult(self._update(filter, update, upsert), True)
+
+    async def replace_one(
+        self,
+        filter: Document,
+        replacement: Document,
+        upsert: bool = False,
+        **kwargs: Any
+    ) -> UpdateResult:
+
+        await self._round_trip()
+        return UpdateResult(self._update(filter, replacement, upsert, replace=True), True)
+
+    async def find_one_and_update(
+        self,
+        filter: Document,
+        update: Document,
+        projection: Optional[Document] = None,
+        upsert: bool = False,
+        return_document: bool = False,
+        **kwargs: Any
+    ) -> Optional[Document]:
+
+        await self._round_trip()
+        found = self._find(filter)
+        before = project(found[0], projection) if found else None
+        outcome = self._update(filter, update, upsert)
+        if not return_document:
+            return before
+        if 'upserted' in outcome:
+            return project(self._documents[outcome['upserted']], projection)
+        return project(self._find({'_id': found[0]['_id']})[0], projection) if found else None
+
+    async def delete_one(self, filter: Document, **kwargs: Any) -> DeleteResult:
+        await self._round_trip()
+        found = self._find(filter)
+        if found:
+            self._remove(found[0])
+        return DeleteResult({'n': len(found[:1])}, True)
+
+    async def delete_many(self, filter: Document, **kwargs: Any) -> DeleteResult:
+        await self._round_trip()
+        found = self._find(filter)
+        for document in found:
+            self._remove(document)
+        return DeleteResult({'n': len(found)}, True)
+
+    async def bulk_write(
+        self,
+        requests: Sequence[WriteRequest],
+        ordered: bool = True,
+        **kwargs: Any
+    ) -> BulkWriteResult:
+
+        await self._round_trip()
+        result: Dict[str, Any] = {
+            'nInserted': 0,
+            'nUpserted': 0,
+            'nMatched': 0,
+            'nModified': 0,
+            'nRemoved': 0,
+            'upserted': [],
+            'insertedIds': [],
+            'writeErrors': [],
+        }
+        for index, request in enumerate(requests):
+            try:
+                self._apply_request(index, request, result)
+            except DuplicateKeyError as error:
+                result['writeErrors'].append({'index': index, 'code': 11000, 'errmsg': str(error)})
+                if ordered:
+                    break
+
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    def _apply_request(self, index: int, request: WriteRequest, result: Document) -> None:
+        if isinstance(request, InsertOne):
+            result['insertedIds'].append((index, self._insert(request._doc)))
+            result['nInserted'] += 1
+        elif isinstance(request, DeleteOne):
+            found = self._find(request._filter)
+            if found:
+                self._remove(found[0])
+                result['nRemoved'] += 1
+        else:
+            outcome = self._update(
+                request._filter,
+                request._doc,
+                request._upsert,
+                replace=isinstance(request, ReplaceOne)
+            )
+            if 'upserted' in outcome:
+                result['nUpserted'] += 1
+                result['upserted'].append({'index': index, '_id': outcome['upserted']})
+            else:
+                result['nMatched'] += outcome['n']
+                result['nModified'] += outcome['nModified']
+
+
+class FakeMotorDatabase:
+    def __init__(self, client: 'FakeMotorClient', name: str) -> None:
+        self.client = client
+        self.name = name
+        self._collections: Dict[str, FakeMotorCollection] = {}
+
+    def __getitem__(self, name: str) -> FakeMotorCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = self._collections[name] = FakeMotorCollection(self, name)
+        return collection
+
+    def __getattr__(self, name: str) -> FakeMotorCollection:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    async def create_collection(self, name: str, **options: Any) -> FakeMotorCollection:
+        await asyncio.sleep(self.client.latency)
+        collection = self[name]
+        if collection.exists:
+            raise CollectionInvalid(f'collection {name} already exists')
+        collection._reset(options)
+        return collection
+
+    async def list_collection_names(self) -> List[str]:
+        await asyncio.sleep(self.client.latency)
+        return [name for name, collection in self._collections.items() if collection.exists]
+
+    async def drop_collection(self, name: str) -> None:
+        await asyncio.sleep(self.client.latency)
+        if name in self._collections:
+            self._collections[name]._reset()
+
+
+class FakeMotorClient:
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self._databases: Dict[str, FakeMotorDatabase] = {}
+
+    def __getitem__(self, name: str) -> FakeMotorDatabase:
+        database = self._databases.get(name)
+        if database is None:
+            database = self._databases[name] = FakeMotorDatabase(self, name)
+        return database
+
+    def __getattr__(self, name: str) -> FakeMotorDatabase:
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_database(self, name: str) -> FakeMotorDatabase:
+        return self[name]
+
+    async def drop_database(self, name: str) -> None:
+        self._databases.pop(name, None)
+
+    def close(self) -> None:
+        pass
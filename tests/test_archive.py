@@ -0,0 +1,119 @@
+import asyncio
+import datetime
+
+from tgstarter import MongoStorage
+from tgstarter.models.storage import WriteMode
+
+from tests.fake_motor import FakeMotorClient
+
+
+IDLE = datetime.timedelta(days=30)
+
+
+async def idle_storage():
+    client = FakeMotorClient()
+    storage = MongoStorage(client, client['tgstarter_test'], archive_after=IDLE)
+    await storage.ensure_indexes()
+    await storage.set_data(chat=1, user=1, data={'name': 'Ivan'})
+    await storage.set_bucket(chat=1, user=1, bucket={'visits': 3})
+    await storage.collection_for(1, 1).update_one(
+        filter={'chat_id': 1, 'user_id': 1},
+        update={'$set': {'last_seen': datetime.datetime.utcnow() - 2 * IDLE}}
+    )
+    return storage, storage.collection_for(1, 1), storage.archive_for(storage.collection_for(1, 1))
+
+
+def test_compact_then_access_restores():
+    async def main():
+        storage, collection, archive = await idle_storage()
+        assert await storage.compact() == 1
+
+        document = await collection.find_one({'chat_id': 1, 'user_id': 1})
+        assert document['archived'] is True
+        assert 'state_data' not in document and 'bucket' not in document
+        assert await archive.count_documents({}) == 1
+
+        assert await storage.get_data(chat=1, user=1) == {'name': 'Ivan'}
+        assert await storage.get_bucket(chat=1, user=1) == {'visits': 3}
+        document = await collection.find_one({'chat_id': 1, 'user_id': 1})
+        assert 'archived' not in document
+        assert document['state_data'] == {'name': 'Ivan'}
+        assert await archive.count_documents({}) == 0
+
+    asyncio.run(main())
+
+
+def test_restore_keeps_a_concurrent_write():
+    async def main():
+        storage, collection, archive = await idle_storage()
+        await storage.compact()
+        find_one = archive.find_one
+
+        async def find_one_then_write(**kwargs):
+            result = await find_one(**kwargs)
+            # another process writes the data while this one is restoring
+            await collection.update_one(
+                filter={'chat_id': 1, 'user_id': 1},
+                update={'$set': {'state_data': {'name': 'Petr'}}}
+            )
+            return result
+
+        archive.find_one = find_one_then_write
+        assert await storage.get_data(chat=1, user=1) == {'name': 'Petr'}
+        assert await storage.get_bucket(chat=1, user=1) == {'visits': 3}
+        document = await collection.find_one({'chat_id': 1, 'user_id': 1})
+        assert document['state_data'] == {'name': 'Petr'}
+        assert 'archived' not in document
+        assert await archive.count_documents({}) == 0
+
+    asyncio.run(main())
+
+
+def test_compact_skips_a_document_touched_meanwhile():
+    async def main():
+        storage, collection, archive = await idle_storage()
+        bulk_write = archive.bulk_write
+
+        async def bulk_write_then_touch(requests, **kwargs):
+            result = await bulk_write(requests, **kwargs)
+            # the user comes back between the archive copy and the guarded update
+            await storage.update_data(chat=1, user=1, name='Ivan')
+            archive.bulk_write = bulk_write
+            return result
+
+        archive.bulk_write = bulk_write_then_touch
+        assert await storage.compact() == 0
+        document = await collection.find_one({'chat_id': 1, 'user_id': 1})
+        assert 'archived' not in document
+        assert document['bucket'] == {'visits': 3}
+        assert await archive.count_documents({}) == 0
+
+    asyncio.run(main())
+
+
+def test_compact_flushes_buffered_writes_first():
+    async def main():
+        client = FakeMotorClient()
+        storage = MongoStorage(
+            client,
+            client['tgstarter_test'],
+            archive_after=IDLE,
+            write_mode=WriteMode.WRITE_BEHIND,
+            write_behind_interval=60.0
+        )
+        await storage.set_data(chat=1, user=1, data={'name': 'Ivan', 'age': 30})
+        await storage.flush()
+        collection = storage.collection_for(1, 1)
+        await collection.update_one(
+            filter={'chat_id': 1, 'user_id': 1},
+            update={'$set': {'last_seen': datetime.datetime.utcnow() - 2 * IDLE}}
+        )
+
+        # still in the buffer when compact starts
+        await storage.update_data(chat=1, user=1, name='Petr')
+        assert await storage.compact() == 0
+        assert await storage.get_data(chat=1, user=1) == {'name': 'Petr', 'age': 30}
+        await storage.close()
+        await storage.wait_closed()
+
+    asyncio.run(main())
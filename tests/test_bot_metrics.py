@@ -0,0 +1,57 @@
+import asyncio
+import io
+
+import aiogram
+import pytest
+from aiogram.utils.exceptions import BadRequest
+
+from tgstarter.bot.metrics import RequestMetrics, payload_size
+
+
+def test_requests_are_timed_per_method(monkeypatch, make_bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        await asyncio.sleep(0.03 if method == 'sendMessage' else 0)
+        if data and data.get('text') == '':
+            raise BadRequest('Message text is empty')
+        return True
+
+    async def main():
+        metrics = RequestMetrics()
+        bot = make_bot(metrics=metrics)
+        await bot.request('sendMessage', {'chat_id': 1, 'text': 'hello'})
+        await bot.request('deleteMessage', {'chat_id': 1, 'message_id': 2})
+        with pytest.raises(BadRequest):
+            await bot.request('sendMessage', {'chat_id': 1, 'text': ''})
+
+        send_message = metrics.methods['sendMessage']
+        assert send_message.requests == 2
+        assert send_message.errors == {'BadRequest': 1}
+        assert 0.025 < send_message.latency.quantile(0.5) <= 0.1
+        assert metrics.methods['deleteMessage'].latency.quantile(0.99) == 0.025
+
+        text = metrics.render()
+        assert 'tgstarter_bot_request_duration_seconds_count{method="sendMessage"} 2' in text
+        assert 'tgstarter_bot_request_duration_seconds_bucket{method="deleteMessage",le="+Inf"} 1' in text
+        assert 'tgstarter_bot_request_errors_total{method="sendMessage",error="BadRequest"} 1' in text
+
+    monkeypatch.setattr(aiogram.Bot, 'request', request)
+    asyncio.run(main())
+
+
+def test_payload_size_counts_fields_and_files():
+    photo = io.BytesIO(b'x' * 1000)
+    photo.seek(10)
+    assert payload_size({'chat_id': 1, 'caption': 'héllo'}, {'photo': ('photo.jpg', photo)}) == 7 + 1 + 7 + 6 + 1000
+    assert photo.tell() == 10
+
+
+def test_connection_pool_settings(make_bot):
+    async def main():
+        bot = make_bot(connections_limit=50, connections_per_host=20, dns_cache_ttl=60)
+        session = await bot.get_session()
+        connector = session.connector
+        assert (connector.limit, connector.limit_per_host) == (50, 20)
+        assert connector.use_dns_cache
+        await session.close()
+
+    asyncio.run(main())
@@ -0,0 +1,145 @@
+import asyncio
+
+import pytest
+from aiogram.utils import exceptions
+from pymongo.errors import AutoReconnect
+
+from tgstarter.bot.broadcast import Broadcast
+from tgstarter.models.storage import BroadcastStatus
+
+from tests.fake_motor import FakeMotorClient
+
+
+BLOCKED = {2, 5}
+FAILED = {4}
+
+
+@pytest.fixture
+def broadcast_bot(make_bot):
+    """Bot whose messages to BLOCKED and FAILED chats fail, the others are appended to sent"""
+    def make(sent):
+        bot = make_bot()
+
+        async def send_message(chat_id, text, **kwargs):
+            if chat_id in BLOCKED:
+                raise exceptions.BotBlocked('Forbidden: bot was blocked by the user')
+            if chat_id in FAILED:
+                raise exceptions.BadRequest('Message text is empty')
+            sent.append(chat_id)
+
+        bot.send_message = send_message
+        return bot
+
+    return make
+
+
+async def chats(chat_ids):
+    for chat_id in chat_ids:
+        yield chat_id
+
+
+def test_outcomes_are_recorded_and_blocked_chats_pruned(broadcast_bot):
+    async def main():
+        sent, pruned = [], []
+        outcomes = FakeMotorClient()['tgstarter_test']['broadcasts']
+
+        async def prune(chat_ids):
+            pruned.extend(chat_ids)
+
+        bot = broadcast_bot(sent)
+        result = await bot.broadcast(
+            chats(range(1, 7)),
+            outcomes=outcomes,
+            broadcast_id='news',
+            concurrency=3,
+            batch_size=2,
+            prune=prune,
+            text='hello'
+        )
+        assert (result.sent, result.blocked, result.failed, result.skipped) == (3, 2, 1, 0)
+        assert sorted(sent) == [1, 3, 6]
+        assert sorted(pruned) == [2, 5]
+
+        statuses = {
+            document['chat_id']: document['status']
+            async for document in outcomes.find({'broadcast_id': 'news'})
+        }
+        assert statuses == {
+            1: BroadcastStatus.SENT,
+            2: BroadcastStatus.BLOCKED,
+            3: BroadcastStatus.SENT,
+            4: BroadcastStatus.FAILED,
+            5: BroadcastStatus.BLOCKED,
+            6: BroadcastStatus.SENT,
+        }
+
+    asyncio.run(main())
+
+
+def test_resumed_broadcast_skips_completed_chats(broadcast_bot):
+    async def main():
+        sent = []
+        outcomes = FakeMotorClient()['tgstarter_test']['broadcasts']
+        bot = broadcast_bot(sent)
+
+        await Broadcast(bot, outcomes, 'news').run(chats([1, 2, 3]), text='hello')
+        broadcast = Broadcast(bot, outcomes, 'news', concurrency=2)
+        result = await broadcast.run(chats([1, 2, 3, 4, 6, 6]), text='hello')
+
+        # failed chats are retried, duplicates in the input are sent once
+        assert (result.sent, result.blocked, result.failed, result.skipped) == (1, 0, 1, 4)
+        assert sent == [1, 3, 6]
+
+        other = await Broadcast(bot, outcomes, 'other').run(chats([1]), text='hello')
+        assert other.sent == 1
+
+    asyncio.run(main())
+
+
+def test_failed_outcome_writes_are_retried(broadcast_bot):
+    async def main():
+        sent = []
+        outcomes = FakeMotorClient()['tgstarter_test']['broadcasts']
+        bulk_write = outcomes.bulk_write
+        failures = 1
+
+        async def flaky_bulk_write(requests, **kwargs):
+            nonlocal failures
+            if failures:
+                failures -= 1
+                raise AutoReconnect('down')
+            return await bulk_write(requests, **kwargs)
+
+        outcomes.bulk_write = flaky_bulk_write
+        broadcast = Broadcast(broadcast_bot(sent), outcomes, 'news', concurrency=2, batch_size=1)
+        result = await asyncio.wait_for(broadcast.run(chats([1, 3, 6]), text='hello'), timeout=5)
+        assert result.sent == 3
+        assert broadcast.flush_errors == 1
+        assert await outcomes.count_documents({'broadcast_id': 'news'}) == 3
+
+    asyncio.run(main())
+
+
+def test_broadcast_fails_instead_of_hanging(broadcast_bot):
+    async def main():
+        outcomes = FakeMotorClient()['tgstarter_test']['broadcasts']
+
+        async def bulk_write(requests, **kwargs):
+            raise AutoReconnect('down')
+
+        outcomes.bulk_write = bulk_write
+        broadcast = Broadcast(broadcast_bot([]), outcomes, 'news', concurrency=2, batch_size=1)
+        with pytest.raises(AutoReconnect):
+            await asyncio.wait_for(broadcast.run(chats(range(1, 50)), text='hello'), timeout=5)
+        assert broadcast.result.sent + broadcast.result.blocked + broadcast.result.failed == 49
+
+        async def crash(chat_id, message):
+            raise RuntimeError('worker bug')
+
+        outcomes = FakeMotorClient()['tgstarter_test']['broadcasts']
+        broadcast = Broadcast(broadcast_bot([]), outcomes, 'news', concurrency=2)
+        broadcast._send = crash
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(broadcast.run(chats(range(1, 50)), text='hello'), timeout=5)
+
+    asyncio.run(main())
@@ -0,0 +1,44 @@
+from tgstarter.storage.cache import LRUCache
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_lru_eviction():
+    cache = LRUCache(max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.evictions == 1
+
+
+def test_ttl_expiration():
+    clock = FakeClock()
+    cache = LRUCache(max_size=10, ttl=5, clock=clock)
+    cache.set('a', 1)
+    clock.now = 4
+    assert cache.get('a') == 1
+    clock.now = 5
+    assert cache.get('a') is None
+    assert cache.expirations == 1
+
+
+def test_counters():
+    cache = LRUCache(max_size=10)
+    cache.set('a', 1)
+    cache.get('a')
+    cache.get('b')
+    cache.peek('a')
+
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.hit_ratio == 0.5
@@ -0,0 +1,95 @@
+import asyncio
+
+import pytest
+
+from tgstarter.bot.chat_actions import ChatActionTicker
+
+
+def make_ticker(sent, interval=0.1):
+    async def send(chat_id, action):
+        sent.append((chat_id, action))
+
+    return ChatActionTicker(send, interval=interval, resolution=0.02)
+
+
+def test_overlapping_actions_are_sent_once_per_interval():
+    async def main():
+        sent = []
+        ticker = make_ticker(sent)
+
+        async def handler(chat_id):
+            async with ticker.track(chat_id, 'typing'):
+                await asyncio.sleep(0.25)
+
+        await asyncio.gather(*[handler(chat_id) for chat_id in (1, 2) for _ in range(50)])
+        assert sorted(set(sent)) == [(1, 'typing'), (2, 'typing')]
+        # sent at the start and refreshed twice, not once per handler
+        assert 2 <= sent.count((1, 'typing')) <= 4
+        assert ticker.chats == 0
+        await ticker.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_latest_action_wins_and_is_restored():
+    async def main():
+        sent = []
+        ticker = make_ticker(sent, interval=10)
+
+        async with ticker.track(1, 'typing'):
+            await asyncio.sleep(0.01)
+            async with ticker.track(1, 'upload_photo'):
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.01)
+        assert sent == [(1, 'typing'), (1, 'upload_photo'), (1, 'typing')]
+
+    asyncio.run(main())
+
+
+def test_a_slow_send_does_not_hold_back_other_chats():
+    async def main():
+        sent = []
+        stuck = asyncio.Event()
+
+        async def send(chat_id, action):
+            if chat_id == 1:
+                # e.g. waiting for the rate limit of a private chat
+                await stuck.wait()
+            sent.append(chat_id)
+
+        ticker = ChatActionTicker(send, interval=0.1, resolution=0.02)
+        async with ticker.track(1, 'typing'), ticker.track(2, 'typing'):
+            await asyncio.sleep(0.35)
+        assert sent.count(2) >= 3
+        assert 1 not in sent
+
+        await ticker.close()
+        await ticker.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_action_stops_when_the_coroutine_raises(make_bot):
+    async def main():
+        bot = make_bot()
+        sent = []
+
+        async def send_chat_action(chat_id, action):
+            sent.append(chat_id)
+
+        async def handler():
+            await asyncio.sleep(0.01)
+            raise ValueError('broken handler')
+
+        bot.send_chat_action = send_chat_action
+        with pytest.raises(ValueError):
+            await bot.send_with_action(1, handler(), delay=0.05)
+
+        ticker = bot.chat_action_ticker(0.05)
+        assert ticker.chats == 0
+        await ticker.wait_closed()
+        count = len(sent)
+        await asyncio.sleep(0.1)
+        assert len(sent) == count == 1
+
+    asyncio.run(main())
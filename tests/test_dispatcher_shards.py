@@ -0,0 +1,143 @@
+import asyncio
+
+from aiogram.utils.executor import Executor
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from tgstarter.dispatcher.webhook import configure_app
+
+
+def test_updates_are_ordered_per_chat_and_parallel_across_chats(make_dispatcher, message_update):
+    async def main():
+        dispatcher = make_dispatcher(shard_workers=4, shard_queue_size=2)
+        processed = {}
+        running, peak = 0, 0
+
+        @dispatcher.message_handler()
+        async def handler(message):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            # earlier updates of a chat sleep longer, so only the queue keeps them in order
+            await asyncio.sleep(0.01 * (10 - message.message_id % 10))
+            processed.setdefault(message.chat.id, []).append(message.message_id)
+            running -= 1
+
+        updates = [
+            message_update(chat_id * 10 + index, chat_id)
+            for index in range(5)
+            for chat_id in (1, 2, 3, 4)
+        ]
+        await dispatcher.process_updates(updates)
+
+        assert processed == {
+            chat_id: [chat_id * 10 + index for index in range(5)]
+            for chat_id in (1, 2, 3, 4)
+        }
+        assert peak == 4
+        shards = dispatcher.shards.shards
+        assert sum(shard.processed for shard in shards) == 20
+        assert max(shard.max_lag for shard in shards) > 0
+        assert dispatcher.shards.depth == 0
+        await dispatcher.shards.close()
+        await dispatcher.shards.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_concurrent_batches_keep_arrival_order(make_dispatcher, message_update):
+    async def main():
+        dispatcher = make_dispatcher(shard_workers=2, shard_queue_size=1)
+        processed = []
+
+        @dispatcher.message_handler()
+        async def handler(message):
+            if message.chat.id == 2:
+                await asyncio.sleep(0.01)
+            processed.append(message.message_id)
+
+        # chat 2 fills its shard, so the first batch waits before it gets to chat 1
+        first = asyncio.ensure_future(dispatcher.process_updates([
+            message_update(1, 2), message_update(2, 2), message_update(3, 2), message_update(4, 1),
+        ]))
+        await asyncio.sleep(0)
+        second = asyncio.ensure_future(dispatcher.process_updates([message_update(5, 1)]))
+        await asyncio.gather(first, second)
+
+        assert [update_id for update_id in processed if update_id in (4, 5)] == [4, 5]
+        await dispatcher.shards.close()
+        await dispatcher.shards.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_webhook_updates_go_through_the_shards(make_dispatcher, message_update):
+    async def main():
+        dispatcher = make_dispatcher(shard_workers=2)
+        processed = []
+
+        @dispatcher.message_handler()
+        async def handler(message):
+            processed.append(message.message_id)
+
+        app = web.Application()
+        configure_app(dispatcher, app, path='/webhook')
+        async with TestClient(TestServer(app)) as client:
+            responses = await asyncio.gather(*[
+                client.post('/webhook', data=message_update(update_id, update_id % 3 + 1).as_json())
+                for update_id in range(5)
+            ])
+            assert [response.status for response in responses] == [200] * 5
+
+        assert sorted(processed) == list(range(5))
+        assert sum(shard.processed for shard in dispatcher.shards.shards) == 5
+        await dispatcher.shards.close()
+        await dispatcher.shards.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_webhook_shutdown_processes_queued_updates(make_dispatcher, message_update):
+    async def main():
+        dispatcher = make_dispatcher(shard_workers=2)
+        processed = []
+
+        @dispatcher.message_handler()
+        async def handler(message):
+            await asyncio.sleep(0.01)
+            processed.append(message.message_id)
+
+        results = [
+            asyncio.ensure_future(dispatcher.notify_update(message_update(update_id, update_id % 2 + 1)))
+            for update_id in range(6)
+        ]
+        await asyncio.sleep(0)
+
+        executor = Executor(dispatcher)
+        executor.on_shutdown(lambda dispatcher: dispatcher.close_shards())
+        # no polling ever started, so waiting for the dispatcher mustn't hang
+        await asyncio.wait_for(executor._shutdown_webhook(wait_closed=True), timeout=5)
+
+        assert sorted(processed) == list(range(6))
+        await asyncio.gather(*results)
+
+    asyncio.run(main())
+
+
+def test_process_updates_honors_fast_false(make_dispatcher, message_update):
+    async def main():
+        dispatcher = make_dispatcher(shard_workers=4)
+        processed = []
+
+        @dispatcher.message_handler()
+        async def handler(message):
+            # a later chat would finish first if the updates ran in parallel
+            await asyncio.sleep(0.01 * (5 - message.message_id))
+            processed.append(message.message_id)
+
+        updates = [message_update(update_id, update_id + 1) for update_id in range(4)]
+        await dispatcher.process_updates(updates, fast=False)
+        assert processed == [0, 1, 2, 3]
+        await dispatcher.close_shards()
+
+    asyncio.run(main())
@@ -0,0 +1,159 @@
+import asyncio
+import os
+
+import bson
+import jinja2
+import pytest
+import pytz
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError
+
+from tgstarter import MongoLogger
+from tgstarter.storage.log_spool import REJECTED_FILE, LogSpool, segment_name
+
+from tests.fake_motor import FakeMotorClient
+
+
+def documents(count):
+    return [{'_id': ObjectId(), 'number': number} for number in range(count)]
+
+
+def test_spools_when_mongo_is_slow_and_replays_in_order(tmp_path):
+    async def main():
+        client = FakeMotorClient(latency=1.0)
+        logs = client['tgstarter_test']['logs']
+        spool = LogSpool(logs, str(tmp_path), latency_budget=0.01, segment_size=200, replay_interval=60)
+        batch = documents(20)
+        for document in batch:
+            await spool.insert_many([document])
+
+        assert spool.spooled == 20
+        assert spool.pending
+        assert len(os.listdir(tmp_path)) > 2
+
+        client.latency = 0.0
+        # a document that reached Mongo despite the timeout is not inserted twice
+        await logs.insert_one(dict(batch[3]))
+        assert await spool.replay() == 20
+        assert not spool.pending
+        assert [document['number'] async for document in logs.find({}).sort('number')] == list(range(20))
+        assert os.listdir(tmp_path) == ['offset.json']
+
+        await spool.insert_many(documents(1))
+        assert not spool.pending
+        await spool.close()
+        await spool.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_offsets_survive_restart_and_partial_writes(tmp_path):
+    async def main():
+        client = FakeMotorClient(latency=1.0)
+        logs = client['tgstarter_test']['logs']
+        spool = LogSpool(logs, str(tmp_path), latency_budget=0.01, batch_size=3, replay_interval=60)
+        await spool.insert_many(documents(5))
+
+        client.latency = 0.0
+        sequence, _ = spool._offset
+        await spool.close()
+        await spool.wait_closed()
+        # a crash in the middle of an append leaves a truncated document behind
+        with open(tmp_path / segment_name(sequence), 'ab') as file:
+            file.write(b'\x40\x00\x00\x00\x02')
+
+        restarted = LogSpool(logs, str(tmp_path), latency_budget=0.01, batch_size=3, replay_interval=60)
+        assert restarted.pending
+        assert await restarted.replay() == 5
+        assert await logs.count_documents({}) == 5
+
+    asyncio.run(main())
+
+
+def test_disk_usage_is_bounded(tmp_path):
+    async def main():
+        client = FakeMotorClient(latency=1.0)
+        spool = LogSpool(client['tgstarter_test']['logs'], str(tmp_path), latency_budget=0.01, max_size=100)
+        for document in documents(10):
+            await spool.insert_many([document])
+        assert spool.dropped > 0
+        assert spool.spooled + spool.dropped == 10
+        assert len(spool) <= 100
+        await spool.close()
+        await spool.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_logger_start_replays_a_previous_run(tmp_path):
+    async def main():
+        client = FakeMotorClient(latency=1.0)
+        logs = client['tgstarter_test']['logs']
+        spool = LogSpool(logs, str(tmp_path), latency_budget=0.01, replay_interval=60)
+        await spool.insert_many(documents(3))
+        await spool.close()
+        await spool.wait_closed()
+
+        client.latency = 0.0
+        logger = MongoLogger(
+            mongo_client=client,
+            mongo_database=client['tgstarter_test'],
+            message_format=jinja2.Template(''),
+            timezone=pytz.utc,
+            spool_directory=str(tmp_path)
+        )
+        logger.spool.replay_interval = 0.01
+        # nothing new is logged, the leftovers are replayed anyway
+        logger.start()
+        for _ in range(100):
+            if not logger.spool.pending:
+                break
+            await asyncio.sleep(0.01)
+        assert await logs.count_documents({}) == 3
+        await logger.close()
+        await logger.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_refused_documents_are_moved_aside(tmp_path):
+    async def main():
+        client = FakeMotorClient(latency=1.0)
+        logs = client['tgstarter_test']['logs']
+        spool = LogSpool(logs, str(tmp_path), latency_budget=0.01, replay_interval=60, max_attempts=3)
+        batch = documents(5)
+        batch[2]['poison'] = True
+        await spool.insert_many(batch)
+        await spool.insert_many(documents(2))
+        client.latency = 0.0
+
+        insert_many = logs.insert_many
+
+        async def validated_insert_many(documents, **kwargs):
+            inserted = {document['_id'] async for document in logs.find({})}
+            valid = [document for document in documents if 'poison' not in document and document['_id'] not in inserted]
+            if valid:
+                await insert_many(valid, **kwargs)
+            errors = [
+                {'index': index, 'code': 121, 'errmsg': 'Document failed validation'}
+                for index, document in enumerate(documents)
+                if 'poison' in document
+            ]
+            if errors:
+                raise BulkWriteError({'writeErrors': errors, 'nInserted': len(valid)})
+
+        logs.insert_many = validated_insert_many
+        for _ in range(2):
+            with pytest.raises(BulkWriteError):
+                await spool.replay()
+        # the third refusal moves the document aside and the documents behind it go in
+        assert await spool.replay() == 6
+        assert spool.rejected == 1
+        assert not spool.pending
+        assert await logs.count_documents({}) == 6
+        with open(tmp_path / REJECTED_FILE, 'rb') as file:
+            assert bson.decode(file.read())['_id'] == batch[2]['_id']
+        await spool.close()
+        await spool.wait_closed()
+
+    asyncio.run(main())
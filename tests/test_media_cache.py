@@ -0,0 +1,74 @@
+import asyncio
+import io
+
+import aiogram
+from aiogram.types import InputFile
+from aiogram.utils.exceptions import WrongFileIdentifier
+
+from tgstarter.bot.media_cache import MediaCache, cache_as
+
+from tests.fake_motor import FakeMotorClient
+
+
+def fake_telegram(uploads, stale):
+    async def request(self, method, data=None, files=None, **kwargs):
+        if files and 'photo' in files:
+            file = files['photo']
+            uploads.append(getattr(file, 'file', file).read())
+            file_id = f'photo-{len(uploads)}'
+        elif data['photo'] in stale:
+            raise WrongFileIdentifier('Bad Request: wrong file identifier/HTTP URL specified')
+        else:
+            file_id = data['photo']
+        return {
+            'message_id': 1,
+            'date': 0,
+            'chat': {'id': data['chat_id'], 'type': 'private'},
+            'photo': [
+                {'file_id': f'{file_id}-thumbnail', 'file_unique_id': 'a', 'width': 90, 'height': 90},
+                {'file_id': file_id, 'file_unique_id': 'b', 'width': 800, 'height': 800},
+            ],
+        }
+
+    return request
+
+
+def test_uploads_are_replaced_with_file_ids(monkeypatch, make_bot):
+    async def main():
+        collection = FakeMotorClient()['tgstarter_test']['media']
+        bot = make_bot(media_cache=MediaCache(collection))
+
+        first = await bot.send_photo(1, InputFile(io.BytesIO(b'image'), filename='a.png'))
+        second = await bot.send_photo(2, io.BytesIO(b'image'))
+        other = await bot.send_photo(2, InputFile(io.BytesIO(b'other image')))
+        assert uploads == [b'image', b'other image']
+        assert first.photo[-1].file_id == second.photo[-1].file_id == 'photo-1'
+        assert other.photo[-1].file_id == 'photo-2'
+
+        # a new process finds the file_ids in Mongo
+        restarted = make_bot(media_cache=MediaCache(collection))
+        await restarted.send_photo(3, io.BytesIO(b'image'))
+        assert len(uploads) == 2
+        assert restarted.media_cache.hits == 1
+
+    uploads = []
+    monkeypatch.setattr(aiogram.Bot, 'request', fake_telegram(uploads, stale=set()))
+    asyncio.run(main())
+
+
+def test_stale_file_id_is_uploaded_again(monkeypatch, make_bot):
+    async def main():
+        media_cache = MediaCache(FakeMotorClient()['tgstarter_test']['media'])
+        bot = make_bot(media_cache=media_cache)
+
+        await bot.send_photo(1, cache_as(InputFile(io.BytesIO(b'image')), 'logo'))
+        stale.add('photo-1')
+        message = await bot.send_photo(1, cache_as(InputFile(io.BytesIO(b'new image')), 'logo'))
+        assert uploads == [b'image', b'new image']
+        assert message.photo[-1].file_id == 'photo-2'
+        assert media_cache.invalidated == 1
+        assert await media_cache.get('photo:key:logo') == 'photo-2'
+
+    uploads, stale = [], set()
+    monkeypatch.setattr(aiogram.Bot, 'request', fake_telegram(uploads, stale))
+    asyncio.run(main())
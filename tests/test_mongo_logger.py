@@ -0,0 +1,397 @@
+import asyncio
+import datetime
+import sys
+
+import jinja2
+import pytz
+from aiogram import types
+from bson.objectid import ObjectId
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from tgstarter import MongoLogger
+from tgstarter.models.storage import Backpressure, LogCollectionMode, LogLevel, LogTask, LogType
+from tgstarter.storage.log_buffer import LogBuffer
+from tgstarter.storage.log_rollup import LogRollup
+
+from tests.fake_motor import FakeMotorClient
+
+
+def make_logger(**kwargs):
+    client = FakeMotorClient()
+    return MongoLogger(
+        mongo_client=client,
+        mongo_database=client['tgstarter_test'],
+        message_format=jinja2.Template('{{ error_type }}: {{ error_value }} ({{ object_id }})'),
+        timezone=pytz.utc,
+        **kwargs
+    )
+
+
+def exc_info():
+    try:
+        raise ValueError('broken')
+    except ValueError:
+        return sys.exc_info()
+
+
+def test_unbuffered_error_message_references_document():
+    async def main():
+        logger = make_logger()
+        message = await logger.error(exc_info=exc_info())
+        document = await logger.logs.find_one({})
+        assert message == f'ValueError: broken ({document["_id"]})'
+
+    asyncio.run(main())
+
+
+def test_buffered_logs_are_inserted_in_batches():
+    async def main():
+        logger = make_logger(buffered=True, buffer_batch_size=10, buffer_interval=60)
+        for _ in range(25):
+            await logger.info()
+        message = await logger.error(exc_info=exc_info())
+        assert await logger.logs.count_documents({}) < 26
+
+        await logger.close()
+        await logger.wait_closed()
+        assert await logger.logs.count_documents({}) == 26
+        assert logger.buffer.inserted == 26
+        document = await logger.logs.find_one({'level': LogLevel.ERROR.value})
+        assert str(document['_id']) in message
+
+    asyncio.run(main())
+
+
+def test_drop_oldest_backpressure():
+    async def main():
+        logger = make_logger(
+            buffered=True,
+            buffer_max_size=3,
+            buffer_interval=60,
+            backpressure=Backpressure.DROP_OLDEST
+        )
+        for _ in range(10):
+            await logger.info()
+        assert logger.buffer.dropped > 0
+
+        await logger.close()
+        await logger.wait_closed()
+        assert await logger.logs.count_documents({}) + logger.buffer.dropped == 10
+
+    asyncio.run(main())
+
+
+def test_drop_debug_backpressure():
+    async def main():
+        logger = make_logger(
+            buffered=True,
+            buffer_max_size=2,
+            buffer_interval=60,
+            backpressure=Backpressure.DROP_DEBUG
+        )
+        for _ in range(5):
+            await logger.debug()
+        await logger.warning()
+
+        await logger.close()
+        await logger.wait_closed()
+        assert await logger.logs.count_documents({'level': LogLevel.WARNING.value}) == 1
+        assert logger.buffer.dropped > 0
+        assert await logger.logs.count_documents({'level': LogLevel.DEBUG.value}) + logger.buffer.dropped == 5
+
+    asyncio.run(main())
+
+
+def test_drop_debug_evicts_queued_debug_documents():
+    async def main():
+        logger = make_logger(
+            buffered=True,
+            buffer_max_size=3,
+            buffer_interval=60,
+            backpressure=Backpressure.DROP_DEBUG
+        )
+        await logger.info()
+        # the worker takes the first document and waits for a batch
+        await asyncio.sleep(0)
+        await logger.debug()
+        await logger.debug()
+        await logger.info()
+        # the buffer is full, each of these makes room by evicting a queued debug document
+        await asyncio.wait_for(logger.info(), timeout=1)
+        await asyncio.wait_for(logger.info(), timeout=1)
+        assert logger.dropped == 2
+
+        await logger.close()
+        await logger.wait_closed()
+        assert await logger.logs.count_documents({'level': LogLevel.INFO.value}) == 4
+        assert await logger.logs.count_documents({'level': LogLevel.DEBUG.value}) == 0
+
+    asyncio.run(main())
+
+
+def test_direct_documents_match_validated_documents():
+    updates = [
+        None,
+        types.Update(
+            update_id=1,
+            message={
+                'message_id': 1,
+                'from': {'id': 2, 'is_bot': False, 'first_name': 'User'},
+                'chat': {'id': 3, 'type': 'group', 'title': 'Group'},
+                'date': 1600000000,
+                'text': 'hello',
+            }
+        ),
+        types.Update(
+            update_id=2,
+            callback_query={
+                'id': '1',
+                'from': {'id': 2, 'is_bot': False, 'first_name': 'User'},
+                'chat_instance': '1',
+                'data': 'data',
+            }
+        ),
+        types.Update(
+            update_id=3,
+            channel_post={
+                'message_id': 1,
+                'chat': {'id': -100, 'type': 'channel', 'title': 'Channel'},
+                'date': 1600000000,
+            }
+        ),
+    ]
+    task = LogTask(function_fullname='module.function', args=[1], kwargs={'a': 'b'}, result=None)
+    exception = {'type': 'ValueError', 'value': 'broken', 'traceback': 'Traceback'}
+    validated, direct = make_logger(validate=True), make_logger(validate=False)
+    for update in updates:
+        parameters = dict(
+            date_time=datetime.datetime(2020, 1, 1),
+            level=LogLevel.ERROR,
+            type=LogType.TASK,
+            from_bot=True,
+            update=update,
+            task=task,
+            exception=exception
+        )
+        assert direct.build_document(**parameters) == validated.build_document(**parameters)
+
+
+def message_update(chat_id):
+    return types.Update(
+        update_id=chat_id,
+        message={
+            'message_id': 1,
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+            'chat': {'id': chat_id, 'type': 'private'},
+            'date': 1600000000,
+        }
+    )
+
+
+def test_min_level_and_sampling():
+    async def main():
+        logger = make_logger(
+            min_level=LogLevel.INFO,
+            level_sample_rates={LogLevel.INFO: 0.0},
+            type_sample_rates={LogType.TASK: 0.0}
+        )
+        assert await logger.debug() is None
+        await logger.info()
+        await logger.warning(type=LogType.TASK)
+        assert await logger.error(exc_info=exc_info()) is not None
+        assert await logger.logs.count_documents({}) == 1
+        assert logger.suppressed == 3
+
+    asyncio.run(main())
+
+
+def test_chat_sampling_keeps_whole_conversations():
+    async def main():
+        logger = make_logger(chat_sample_rate=0.5)
+        for _ in range(3):
+            for chat_id in range(1, 201):
+                await logger.info(update=message_update(chat_id))
+        await logger.info()
+
+        logged = {}
+        async for document in logger.logs.find({'update': {'$ne': None}}):
+            chat_id = document['user_info']['chat']['id']
+            logged[chat_id] = logged.get(chat_id, 0) + 1
+        assert set(logged.values()) == {3}
+        assert 50 < len(logged) < 150
+        assert await logger.logs.count_documents({'update': None}) == 1
+
+    asyncio.run(main())
+
+
+def test_spooled_logger_does_not_wait_for_slow_mongo(tmp_path):
+    async def main():
+        logger = make_logger(spool_directory=str(tmp_path), spool_latency_budget=0.01)
+        logger.client.latency = 1.0
+        message = await asyncio.wait_for(logger.error(exc_info=exc_info()), timeout=0.5)
+        assert logger.spool.spooled == 1
+
+        logger.client.latency = 0.0
+        await logger.spool.replay()
+        document = await logger.logs.find_one({})
+        assert str(document['_id']) in message
+        await logger.close()
+        await logger.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_deduplicated_tracebacks():
+    def fail(value):
+        raise ValueError(value)
+
+    def exc_info_for(value):
+        try:
+            fail(value)
+        except ValueError:
+            return sys.exc_info()
+
+    async def main():
+        logger = make_logger(deduplicate_tracebacks=True, validate=False)
+        plain = make_logger()
+        for number in range(3):
+            await logger.error(exc_info=exc_info_for(f'user {number}'))
+        await logger.error(exc_info=exc_info())
+
+        assert await logger.tracebacks.count_documents({}) == 2
+        stored = [document async for document in logger.logs.find({}).sort('datetime')]
+        assert [document['exception']['occurrence'] for document in stored] == [1, 2, 3, 1]
+        assert stored[0]['exception']['fingerprint'] == stored[2]['exception']['fingerprint']
+        assert all('traceback' not in document['exception'] for document in stored)
+
+        traceback = await logger.tracebacks.find_one({'_id': stored[0]['exception']['fingerprint']})
+        assert traceback['count'] == 3
+        assert 'fail(value)' in traceback['traceback']
+
+        plain.message_format = logger.message_format = jinja2.Template('{{ traceback }}')
+        assert await logger.error(exc_info=exc_info()) == await plain.error(exc_info=exc_info())
+
+        # an expired traceback is stored again with its text
+        await logger.tracebacks.delete_many({})
+        await logger.error(exc_info=exc_info_for('user 4'))
+        traceback = await logger.tracebacks.find_one({'_id': stored[0]['exception']['fingerprint']})
+        assert traceback['count'] == 1
+        assert 'fail(value)' in traceback['traceback']
+
+        logger = make_logger(deduplicate_tracebacks=True, validate=False, tracebacks_cache_size=1)
+        await logger.error(exc_info=exc_info_for('user 5'))
+        await logger.error(exc_info=exc_info())
+        # the fingerprints known to be stored don't grow with every distinct traceback
+        assert len(logger._stored_fingerprints) == 1
+
+    asyncio.run(main())
+
+
+def test_collection_modes():
+    async def main():
+        capped = make_logger(collection_mode=LogCollectionMode.CAPPED, capped_max=3)
+        assert await capped.create_collection()
+        assert not await capped.create_collection()
+        assert capped.logs.options == {'capped': True, 'size': capped.capped_size, 'max': 3}
+        for _ in range(5):
+            await capped.info()
+        assert await capped.logs.count_documents({}) == 3
+
+        time_series = make_logger(
+            collection_mode=LogCollectionMode.TIME_SERIES,
+            expire_after=datetime.timedelta(days=7)
+        )
+        await time_series.create_collection()
+        assert time_series.logs.options['timeseries']['timeField'] == 'datetime'
+        assert time_series.logs.options['expireAfterSeconds'] == 7 * 24 * 60 * 60
+        await time_series.warning(type=LogType.TASK)
+        document = await time_series.logs.find_one({})
+        assert document['meta'] == {'level': LogLevel.WARNING.value, 'type': LogType.TASK.value}
+
+    asyncio.run(main())
+
+
+def test_rollup_counts_every_call():
+    async def main():
+        logger = make_logger(rollup=True, rollup_interval=60, min_level=LogLevel.INFO)
+        await logger.ensure_indexes()
+        for _ in range(3):
+            await logger.debug()
+        await logger.info(from_bot=True)
+        await logger.flush()
+        await logger.info(from_bot=True)
+        await logger.close()
+        await logger.wait_closed()
+
+        counts = await logger.rollup.counts(since=datetime.datetime.utcnow() - datetime.timedelta(minutes=1))
+        by_key = {}
+        for count in counts:
+            key = (count['level'], count['came_from'])
+            by_key[key] = by_key.get(key, 0) + count['count']
+        assert by_key == {(LogLevel.DEBUG.value, 'USER'): 3, (LogLevel.INFO.value, 'BOT'): 2}
+        assert await logger.logs.count_documents({}) == 2
+
+    asyncio.run(main())
+
+
+def test_buffer_retries_what_was_not_inserted():
+    async def main():
+        collection = FakeMotorClient()['tgstarter_test'].logs
+        insert_many = collection.insert_many
+        attempts = []
+
+        async def flaky_insert_many(documents, **kwargs):
+            attempts.append(len(documents))
+            if len(attempts) == 1:
+                raise AutoReconnect('down')
+            if len(attempts) == 2:
+                # the first document is inserted, the second is rejected
+                await insert_many(documents[:1], **kwargs)
+                raise BulkWriteError({
+                    'writeErrors': [{'index': 1, 'code': 91, 'errmsg': 'shutting down'}],
+                    'nInserted': 1,
+                })
+            return await insert_many(documents, **kwargs)
+
+        collection.insert_many = flaky_insert_many
+        buffer = LogBuffer(collection, batch_size=2, interval=60, retry_interval=0.01)
+        for number in range(2):
+            await buffer.put({'_id': ObjectId(), 'number': number})
+        await buffer.flush()
+
+        assert attempts == [2, 2, 1]
+        assert buffer.inserted == 2
+        assert buffer.failed == 0
+        assert await collection.count_documents({}) == 2
+        await buffer.close()
+        await buffer.wait_closed()
+
+    asyncio.run(main())
+
+
+def test_rollup_retries_a_failed_flush():
+    async def main():
+        client = FakeMotorClient()
+        rollup = LogRollup(client['tgstarter_test']['logs_rollup'], interval=0.01)
+        bulk_write = rollup.collection.bulk_write
+        failures = 2
+
+        async def flaky_bulk_write(requests, **kwargs):
+            nonlocal failures
+            if failures:
+                failures -= 1
+                raise AutoReconnect('primary stepped down')
+            return await bulk_write(requests, **kwargs)
+
+        rollup.collection.bulk_write = flaky_bulk_write
+        rollup.add(datetime.datetime.utcnow(), 'INFO', 'TASK', 'BOT')
+        rollup.add(datetime.datetime.utcnow(), 'INFO', 'TASK', 'BOT')
+        # nothing else is logged, the timer alone has to get the counters written
+        await asyncio.wait_for(rollup.wait_closed(), timeout=5)
+
+        assert rollup.failed_flushes == 2
+        assert isinstance(rollup.last_error, AutoReconnect)
+        counts = await rollup.counts(since=datetime.datetime.utcnow() - datetime.timedelta(minutes=1))
+        assert [count['count'] for count in counts] == [2]
+
+    asyncio.run(main())
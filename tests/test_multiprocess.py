@@ -0,0 +1,182 @@
+import asyncio
+import json
+import os
+
+import pytest
+from aiogram import types
+
+from tgstarter import Bot, Dispatcher
+from tgstarter.dispatcher.multiprocess import MultiprocessWebhook
+from tgstarter.dispatcher.shards import UpdateShards
+
+
+LOG_VARIABLE = 'TGSTARTER_TEST_MULTIPROCESS_LOG'
+DELAY_VARIABLE = 'TGSTARTER_TEST_MULTIPROCESS_DELAY'
+
+
+def make_dispatcher():
+    """Runs in the worker processes: writes down which process handled which update"""
+    dispatcher = Dispatcher(Bot(token='123456:' + 'a' * 35))
+
+    @dispatcher.message_handler()
+    async def handler(message: types.Message) -> None:
+        await asyncio.sleep(float(os.environ.get(DELAY_VARIABLE, 0)))
+        with open(os.environ[LOG_VARIABLE], 'a') as log:
+            log.write(f'{os.getpid()} {message.chat.id} {message.message_id}\n')
+
+    return dispatcher
+
+
+def message_body(update_id, chat_id):
+    return json.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'user'},
+            'text': str(update_id),
+        },
+    }).encode()
+
+
+def test_chats_stick_to_workers_across_a_restart(tmp_path, monkeypatch):
+    log_path = tmp_path / 'processed.log'
+    monkeypatch.setenv(LOG_VARIABLE, str(log_path))
+
+    async def main():
+        front = MultiprocessWebhook(make_dispatcher, workers=2, socket_directory=str(tmp_path), max_in_flight=3)
+        await front.start()
+        first_pids = [link.process.pid for link in front.links]
+
+        update_ids = iter(range(1, 1000))
+        sent = {chat_id: [] for chat_id in range(1, 7)}
+
+        def submit_round():
+            for chat_id in sent:
+                update_id = next(update_ids)
+                assert front.submit(message_body(update_id, chat_id))
+                sent[chat_id].append(update_id)
+
+        for _ in range(5):
+            submit_round()
+        # updates for the restarted worker wait in the front meanwhile
+        restart = asyncio.ensure_future(front.restart_worker(0))
+        for _ in range(5):
+            submit_round()
+            await asyncio.sleep(0)
+        await restart
+        await front.join()
+
+        assert front.links[0].process.pid != first_pids[0]
+        assert front.links[1].process.pid == first_pids[1]
+        assert front.links[0].restarts == 1
+        assert sum(link.processed for link in front.links) == 60
+        assert all(link.depth == 0 for link in front.links)
+        await front.close()
+        assert all(link.process.exitcode == 0 for link in front.links)
+        assert not front.submit(message_body(next(update_ids), 1))
+        workers = {chat_id: front.worker_for(json.loads(message_body(0, chat_id))).index for chat_id in sent}
+        return sent, first_pids, workers
+
+    sent, first_pids, workers = asyncio.run(main())
+
+    processed, pids = {}, {}
+    for line in log_path.read_text().splitlines():
+        pid, chat_id, update_id = map(int, line.split())
+        processed.setdefault(chat_id, []).append(update_id)
+        pids.setdefault(chat_id, set()).add(pid)
+    assert processed == sent
+    assert set(workers.values()) == {0, 1}
+    for chat_id, chat_pids in pids.items():
+        if workers[chat_id] == 1:
+            assert chat_pids == {first_pids[1]}
+        else:
+            # one process before the restart of worker 0, one after
+            assert first_pids[0] in chat_pids and len(chat_pids) <= 2
+
+
+def test_dead_worker_is_replaced(tmp_path, monkeypatch):
+    log_path = tmp_path / 'processed.log'
+    monkeypatch.setenv(LOG_VARIABLE, str(log_path))
+
+    async def main():
+        front = MultiprocessWebhook(make_dispatcher, workers=1, socket_directory=str(tmp_path))
+        await front.start()
+        link = front.links[0]
+        link.process.kill()
+        while link.restarts == 0:
+            await asyncio.sleep(0.01)
+
+        assert front.submit(message_body(1, 1))
+        await front.join()
+        assert link.processed == 1
+        await front.close()
+
+    asyncio.run(main())
+    assert log_path.read_text().split()[1:] == ['1', '1']
+
+
+def test_every_shard_of_a_worker_gets_chats(tmp_path):
+    front = MultiprocessWebhook(make_dispatcher, workers=8, socket_directory=str(tmp_path))
+    shards = UpdateShards(None, workers=16)
+    chat_ids = list(range(1, 1001)) + [-1001000000000 - number for number in range(500)]
+    used = {link.index: set() for link in front.links}
+    for update_id, chat_id in enumerate(chat_ids):
+        body = message_body(update_id, chat_id)
+        # the worker shards what the front sent it, the way serve_worker does
+        shard = shards.shard_for(types.Update(**json.loads(body)))
+        used[front.worker_for(json.loads(body)).index].add(shards.shards.index(shard))
+    assert all(indexes == set(range(16)) for indexes in used.values())
+
+
+def test_worker_dying_during_close(tmp_path, monkeypatch):
+    log_path = tmp_path / 'processed.log'
+    monkeypatch.setenv(LOG_VARIABLE, str(log_path))
+    monkeypatch.setenv(DELAY_VARIABLE, '0.1')
+
+    async def main():
+        front = MultiprocessWebhook(make_dispatcher, workers=1, socket_directory=str(tmp_path))
+        await front.start()
+        link = front.links[0]
+        for update_id in range(1, 6):
+            assert front.submit(message_body(update_id, 1))
+
+        closing = asyncio.ensure_future(front.close())
+        await asyncio.sleep(0.2)
+        link.process.kill()
+        await asyncio.wait_for(closing, timeout=30)
+
+        assert link.restarts == 1
+        assert link.depth == 0 and front.dropped == 0
+        assert link.process.exitcode == 0
+
+    asyncio.run(main())
+    # updates the killed worker processed but hadn't acknowledged are processed again
+    assert {int(line.split()[2]) for line in log_path.read_text().splitlines()} == set(range(1, 6))
+
+
+def test_failed_replacement_is_raised(tmp_path, monkeypatch):
+    monkeypatch.setenv(LOG_VARIABLE, str(tmp_path / 'processed.log'))
+
+    async def main():
+        front = MultiprocessWebhook(make_dispatcher, workers=1, socket_directory=str(tmp_path))
+        await front.start()
+        link = front.links[0]
+
+        async def start_worker(link):
+            raise RuntimeError('no room for a worker')
+
+        front._start_worker = start_worker
+        link.process.kill()
+        assert front.submit(message_body(1, 1))
+        with pytest.raises(RuntimeError):
+            await asyncio.wait_for(front.join(), timeout=30)
+        assert front.failed_restarts == 1
+        assert isinstance(link.last_error, RuntimeError)
+
+        with pytest.raises(RuntimeError):
+            await front.close()
+        assert front.dropped == 1
+
+    asyncio.run(main())
@@ -0,0 +1,101 @@
+import asyncio
+import datetime
+
+from tgstarter.storage.partitioned_storage import PartitionedMongoStorage, migrate_partitions, partition_index
+
+from tests.fake_motor import FakeMotorClient
+
+
+def test_partition_index_is_stable():
+    assert partition_index(42, 42, 8) == partition_index(42, 42, 8)
+    assert all(0 <= partition_index(chat, chat, 8) < 8 for chat in range(1000))
+
+
+def test_growing_partitions_moves_few_addresses():
+    addresses = range(10_000)
+    moved = sum(partition_index(chat, chat, 4) != partition_index(chat, chat, 5) for chat in addresses)
+    assert moved < len(addresses) * 0.25
+    assert all(
+        partition_index(chat, chat, 5) == 4
+        for chat in addresses
+        if partition_index(chat, chat, 4) != partition_index(chat, chat, 5)
+    )
+
+
+def partition_documents(partitions):
+    async def collect():
+        return [
+            [document async for document in partition.find({})]
+            for partition in partitions
+        ]
+    return collect()
+
+
+def test_migration_moves_every_document_once():
+    async def main():
+        client = FakeMotorClient()
+        database = client['tgstarter_test']
+        old = [database[f'users_{index}'] for index in range(2)]
+        new = old + [database['users_2']]
+
+        storage = PartitionedMongoStorage(client, old)
+        addresses = [(chat, chat) for chat in range(1, 201)]
+        for chat, user in addresses:
+            await storage.update_data(chat=chat, user=user, number=chat)
+
+        moved = await migrate_partitions(old, new, batch_size=16)
+        assert 0 < moved < len(addresses)
+
+        placed = {}
+        for index, documents in enumerate(await partition_documents(new)):
+            for document in documents:
+                address = document['chat_id'], document['user_id']
+                assert address not in placed
+                assert index == partition_index(*address, len(new))
+                placed[address] = document['state_data']['number']
+        assert placed == {address: address[0] for address in addresses}
+
+        # a rerun finds nothing to move and changes nothing
+        migrated = await partition_documents(new)
+        assert await migrate_partitions(old, new, batch_size=16) == 0
+        assert await partition_documents(new) == migrated
+
+        storage = PartitionedMongoStorage(client, new)
+        for chat, user in addresses:
+            assert await storage.get_data(chat=chat, user=user) == {'number': chat}
+
+    asyncio.run(main())
+
+
+def test_migration_moves_archived_documents_with_their_archive():
+    async def main():
+        idle = datetime.timedelta(days=30)
+        client = FakeMotorClient()
+        database = client['tgstarter_test']
+        old = [database[f'users_{index}'] for index in range(2)]
+        new = old + [database['users_2']]
+
+        storage = PartitionedMongoStorage(client, old, archive_after=idle)
+        await storage.ensure_indexes()
+        addresses = [(chat, chat) for chat in range(1, 21)]
+        for chat, user in addresses:
+            await storage.update_data(chat=chat, user=user, number=chat)
+            await storage.update_bucket(chat=chat, user=user, visits=chat)
+            await storage.collection_for(chat, user).update_one(
+                filter={'chat_id': chat, 'user_id': user},
+                update={'$set': {'last_seen': datetime.datetime.utcnow() - 2 * idle}}
+            )
+        assert await storage.compact() == len(addresses)
+
+        moved = await migrate_partitions(old, new)
+        assert 0 < moved < len(addresses)
+        for index, partition in enumerate(new):
+            async for document in storage.archive_for(partition).find({}):
+                assert index == partition_index(document['chat_id'], document['user_id'], len(new))
+
+        storage = PartitionedMongoStorage(client, new, archive_after=idle)
+        for chat, user in addresses:
+            assert await storage.get_data(chat=chat, user=user) == {'number': chat}
+            assert await storage.get_bucket(chat=chat, user=user) == {'visits': chat}
+
+    asyncio.run(main())
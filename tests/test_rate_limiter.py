@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+import aiogram
+from aiogram.utils.exceptions import RetryAfter
+
+from tgstarter import Bot
+from tgstarter.bot.rate_limiter import Priority, RateLimiter, priority
+
+
+def test_interactive_requests_overtake_bulk():
+    async def main():
+        limiter = RateLimiter(global_rate=5)
+        order = []
+
+        async def send(chat_id, request_priority):
+            await limiter.acquire(chat_id, priority=request_priority)
+            order.append(request_priority)
+
+        await asyncio.gather(
+            *[send(chat_id, Priority.BULK) for chat_id in range(1, 7)],
+            send(100, Priority.INTERACTIVE),
+            send(101, Priority.NORMAL),
+        )
+        assert order[:2] == [Priority.INTERACTIVE, Priority.NORMAL]
+        assert limiter.granted == 8
+        assert sum(limiter.queue_depth.values()) == 0
+
+    asyncio.run(main())
+
+
+def test_busy_chat_does_not_block_others():
+    async def main():
+        limiter = RateLimiter(global_rate=100, private_rate=10)
+        finished = {}
+
+        async def send(chat_id, number):
+            await limiter.acquire(chat_id)
+            finished[(chat_id, number)] = time.monotonic()
+
+        started = time.monotonic()
+        tasks = [asyncio.ensure_future(send(1, number)) for number in range(4)]
+        await asyncio.sleep(0.01)
+        assert limiter.queue_depth[Priority.NORMAL] == 3
+        await send(2, 0)
+        assert finished[(2, 0)] - started < 0.1
+        await asyncio.gather(*tasks)
+        # one message per 0.1s to the same private chat
+        assert finished[(1, 3)] - started >= 0.28
+
+    asyncio.run(main())
+
+
+def test_bot_honors_retry_after(monkeypatch):
+    calls = []
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        calls.append((method, time.monotonic()))
+        if len(calls) == 1:
+            raise RetryAfter(0.2)
+        return {'ok': True}
+
+    monkeypatch.setattr(aiogram.Bot, 'request', request)
+
+    async def main():
+        bot = Bot('123:token', rate_limiter=RateLimiter(private_rate=10))
+        with priority(Priority.INTERACTIVE):
+            assert await bot.request('sendMessage', {'chat_id': 1, 'text': 'text'}) == {'ok': True}
+        assert await bot.request('getMe') == {'ok': True}
+        assert [method for method, _ in calls] == ['sendMessage', 'sendMessage', 'getMe']
+        assert calls[1][1] - calls[0][1] >= 0.2
+        assert bot.rate_limiter.retries == 1
+
+    asyncio.run(main())
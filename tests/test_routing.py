@@ -0,0 +1,153 @@
+import asyncio
+
+import aiogram
+import pytest
+from aiogram import types
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+from tgstarter import Dispatcher
+from tgstarter.dispatcher.routing import IndexedHandler
+
+
+STATES = [None] + [f'form:{number}' for number in range(20)]
+
+
+def message(text=None, chat_id=1, **content):
+    return types.Message(**{
+        'message_id': 1,
+        'date': 0,
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'user'},
+        'text': text,
+        **content,
+    })
+
+
+async def process(dispatcher, event):
+    # in a task of its own, as every update is processed, so the cached state doesn't leak
+    update = types.Update(update_id=1, message=event.to_python())
+    return await asyncio.ensure_future(dispatcher.process_update(update))
+
+
+@pytest.fixture
+def routing_dispatcher(make_dispatcher):
+    """Dispatcher with command, state and content type handlers, each returning its name"""
+    def make(indexed_routing):
+        dispatcher = make_dispatcher(storage=MemoryStorage(), indexed_routing=indexed_routing)
+
+        def register(name, *custom_filters, **filters):
+            async def handler(message):
+                return name
+
+            dispatcher.register_message_handler(handler, *custom_filters, **filters)
+
+        register('start', commands=['start'], state='*')
+        register('cancel in form', commands=['Cancel'], state=[f'form:{number}' for number in range(10)])
+        register('long text', lambda message: len(message.text or '') > 20, state='*')
+        for number in range(20):
+            register(f'form:{number} photo', content_types=[types.ContentType.PHOTO], state=f'form:{number}')
+            register(f'form:{number}', state=f'form:{number}')
+        register('any content', content_types=types.ContentType.ANY, state='*')
+        return dispatcher
+
+    return make
+
+
+def test_index_matches_linear_scan(routing_dispatcher):
+    events = [
+        message('/start'),
+        message('/cancel'),
+        message('/CANCEL now'),
+        message('hello'),
+        message('a message longer than twenty characters'),
+        message(caption='/start', photo=[{'file_id': 'a', 'file_unique_id': 'a', 'width': 1, 'height': 1}]),
+        message(sticker={'file_id': 'a', 'file_unique_id': 'a', 'width': 1, 'height': 1, 'is_animated': False,
+                         'is_video': False, 'type': 'regular'}),
+    ]
+
+    async def handled(dispatcher, state, event):
+        await dispatcher.storage.set_state(chat=1, user=1, state=state)
+        return await process(dispatcher, event)
+
+    async def main():
+        indexed, linear = routing_dispatcher(True), routing_dispatcher(False)
+        assert isinstance(indexed.message_handlers, IndexedHandler)
+        assert not isinstance(linear.message_handlers, IndexedHandler)
+        for state in STATES:
+            for event in events:
+                expected = await handled(linear, state, event)
+                assert await handled(indexed, state, event) == expected, (state, event.text)
+
+        assert await handled(indexed, 'form:3', events[1]) == ['cancel in form']
+        assert await handled(indexed, 'form:13', events[1]) == ['form:13']
+        assert await handled(indexed, 'form:13', events[5]) == ['form:13 photo']
+
+    asyncio.run(main())
+
+
+def test_handlers_registered_later_are_indexed(routing_dispatcher):
+    async def main():
+        dispatcher = routing_dispatcher(True)
+        event = message('/help')
+        await dispatcher.storage.set_state(chat=1, user=1, state=None)
+        assert await process(dispatcher, event) == ['any content']
+
+        async def help_handler(message):
+            return 'help'
+
+        dispatcher.register_message_handler(help_handler, commands=['help'])
+        dispatcher.message_handlers.register(help_handler, index=0)
+        assert await process(dispatcher, event) == ['help']
+
+        order = []
+
+        @dispatcher.any_update_handler()
+        async def first(update):
+            order.append('any update')
+
+        @dispatcher.message_handler(commands=['help'], state='*')
+        async def last(message):
+            order.append('message')
+
+        await dispatcher.updates_handler.notify(types.Update(update_id=1, message=event.to_python()))
+        assert order == ['any update']
+
+    asyncio.run(main())
+
+
+def test_state_is_read_only_when_a_state_filter_comes_up(routing_dispatcher):
+    async def main():
+        dispatcher = routing_dispatcher(True)
+        get_state = dispatcher.storage.get_state
+        reads = []
+
+        async def counted_get_state(**kwargs):
+            reads.append(kwargs)
+            return await get_state(**kwargs)
+
+        dispatcher.storage.get_state = counted_get_state
+        # the '*' handler of /start matches before any handler with a state filter
+        assert await process(dispatcher, message('/start')) == ['start']
+        assert reads == []
+        assert await process(dispatcher, message('hello')) == ['any content']
+        assert len(reads) == 1
+
+    asyncio.run(main())
+
+
+def test_handlers_missing_from_older_aiogram_are_skipped(monkeypatch, make_dispatcher):
+    names = ('my_chat_member_handlers', 'chat_member_handlers', 'chat_join_request_handlers')
+    setup_filters = Dispatcher._setup_filters
+
+    def setup_filters_of_older_aiogram(dispatcher):
+        # aiogram releases before these updates existed never create the handlers
+        for name in names:
+            delattr(dispatcher, name)
+        setup_filters(dispatcher)
+
+    monkeypatch.setattr(Dispatcher, '_setup_filters', setup_filters_of_older_aiogram)
+    # aiogram's own filter setup would bind filters to the missing handlers
+    monkeypatch.setattr(aiogram.Dispatcher, '_setup_filters', lambda dispatcher: None)
+    dispatcher = make_dispatcher()
+    assert isinstance(dispatcher.message_handlers, IndexedHandler)
+    assert not any(hasattr(dispatcher, name) for name in names)
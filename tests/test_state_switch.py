@@ -0,0 +1,85 @@
+import asyncio
+
+import pytest
+
+from tgstarter import MongoStorage
+from tgstarter.middlewares.state_switch import StateSwitch
+from tgstarter.middlewares.storage_snapshot import StorageSnapshot
+
+from tests.fake_motor import FakeMotorClient
+
+
+@pytest.fixture
+def switch_dispatcher(make_dispatcher):
+    """Dispatcher on a MongoStorage with the middlewares, and the updates written to the chat's document"""
+    def make(*middlewares):
+        client = FakeMotorClient()
+        storage = MongoStorage(client, client['tgstarter_test'])
+        dispatcher = make_dispatcher(storage=storage)
+        for middleware in middlewares:
+            dispatcher.middleware.setup(middleware(storage))
+
+        writes = []
+        collection = storage.collection_for(1, 1)
+        update_one = collection.update_one
+
+        async def counted_update_one(**kwargs):
+            writes.append(kwargs['update'])
+            return await update_one(**kwargs)
+
+        collection.update_one = counted_update_one
+
+        @dispatcher.message_handler(state='*')
+        async def handler(message):
+            await storage.update_data(chat=1, user=1, answer=message.text)
+            if message.text == 'reset':
+                await storage.set_state(chat=1, user=1, state=None)
+            return 'form:name'
+
+        return dispatcher, storage, writes
+
+    return make
+
+
+async def process(dispatcher, update):
+    await asyncio.ensure_future(dispatcher.process_updates([update]))
+
+
+def test_transition_is_folded_into_the_data_write(switch_dispatcher, message_update):
+    async def main():
+        dispatcher, storage, writes = switch_dispatcher(StateSwitch)
+        await process(dispatcher, message_update(1, text='Ivan'))
+        assert len(writes) == 1
+        assert writes[0]['$set']['state'] == 'form:name'
+        assert writes[0]['$set']['state_data.answer'] == 'Ivan'
+
+        # the state doesn't change, only the data is written
+        await process(dispatcher, message_update(2, text='Petr'))
+        assert len(writes) == 2
+        assert 'state' not in writes[1]['$set']
+        assert await storage.get_state(chat=1, user=1) == 'form:name'
+        assert await storage.get_data(chat=1, user=1) == {'answer': 'Petr'}
+
+    asyncio.run(main())
+
+
+def test_state_changed_by_the_handler_is_switched_back(switch_dispatcher, message_update):
+    async def main():
+        dispatcher, storage, writes = switch_dispatcher(StateSwitch)
+        await process(dispatcher, message_update(1, text='Ivan'))
+        await process(dispatcher, message_update(2, text='reset'))
+        assert len(writes) == 2
+        assert await storage.get_state(chat=1, user=1) == 'form:name'
+
+    asyncio.run(main())
+
+
+def test_one_write_with_storage_snapshot_in_either_order(switch_dispatcher, message_update):
+    async def main():
+        for middlewares in [(StorageSnapshot, StateSwitch), (StateSwitch, StorageSnapshot)]:
+            dispatcher, storage, writes = switch_dispatcher(*middlewares)
+            await process(dispatcher, message_update(1, text='Ivan'))
+            assert len(writes) == 1
+            assert await storage.get_state(chat=1, user=1) == 'form:name'
+
+    asyncio.run(main())
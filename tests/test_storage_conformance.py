@@ -0,0 +1,221 @@
+import asyncio
+import os
+import uuid
+
+import pytest
+
+from tgstarter import MongoStorage, SQLiteStorage
+from tgstarter.models.storage import WriteMode
+from tgstarter.storage.cache import LRUCache
+from tgstarter.storage.partitioned_storage import PartitionedMongoStorage
+from tgstarter.storage.updates import Unset
+
+from tests.fake_motor import FakeMotorClient
+
+
+MONGO_URI = os.environ.get('TGSTARTER_MONGO_URI')
+
+
+async def open_mongo(tmp_path):
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    client = AsyncIOMotorClient(MONGO_URI)
+    database = client[f'tgstarter_test_{uuid.uuid4().hex}']
+    storage = MongoStorage(client, database)
+
+    async def cleanup():
+        await client.drop_database(database.name)
+        client.close()
+
+    return storage, cleanup
+
+
+async def open_fake(tmp_path):
+    client = FakeMotorClient()
+    storage = MongoStorage(client, client['tgstarter_test'])
+    await storage.ensure_indexes()
+
+    async def cleanup():
+        pass
+
+    return storage, cleanup
+
+
+async def open_fake_cached(tmp_path):
+    client = FakeMotorClient()
+    storage = MongoStorage(client, client['tgstarter_test'], cache=LRUCache(max_size=100))
+    await storage.ensure_indexes()
+
+    async def cleanup():
+        pass
+
+    return storage, cleanup
+
+
+async def open_fake_write_behind(tmp_path):
+    client = FakeMotorClient()
+    storage = MongoStorage(
+        client,
+        client['tgstarter_test'],
+        cache=LRUCache(max_size=100),
+        write_mode=WriteMode.WRITE_BEHIND,
+        write_behind_interval=0.01
+    )
+    await storage.ensure_indexes()
+
+    async def cleanup():
+        pass
+
+    return storage, cleanup
+
+
+async def open_fake_partitioned(tmp_path):
+    client = FakeMotorClient()
+    database = client['tgstarter_test']
+    storage = PartitionedMongoStorage(client, [database[f'users_{index}'] for index in range(3)])
+    await storage.ensure_indexes()
+
+    async def cleanup():
+        pass
+
+    return storage, cleanup
+
+
+async def open_sqlite(tmp_path):
+    storage = SQLiteStorage(path=str(tmp_path / 'storage.sqlite3'))
+
+    async def cleanup():
+        pass
+
+    return storage, cleanup
+
+
+BACKENDS = [
+    pytest.param(open_sqlite, id='sqlite'),
+    pytest.param(open_fake, id='fake-mongo'),
+    pytest.param(open_fake_cached, id='fake-mongo-cached'),
+    pytest.param(open_fake_write_behind, id='fake-mongo-write-behind'),
+    pytest.param(open_fake_partitioned, id='fake-mongo-partitioned'),
+    pytest.param(
+        open_mongo,
+        id='mongo',
+        marks=pytest.mark.skipif(MONGO_URI is None, reason='TGSTARTER_MONGO_URI is not set'),
+    ),
+]
+
+
+@pytest.fixture(params=BACKENDS)
+def run(request, tmp_path):
+    def runner(scenario):
+        async def main():
+            storage, cleanup = await request.param(tmp_path)
+            try:
+                await scenario(storage)
+            finally:
+                await storage.close()
+                await storage.wait_closed()
+                await cleanup()
+
+        asyncio.run(main())
+
+    return runner
+
+
+def test_state(run):
+    async def scenario(storage):
+        assert await storage.get_state(chat=1, user=2) is None
+        assert await storage.get_state(chat=1, user=2, default='default') == 'default'
+        await storage.set_state(chat=1, user=2, state='first')
+        assert await storage.get_state(chat=1, user=2) == 'first'
+        assert await storage.get_state(chat=1, user=3) is None
+        await storage.reset_state(chat=1, user=2, with_data=False)
+        assert await storage.get_state(chat=1, user=2) is None
+
+    run(scenario)
+
+
+def test_address_resolution(run):
+    async def scenario(storage):
+        await storage.set_state(chat=7, user=None, state='private')
+        assert await storage.get_state(chat=None, user=7) == 'private'
+        assert await storage.get_state(chat=7, user=7) == 'private'
+        with pytest.raises(ValueError):
+            await storage.get_state(chat=None, user=None)
+
+    run(scenario)
+
+
+def test_data(run):
+    async def scenario(storage):
+        assert await storage.get_data(chat=1, user=1) is None
+        assert await storage.get_data(chat=1, user=1, default={}) == {}
+        await storage.set_data(chat=1, user=1, data={'a': 1, 'b': 2})
+        await storage.update_data(chat=1, user=1, data={'c': 3}, b=Unset)
+        assert await storage.get_data(chat=1, user=1) == {'a': 1, 'c': 3}
+
+        await storage.increment_data(chat=1, user=1, a=2)
+        await storage.push_data(chat=1, user=1, items='x')
+        await storage.push_data(chat=1, user=1, items='y')
+        assert await storage.get_data(chat=1, user=1) == {'a': 3, 'c': 3, 'items': ['x', 'y']}
+
+        await storage.update_data(chat=1, user=1, data={'with.dot': 1})
+        assert (await storage.get_data(chat=1, user=1))['with.dot'] == 1
+
+        await storage.set_state(chat=1, user=1, state='state')
+        await storage.finish(chat=1, user=1)
+        assert await storage.get_data(chat=1, user=1) == {}
+        assert await storage.get_state(chat=1, user=1) is None
+
+    run(scenario)
+
+
+def test_bucket(run):
+    async def scenario(storage):
+        assert storage.has_bucket()
+        assert await storage.get_bucket(chat=1, user=1) is None
+        await storage.set_bucket(chat=1, user=1, bucket=None)
+        assert await storage.get_bucket(chat=1, user=1) == {}
+        await storage.update_bucket(chat=1, user=1, bucket={'a': 1}, b=2)
+        await storage.increment_bucket(chat=1, user=1, a=1)
+        assert await storage.get_bucket(chat=1, user=1) == {'a': 2, 'b': 2}
+        await storage.reset_bucket(chat=1, user=1)
+        assert await storage.get_bucket(chat=1, user=1) == {}
+
+    run(scenario)
+
+
+def test_reset_does_not_create_records(run):
+    async def scenario(storage):
+        await storage.reset_data(chat=5, user=5)
+        await storage.reset_bucket(chat=5, user=5)
+        assert await storage.get_data(chat=5, user=5) is None
+        assert await storage.get_bucket(chat=5, user=5) is None
+
+    run(scenario)
+
+
+def test_concurrent_writes(run):
+    async def scenario(storage):
+        await asyncio.gather(*[
+            storage.increment_data(chat=1, user=1, counter=1)
+            for _ in range(50)
+        ])
+        assert await storage.get_data(chat=1, user=1) == {'counter': 50}
+
+    run(scenario)
+
+
+def test_iter_and_delete_chats(run):
+    async def scenario(storage):
+        for chat, user in [(3, 3), (-10, 1), (-10, 2), (1, 1)]:
+            await storage.set_state(chat=chat, user=user, state='state')
+        assert [chat async for chat in storage.iter_chats()] == [-10, 1, 3]
+        assert [chat async for chat in storage.iter_chats(private_only=True)] == [1, 3]
+
+        assert await storage.delete_chats([-10, 3]) == 3
+        assert await storage.get_state(chat=-10, user=1) is None
+        assert await storage.get_state(chat=3, user=3) is None
+        assert await storage.get_state(chat=1, user=1) == 'state'
+        assert [chat async for chat in storage.iter_chats()] == [1]
+
+    run(scenario)
@@ -0,0 +1,55 @@
+import asyncio
+
+from tgstarter import MongoStorage
+from tgstarter.middlewares.storage_snapshot import StorageSnapshot
+from tgstarter.storage.sqlite_storage import SQLiteStorage
+
+from tests.fake_motor import FakeMotorClient
+
+
+def test_write_from_a_task_spawned_by_the_handler_after_commit(make_dispatcher, message_update):
+    async def main():
+        client = FakeMotorClient()
+        storage = MongoStorage(client, client['tgstarter_test'])
+        dispatcher = make_dispatcher(storage=storage)
+        dispatcher.middleware.setup(StorageSnapshot(storage))
+        committed = asyncio.Event()
+        spawned = []
+
+        async def later():
+            await committed.wait()
+            # the task inherited the update's snapshot scope, which is committed by now
+            assert not storage.in_snapshot
+            await storage.update_data(chat=1, user=1, later=True)
+
+        @dispatcher.message_handler()
+        async def handler(message):
+            await storage.update_data(chat=1, user=1, handler=True)
+            spawned.append(asyncio.ensure_future(later()))
+
+        await asyncio.ensure_future(dispatcher.process_updates([message_update(1)]))
+        committed.set()
+        await spawned[0]
+
+        document = await storage.collection_for(1, 1).find_one({'chat_id': 1, 'user_id': 1})
+        assert document['state_data'] == {'handler': True, 'later': True}
+
+    asyncio.run(main())
+
+
+def test_does_nothing_with_storages_without_snapshots(tmp_path, make_dispatcher, message_update):
+    async def main():
+        storage = SQLiteStorage(str(tmp_path / 'storage.sqlite3'))
+        dispatcher = make_dispatcher(storage=storage)
+        dispatcher.middleware.setup(StorageSnapshot(storage))
+
+        @dispatcher.message_handler()
+        async def handler(message):
+            await storage.update_data(chat=1, user=1, answer='yes')
+
+        await asyncio.ensure_future(dispatcher.process_updates([message_update(1)]))
+        assert await storage.get_data(chat=1, user=1) == {'answer': 'yes'}
+        await storage.close()
+        await storage.wait_closed()
+
+    asyncio.run(main())
@@ -0,0 +1,120 @@
+from html.parser import HTMLParser
+import asyncio
+import random
+
+import aiogram
+import pytest
+
+from tgstarter.utils.text_splitter import split_text, utf16_length
+
+
+class VisibleText(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.text = []
+        self.open = []
+
+    def handle_starttag(self, tag, attrs):
+        self.open.append(tag)
+
+    def handle_endtag(self, tag):
+        assert self.open.pop() == tag
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+
+def visible_html(chunk):
+    parser = VisibleText()
+    parser.feed(chunk)
+    parser.close()
+    assert parser.open == []
+    return ''.join(parser.text)
+
+
+def squeeze(text):
+    return ''.join(text.split())
+
+
+def test_plain_text_is_cut_at_best_boundary():
+    assert split_text('First sentence. Second one\nthird line', max_length=30) == [
+        'First sentence. Second one',
+        'third line',
+    ]
+    text = 'word ' * 10 + '\n\n' + 'word ' * 10
+    assert split_text(text, max_length=80)[0] == text.split('\n\n')[0]
+    assert split_text('a' * 10, max_length=4) == ['aaaa', 'aaaa', 'aa']
+
+
+def test_length_is_counted_in_utf16_units():
+    chunks = split_text('😀' * 10, max_length=5)
+    assert chunks == ['😀😀'] * 5
+    assert all(utf16_length(chunk) <= 5 for chunk in chunks)
+
+
+def test_html_tags_are_reopened():
+    text = '<b>bold <a href="https://example.com">link text</a> more</b> plain &amp; simple'
+    chunks = split_text(text, max_length=12, parse_mode='HTML')
+    assert chunks[0] == '<b>bold <a href="https://example.com">link</a></b>'
+    assert chunks[1].startswith('<b><a href="https://example.com">text</a>')
+    for chunk in chunks:
+        assert utf16_length(visible_html(chunk)) <= 12
+    assert squeeze(''.join(visible_html(chunk) for chunk in chunks)) == squeeze(visible_html(text))
+
+
+def test_markdown_v2_entities_are_reopened():
+    text = '*bold _italic text_ bold* [link text](https://example.com/a\\)b) `code \\` here` done\\.'
+    assert split_text(text, max_length=12, parse_mode='MarkdownV2') == [
+        '*bold _italic_*',
+        '*_text_ bold*',
+        '[link text](https://example.com/a\\)b)',
+        '`code \\` here`',
+        'done\\.',
+    ]
+    assert split_text('[long link text](https://example.com)', max_length=10, parse_mode='MarkdownV2') == [
+        '[long link](https://example.com)',
+        '[text](https://example.com)',
+    ]
+
+
+def test_whitespace_only_chunks_are_left_out():
+    assert split_text('  ' * 20, max_length=10) == []
+    chunks = split_text('first' + ' ' * 30 + 'second', max_length=10)
+    assert [chunk.strip() for chunk in chunks] == ['first', 'second']
+    chunks = split_text('<b>bold</b>' + ' ' * 30 + '<i>italic</i>', max_length=10, parse_mode='HTML')
+    assert [chunk.strip() for chunk in chunks] == ['<b>bold</b>', '<i>italic</i>']
+
+
+@pytest.mark.parametrize('max_length', [20, 57, 4096])
+def test_random_html_round_trip(max_length):
+    generator = random.Random(max_length)
+    words = ['alpha', 'beta.', 'gamma!', '😀', 'delta\n', '\n\n', '&lt;', 'x' * 30]
+    parts = []
+    for _ in range(2000):
+        word = generator.choice(words)
+        if generator.random() < 0.1:
+            tag = generator.choice(['b', 'i', 'code'])
+            word = f'<{tag}>{word}</{tag}>'
+        parts.append(word)
+    text = ' '.join(parts)
+
+    chunks = split_text(text, max_length=max_length, parse_mode='HTML')
+    for chunk in chunks:
+        assert 0 < utf16_length(visible_html(chunk)) <= max_length
+    assert squeeze(''.join(visible_html(chunk) for chunk in chunks)) == squeeze(visible_html(text))
+
+
+def test_send_large_message_keeps_positional_arguments(monkeypatch, make_bot):
+    sent = []
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        sent.append(data)
+        return {'message_id': len(sent), 'date': 0, 'chat': {'id': data['chat_id'], 'type': 'private'}}
+
+    monkeypatch.setattr(aiogram.Bot, 'request', request)
+    bot = make_bot()
+    # disable_web_page_preview and disable_notification, in their places from before parse_mode existed
+    messages = asyncio.run(bot.send_large_message(1, 'word ' * 10, True, True, None, 20))
+    assert len(messages) == len(sent) > 1
+    assert all(data['disable_web_page_preview'] and data['disable_notification'] for data in sent)
+    assert all('parse_mode' not in data for data in sent)
@@ -0,0 +1,96 @@
+import copy
+import random
+
+from tgstarter.storage.updates import Unset, apply_update, field_update, merge_updates
+
+
+def test_field_update():
+    update = field_update('state_data', {'a': 1, 'b': Unset})
+    assert update == {
+        '$set': {'state_data.a': 1},
+        '$unset': {'state_data.b': ''},
+    }
+
+
+def test_apply_update():
+    document = {'state_data': {'a': 1, 'b': 2}}
+    apply_update(document, {
+        '$set': {'state_data.c.d': 3},
+        '$unset': {'state_data.b': ''},
+        '$inc': {'state_data.a': 2},
+        '$push': {'bucket.items': {'$each': [1, 2]}},
+    })
+    assert document == {
+        'state_data': {'a': 3, 'c': {'d': 3}},
+        'bucket': {'items': [1, 2]},
+    }
+
+
+def test_merge_folds_into_pending_set():
+    merged = merge_updates(
+        {'$set': {'state_data': {'a': 1}}},
+        {'$inc': {'state_data.a': 1}, '$push': {'state_data.items': 'x'}},
+    )
+    assert merged == {'$set': {'state_data': {'a': 2, 'items': ['x']}}}
+
+
+def test_merge_combines_same_operator():
+    merged = merge_updates(
+        {'$inc': {'bucket.count': 1}, '$push': {'bucket.items': 1}},
+        {'$inc': {'bucket.count': 2}, '$push': {'bucket.items': {'$each': [2, 3]}}},
+    )
+    assert merged == {
+        '$inc': {'bucket.count': 3},
+        '$push': {'bucket.items': {'$each': [1, 2, 3]}},
+    }
+
+
+def test_merge_overwrites_children():
+    merged = merge_updates(
+        {'$set': {'state_data.a': 1}, '$inc': {'state_data.b': 1}},
+        {'$set': {'state_data': {}}},
+    )
+    assert merged == {'$set': {'state_data': {}}}
+
+
+def test_merge_refuses_conflicting_paths():
+    assert merge_updates({'$inc': {'bucket.count': 1}}, {'$push': {'bucket.count': 1}}) is None
+    assert merge_updates({'$inc': {'bucket.a': 1}}, {'$inc': {'bucket': 1}}) is None
+
+
+def random_update(rng):
+    paths = ['state_data', 'state_data.a', 'state_data.b', 'bucket', 'bucket.n', 'bucket.items']
+    update = {}
+    used = []
+    for _ in range(rng.randint(1, 3)):
+        path = rng.choice(paths)
+        if any(path == other or path.startswith(other + '.') or other.startswith(path + '.') for other in used):
+            continue
+        used.append(path)
+        operator = rng.choice(['$set', '$unset', '$inc', '$push'])
+        value = {'$set': rng.choice([{}, {'a': 1}, 5]), '$unset': '', '$inc': 1, '$push': 'x'}[operator]
+        update.setdefault(operator, {})[path] = value
+    return update
+
+
+def test_merge_is_equivalent_to_sequential_updates():
+    rng = random.Random(42)
+    checked = 0
+    for _ in range(3000):
+        first, second = random_update(rng), random_update(rng)
+        merged = merge_updates(first, second)
+        if merged is None:
+            continue
+
+        sequential = {'state_data': {'a': 1}, 'bucket': {'n': 1, 'items': []}}
+        combined = copy.deepcopy(sequential)
+        try:
+            apply_update(sequential, first)
+            apply_update(sequential, second)
+        except (ValueError, TypeError):
+            continue
+        apply_update(combined, merged)
+        assert combined == sequential, (first, second, merged)
+        checked += 1
+
+    assert checked > 100
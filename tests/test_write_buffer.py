@@ -0,0 +1,41 @@
+import asyncio
+
+from pymongo.errors import AutoReconnect
+
+from tgstarter.storage.write_buffer import WriteBuffer
+
+from tests.fake_motor import FakeMotorClient
+
+
+def test_failed_timer_flush_is_retried():
+    async def main():
+        collection = FakeMotorClient()['tgstarter_test'].users
+        bulk_write = collection.bulk_write
+        failures = 2
+
+        async def flaky_bulk_write(requests, **kwargs):
+            nonlocal failures
+            if failures:
+                failures -= 1
+                raise AutoReconnect('down')
+            return await bulk_write(requests, **kwargs)
+
+        collection.bulk_write = flaky_bulk_write
+        buffer = WriteBuffer(lambda key: collection, interval=0.01)
+        await buffer.add((1, 1), {'$set': {'state': 'form:name'}})
+
+        # no further add() or close(), only the timer flushes
+        for _ in range(100):
+            if buffer.flushed_writes:
+                break
+            await asyncio.sleep(0.01)
+
+        assert len(buffer) == 0
+        assert buffer.failed_flushes == 2
+        assert isinstance(buffer.last_error, AutoReconnect)
+        document = await collection.find_one({'chat_id': 1, 'user_id': 1})
+        assert document['state'] == 'form:name'
+        await buffer.close()
+        await buffer.wait_closed()
+
+    asyncio.run(main())
@@ -1,6 +1,7 @@
 from .dispatcher.dispatcher import Dispatcher
 from .storage.mongo_storage import MongoStorage
 from .storage.mongo_logger import MongoLogger
+from .storage.sqlite_storage import SQLiteStorage
 from .bot.bot import Bot
 from .handler.handler import Handler
 from .utils.content import ContentValidator
@@ -12,6 +13,7 @@ __all__ = (
     'Dispatcher',
     'MongoStorage',
     'MongoLogger',
+    'SQLiteStorage',
     'Bot',
     'Handler',
     'ContentValidator',
@@ -1,12 +1,112 @@
-import asyncio
+import time
 import typing
 
 import aiogram
 from aiogram.types import base
 from aiogram import types
+from aiogram.utils.exceptions import RetryAfter
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from tgstarter.bot.broadcast import Broadcast, Prune
+from tgstarter.bot.chat_actions import ChatActionTicker
+from tgstarter.bot.media_cache import MediaCache
+from tgstarter.bot.metrics import RequestMetrics, payload_size
+from tgstarter.bot.rate_limiter import RateLimiter, request_priority
+from tgstarter.models.storage import BroadcastResult
+from tgstarter.utils.text_splitter import split_text
+
+
+def limited_chat(method: str, data: typing.Optional[typing.Dict[str, typing.Any]]) -> typing.Tuple[bool, typing.Any]:
+    """Whether the method counts towards the rate limits and the chat it does"""
+    if not data or 'chat_id' not in data or method.startswith('get'):
+        return False, None
+    return True, data['chat_id']
 
 
 class Bot(aiogram.Bot):
+    def __init__(
+        self,
+        *args: typing.Any,
+        rate_limiter: typing.Optional[RateLimiter] = None,
+        max_retries: int = 3,
+        metrics: typing.Optional[RequestMetrics] = None,
+        media_cache: typing.Optional[MediaCache] = None,
+        connections_per_host: int = 0,
+        keepalive_timeout: float = 30.0,
+        dns_cache_ttl: typing.Optional[int] = 300,
+        **kwargs: typing.Any
+    ) -> None:
+        """connections_limit (aiogram's) caps the pool, connections_per_host=0 doesn't cap it per host;
+        a dns_cache_ttl of None caches api.telegram.org forever
+        """
+        super().__init__(*args, **kwargs)
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.metrics = metrics
+        self.media_cache = media_cache
+        self._connector_init.update(
+            limit_per_host=connections_per_host,
+            keepalive_timeout=keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=dns_cache_ttl,
+        )
+        self._chat_action_tickers: typing.Dict[float, ChatActionTicker] = {}
+
+    async def request(
+        self,
+        method: base.String,
+        data: typing.Optional[typing.Dict] = None,
+        files: typing.Optional[typing.Dict] = None,
+        **kwargs: typing.Any
+    ) -> typing.Union[typing.List, typing.Dict, base.Boolean]:
+        if self.media_cache is not None and files:
+            return await self.media_cache.request(self._limited_request, method, data, files, **kwargs)
+        return await self._limited_request(method, data, files, **kwargs)
+
+    async def _limited_request(
+        self,
+        method: base.String,
+        data: typing.Optional[typing.Dict],
+        files: typing.Optional[typing.Dict],
+        **kwargs: typing.Any
+    ) -> typing.Union[typing.List, typing.Dict, base.Boolean]:
+        limited, chat_id = limited_chat(method, data)
+        if self.rate_limiter is None or not limited:
+            return await self._request(method, data, files, **kwargs)
+
+        retries = 0
+        while True:
+            await self.rate_limiter.acquire(chat_id, priority=request_priority.get())
+            try:
+                return await self._request(method, data, files, **kwargs)
+            except RetryAfter as error:
+                if retries >= self.max_retries:
+                    raise
+                retries += 1
+                self.rate_limiter.pause(chat_id, error.timeout)
+
+    async def _request(
+        self,
+        method: base.String,
+        data: typing.Optional[typing.Dict],
+        files: typing.Optional[typing.Dict],
+        **kwargs: typing.Any
+    ) -> typing.Union[typing.List, typing.Dict, base.Boolean]:
+        """Makes one HTTP request, timed without the time spent waiting for the rate limiter"""
+        if self.metrics is None:
+            return await super().request(method, data, files, **kwargs)
+
+        size = payload_size(data, files)
+        started_at = time.perf_counter()
+        try:
+            result = await super().request(method, data, files, **kwargs)
+        except Exception as error:
+            self.metrics.observe(method, time.perf_counter() - started_at, size, error)
+            raise
+        self.metrics.observe(method, time.perf_counter() - started_at, size)
+        return result
+
     async def send_large_message(
         self,
         chat_id: typing.Union[base.Integer, base.String],
@@ -14,9 +114,10 @@ class Bot(aiogram.Bot):
         disable_web_page_preview: typing.Optional[base.Boolean] = None,
         disable_notification: typing.Optional[base.Boolean] = None,
         reply_to_message_id: typing.Optional[base.Integer] = None,
-        max_length: base.Integer = 4096
+        max_length: base.Integer = 4096,
+        parse_mode: typing.Optional[base.String] = None
     ) -> typing.List[types.Message]:
-        """No parse_mode is supported"""
+        """HTML and MarkdownV2 formatting is kept across messages, other parse modes are split as plain text"""
         kwargs = locals()
         ignore_keys = (
             'self',
@@ -26,20 +127,47 @@ class Bot(aiogram.Bot):
         for key in ignore_keys:
             del kwargs[key]
 
-        start_index = 0
-        end_index = max_length
-        cut_text = text[start_index:end_index]
-
+        kwargs['parse_mode'] = parse_mode or self.parse_mode
         result_messages = []
-        while cut_text:
+        for cut_text in split_text(text, max_length=max_length, parse_mode=kwargs['parse_mode']):
             message = await self.send_message(text=cut_text, **kwargs)
             result_messages.append(message)
-            start_index = end_index
-            end_index += max_length
-            cut_text = text[start_index:end_index]
 
         return result_messages
 
+    async def broadcast(
+        self,
+        chat_ids: typing.AsyncIterable[int],
+        *,
+        outcomes: AsyncIOMotorCollection,
+        broadcast_id: str,
+        concurrency: int = 20,
+        batch_size: int = 500,
+        prune: typing.Optional[Prune] = None,
+        **message: typing.Any
+    ) -> BroadcastResult:
+        """Sends send_message(**message) to every chat, see Broadcast; prune may be MongoStorage.delete_chats"""
+        broadcast = Broadcast(
+            self,
+            outcomes,
+            broadcast_id,
+            concurrency=concurrency,
+            batch_size=batch_size,
+            prune=prune
+        )
+        await broadcast.ensure_indexes()
+        return await broadcast.run(chat_ids, **message)
+
+    def chat_action_ticker(self, interval: float) -> ChatActionTicker:
+        ticker = self._chat_action_tickers.get(interval)
+        if ticker is None:
+            ticker = ChatActionTicker(self._send_chat_action, interval=interval)
+            self._chat_action_tickers[interval] = ticker
+        return ticker
+
+    async def _send_chat_action(self, chat_id: typing.Union[base.Integer, base.String], action: base.String) -> None:
+        await self.send_chat_action(chat_id=chat_id, action=action)
+
     async def send_with_action(
         self,
         chat_id: int,
@@ -47,20 +175,11 @@ class Bot(aiogram.Bot):
         action: str = types.ChatActions.TYPING,
         delay: int = 5
     ) -> typing.Any:
-        async def infinite_chat_action(tracked_task: asyncio.Task) -> None:
-            while True:
-                if tracked_task.done():
-                    break
-                else:
-                    await self.send_chat_action(chat_id=chat_id, action=action)
-                    await asyncio.sleep(delay)
-
-        tracked_task = asyncio.create_task(coroutine)
-        infinite_chat_action_task = asyncio.create_task(
-            infinite_chat_action(tracked_task)
-        )
-        tasks = [infinite_chat_action_task, tracked_task]
+        """Shows the action every delay seconds until the coroutine finishes, one ticker task serves all chats"""
+        async with self.chat_action_ticker(delay).track(chat_id, action):
+            return await coroutine
 
-        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-        coro = next(iter(done))
-        return coro.result()
+    async def close_chat_actions(self) -> None:
+        for ticker in self._chat_action_tickers.values():
+            await ticker.close()
+            await ticker.wait_closed()
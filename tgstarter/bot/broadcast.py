@@ -0,0 +1,206 @@
+from typing import (
+    Any,
+    AsyncIterable,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+import asyncio
+import datetime
+import time
+
+import aiogram
+import pymongo
+from aiogram.utils import exceptions
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import UpdateOne
+
+from tgstarter.bot.rate_limiter import Priority, priority
+from tgstarter.models.storage import BroadcastResult, BroadcastStatus
+
+
+Prune = Callable[[List[int]], Awaitable[Any]]
+# the chat is gone for good: retrying won't help and its records can be pruned
+BLOCKED_ERRORS = (
+    exceptions.Unauthorized,
+    exceptions.ChatNotFound,
+    exceptions.GroupDeactivated,
+)
+
+
+class Broadcast:
+    """Sends one message to many chats and records every outcome, so a stopped run can be resumed
+
+    Outcomes are kept in `outcomes` as one document per (broadcast_id, chat_id);
+    chats with a SENT or BLOCKED outcome are skipped when the same broadcast is run again.
+    """
+
+    def __init__(
+        self,
+        bot: aiogram.Bot,
+        outcomes: AsyncIOMotorCollection,
+        broadcast_id: str,
+        *,
+        concurrency: int = 20,
+        batch_size: int = 500,
+        flush_interval: float = 5.0,
+        max_retries: int = 3,
+        prune: Optional[Prune] = None
+    ) -> None:
+        self.bot = bot
+        self.outcomes = outcomes
+        self.broadcast_id = broadcast_id
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.prune = prune
+
+        self.result = BroadcastResult(broadcast_id=broadcast_id)
+        self.flush_errors = 0
+        self.last_error: Optional[BaseException] = None
+
+        self._pending: List[Tuple[int, BroadcastStatus, Optional[str]]] = []
+        self._flushed_at = time.monotonic()
+        self._flush_failing = False
+        self._lock = asyncio.Lock()
+
+    async def ensure_indexes(self) -> List[str]:
+        return [
+            await self.outcomes.create_index(
+                [
+                    ('broadcast_id', pymongo.ASCENDING),
+                    ('chat_id', pymongo.ASCENDING),
+                ],
+                unique=True
+            ),
+        ]
+
+    async def completed_chats(self) -> Set[int]:
+        cursor = self.outcomes.find(
+            {
+                'broadcast_id': self.broadcast_id,
+                'status': {'$in': [BroadcastStatus.SENT.value, BroadcastStatus.BLOCKED.value]},
+            },
+            projection={'_id': False, 'chat_id': True}
+        )
+        return {document['chat_id'] async for document in cursor}
+
+    async def run(self, chat_ids: AsyncIterable[int], **message: Any) -> BroadcastResult:
+        """message holds the send_message arguments besides chat_id"""
+        seen = await self.completed_chats()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.ensure_future(self._work(queue, message)) for _ in range(self.concurrency)]
+        try:
+            async for chat_id in chat_ids:
+                if chat_id in seen:
+                    self.result.skipped += 1
+                    continue
+                seen.add(chat_id)
+                await self._put(queue, chat_id, workers)
+            for _ in workers:
+                await self._put(queue, None, workers)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            # whatever was sent before a crash is recorded, so resuming doesn't send it twice
+            await self.flush()
+        return self.result
+
+    async def _put(self, queue: asyncio.Queue, chat_id: Optional[int], workers: List[asyncio.Future]) -> None:
+        """Waits for room in the queue, raises what a worker died of instead of waiting forever"""
+        if not queue.full():
+            queue.put_nowait(chat_id)
+            return
+        put = asyncio.ensure_future(queue.put(chat_id))
+        done, _ = await asyncio.wait([put, *workers], return_when=asyncio.FIRST_COMPLETED)
+        if put in done:
+            return
+        put.cancel()
+        # workers only return after the None sentinel, so this one failed
+        for worker in done:
+            worker.result()
+
+    async def _work(self, queue: asyncio.Queue, message: Dict[str, Any]) -> None:
+        while True:
+            chat_id = await queue.get()
+            if chat_id is None:
+                return
+            status, error = await self._send(chat_id, message)
+            await self._record(chat_id, status, error)
+
+    async def _send(self, chat_id: int, message: Dict[str, Any]) -> Tuple[BroadcastStatus, Optional[str]]:
+        retries = 0
+        while True:
+            try:
+                with priority(Priority.BULK):
+                    await self.bot.send_message(chat_id=chat_id, **message)
+                return BroadcastStatus.SENT, None
+            except BLOCKED_ERRORS as error:
+                return BroadcastStatus.BLOCKED, str(error)
+            except exceptions.RetryAfter as error:
+                # only reached without a rate limiter or once the bot gave up retrying itself
+                if retries >= self.max_retries:
+                    return BroadcastStatus.FAILED, str(error)
+                retries += 1
+                await asyncio.sleep(error.timeout)
+            except Exception as error:
+                # one broken chat must not stop the whole broadcast
+                return BroadcastStatus.FAILED, str(error)
+
+    async def _record(self, chat_id: int, status: BroadcastStatus, error: Optional[str]) -> None:
+        if status == BroadcastStatus.SENT:
+            self.result.sent += 1
+        elif status == BroadcastStatus.BLOCKED:
+            self.result.blocked += 1
+        else:
+            self.result.failed += 1
+
+        self._pending.append((chat_id, status, error))
+        # after a failed flush the batch is retried on the interval, not on every outcome
+        full = len(self._pending) >= self.batch_size and not self._flush_failing
+        if full or time.monotonic() - self._flushed_at >= self.flush_interval:
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                # the outcomes stay pending, the final flush of run() raises if Mongo stays down
+                self.flush_errors += 1
+                self.last_error = error
+                self._flush_failing = True
+
+    async def flush(self) -> None:
+        async with self._lock:
+            pending, self._pending = self._pending, []
+            self._flushed_at = time.monotonic()
+            if not pending:
+                return
+
+            now = datetime.datetime.utcnow()
+            try:
+                await self.outcomes.bulk_write(
+                    [
+                        UpdateOne(
+                            {'broadcast_id': self.broadcast_id, 'chat_id': chat_id},
+                            {'$set': {'status': status.value, 'error': error, 'datetime': now}},
+                            upsert=True
+                        )
+                        for chat_id, status, error in pending
+                    ],
+                    ordered=False
+                )
+            except BaseException:
+                self._pending = pending + self._pending
+                raise
+            self._flush_failing = False
+
+            blocked = [chat_id for chat_id, status, _ in pending if status == BroadcastStatus.BLOCKED]
+            if blocked and self.prune is not None:
+                await self.prune(blocked)
@@ -0,0 +1,164 @@
+from typing import (
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Union,
+)
+from contextlib import asynccontextmanager
+import asyncio
+import math
+import time
+
+
+ChatId = Union[int, str]
+SendAction = Callable[[ChatId, str], Awaitable[object]]
+
+
+class ChatActionTicker:
+    """Keeps chat actions ("typing..." and the like) alive for every tracked chat from a single task
+
+    Chats sit on a timer wheel of `interval / resolution` slots and are refreshed when the wheel
+    reaches their slot. A chat tracked several times at once gets one action: the latest started.
+    Every action is sent by a task of its own, so a throttled or slow chat doesn't hold back the others.
+    """
+
+    def __init__(
+        self,
+        send: SendAction,
+        *,
+        interval: float = 5.0,
+        resolution: float = 0.5,
+        clock: Callable[[], float] = time.monotonic
+    ) -> None:
+        self.send = send
+        self.interval = interval
+        self.resolution = resolution
+        self.clock = clock
+
+        self.sent = 0
+        self.errors = 0
+        self.last_error: Optional[BaseException] = None
+
+        self._wheel: List[Set[ChatId]] = [set() for _ in range(max(1, math.ceil(interval / resolution)))]
+        self._slot_of: Dict[ChatId, int] = {}
+        # actions of every tracked chat in the order they were started
+        self._actions: Dict[ChatId, List[str]] = {}
+        # chats whose action changed and is sent on the next turn
+        self._due: Set[ChatId] = set()
+        # sends still running, at most one per chat
+        self._sending: Dict[ChatId, asyncio.Future] = {}
+        self._turn = 0
+        self._started_at = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._ticker: Optional[asyncio.Future] = None
+
+    @property
+    def chats(self) -> int:
+        return len(self._actions)
+
+    @asynccontextmanager
+    async def track(self, chat_id: ChatId, action: str) -> AsyncIterator[None]:
+        """The action is shown in the chat until the block is left, however it is left"""
+        actions = self._actions.setdefault(chat_id, [])
+        if not actions or actions[-1] != action:
+            self._due.add(chat_id)
+        actions.append(action)
+        self._start()
+        try:
+            yield
+        finally:
+            self._untrack(chat_id, action)
+
+    def _untrack(self, chat_id: ChatId, action: str) -> None:
+        actions = self._actions[chat_id]
+        latest = actions[-1]
+        # the last occurrence, so an earlier block of the same action keeps its place
+        del actions[len(actions) - 1 - actions[::-1].index(action)]
+        if not actions:
+            del self._actions[chat_id]
+            self._due.discard(chat_id)
+            slot = self._slot_of.pop(chat_id, None)
+            if slot is not None:
+                self._wheel[slot].discard(chat_id)
+        elif actions[-1] != latest:
+            self._due.add(chat_id)
+            self._wake()
+
+    def _start(self) -> None:
+        if self._ticker is None or self._ticker.done():
+            self._started_at = self.clock()
+            self._turn = 0
+            self._ticker = asyncio.ensure_future(self._run())
+        self._wake()
+
+    def _wake(self) -> None:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._wakeup.set()
+
+    def _due_chats(self) -> Set[ChatId]:
+        """Takes the chats of every slot the wheel passed since the last turn"""
+        due, self._due = self._due, set()
+        current = int((self.clock() - self._started_at) / self.resolution)
+        # a stalled loop doesn't need more than one revolution to catch up
+        self._turn = max(self._turn, current - len(self._wheel) + 1)
+        while self._turn <= current:
+            slot = self._turn % len(self._wheel)
+            due |= self._wheel[slot]
+            self._wheel[slot] = set()
+            self._turn += 1
+
+        # chats come back to the same slot after a whole revolution
+        slot = (self._turn - 1) % len(self._wheel)
+        for chat_id in due:
+            previous = self._slot_of.get(chat_id)
+            if previous is not None and previous != slot:
+                self._wheel[previous].discard(chat_id)
+            self._wheel[slot].add(chat_id)
+            self._slot_of[chat_id] = slot
+        return due
+
+    async def _send(self, chat_id: ChatId, action: str) -> None:
+        try:
+            await self.send(chat_id, action)
+            self.sent += 1
+        except Exception as error:
+            self.errors += 1
+            self.last_error = error
+        finally:
+            del self._sending[chat_id]
+
+    async def _run(self) -> None:
+        assert self._wakeup is not None
+        while self._actions:
+            self._wakeup.clear()
+            for chat_id in self._due_chats():
+                if chat_id not in self._actions:
+                    continue
+                if chat_id in self._sending:
+                    # tried again on the next turn, the action may have changed meanwhile
+                    self._due.add(chat_id)
+                    continue
+                self._sending[chat_id] = asyncio.ensure_future(self._send(chat_id, self._actions[chat_id][-1]))
+
+            next_turn_at = self._started_at + self._turn * self.resolution
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, next_turn_at - self.clock()))
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self) -> None:
+        if self._ticker is not None:
+            self._ticker.cancel()
+        for sending in self._sending.values():
+            sending.cancel()
+
+    async def wait_closed(self) -> None:
+        if self._ticker is not None:
+            await asyncio.gather(self._ticker, return_exceptions=True)
+            self._ticker = None
+        await asyncio.gather(*self._sending.values(), return_exceptions=True)
@@ -0,0 +1,173 @@
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+import asyncio
+import datetime
+import hashlib
+
+from aiogram.utils import exceptions
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from tgstarter.bot.metrics import input_file_size
+from tgstarter.storage.cache import LRUCache
+
+
+SendRequest = Callable[..., Awaitable[Any]]
+
+# fields of the sent message that hold the file_id of an upload of the same name
+MEDIA_FIELDS = (
+    'photo',
+    'document',
+    'audio',
+    'video',
+    'animation',
+    'voice',
+    'video_note',
+    'sticker',
+)
+# Telegram doesn't know or doesn't accept a cached file_id any more
+STALE_ERRORS = (
+    exceptions.WrongFileIdentifier,
+    exceptions.WrongRemoteFileIdSpecified,
+    exceptions.TypeOfFileMismatch,
+)
+CHUNK_SIZE = 2 ** 16
+# files this large are hashed in a thread, not to block the loop
+THREAD_HASH_SIZE = 2 ** 20
+KEY_ATTRIBUTE = 'media_cache_key'
+
+
+def cache_as(file: Any, key: str) -> Any:
+    """Gives the upload a stable key, so it isn't hashed (needed for files streamed from a URL)"""
+    setattr(file, KEY_ATTRIBUTE, key)
+    return file
+
+
+def hash_file(file: Any) -> Optional[str]:
+    """sha256 of the file content, the read position is kept; None for files that can't be rewound"""
+    try:
+        position = file.tell()
+        file.seek(0)
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+        file.seek(position)
+    except (AttributeError, OSError, ValueError, TypeError):
+        return None
+    return digest.hexdigest()
+
+
+def sent_file_id(result: Any, field: str) -> Optional[str]:
+    media = result.get(field) if isinstance(result, dict) else None
+    if isinstance(media, list):
+        # photos come in several sizes, the largest is last and is the one that was uploaded
+        media = media[-1] if media else None
+    return media.get('file_id') if isinstance(media, dict) else None
+
+
+class MediaCache:
+    """Remembers the file_id Telegram gives an uploaded file and sends it instead of the same file later
+
+    Files are keyed by the method's media field and a content hash or a key given with `cache_as`.
+    file_ids are stored in `collection` with an LRUCache in front; media groups are not cached.
+    """
+
+    def __init__(
+        self,
+        collection: AsyncIOMotorCollection,
+        *,
+        cache: Optional[LRUCache[str, str]] = None
+    ) -> None:
+        self.collection = collection
+        self.cache = cache if cache is not None else LRUCache(max_size=10_000)
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    async def key(self, field: str, file: Any) -> Optional[str]:
+        stable_key = getattr(file, KEY_ATTRIBUTE, None)
+        if stable_key is not None:
+            return f'{field}:key:{stable_key}'
+
+        content = getattr(file, 'file', file)
+        if input_file_size(content) >= THREAD_HASH_SIZE:
+            digest = await asyncio.get_running_loop().run_in_executor(None, hash_file, content)
+        else:
+            digest = hash_file(content)
+        return f'{field}:sha256:{digest}' if digest is not None else None
+
+    async def get(self, key: str) -> Optional[str]:
+        file_id = self.cache.get(key)
+        if file_id is None:
+            document = await self.collection.find_one({'_id': key}, projection={'file_id': True})
+            if document is None:
+                return None
+            file_id = document['file_id']
+            self.cache.set(key, file_id)
+        return file_id
+
+    async def set(self, key: str, file_id: str) -> None:
+        self.cache.set(key, file_id)
+        await self.collection.update_one(
+            {'_id': key},
+            {'$set': {'file_id': file_id, 'datetime': datetime.datetime.utcnow()}},
+            upsert=True
+        )
+
+    async def invalidate(self, key: str) -> None:
+        self.cache.pop(key)
+        await self.collection.delete_one({'_id': key})
+        self.invalidated += 1
+
+    async def request(
+        self,
+        send: SendRequest,
+        method: str,
+        data: Optional[Dict[str, Any]],
+        files: Dict[str, Any],
+        **kwargs: Any
+    ) -> Any:
+        """Sends the request with cached file_ids in place of uploads and caches the file_ids of new uploads"""
+        data = dict(data or {})
+        files = dict(files)
+        uploads: List[Tuple[str, str]] = []
+        swapped: List[Tuple[str, str, Any]] = []
+        for field in MEDIA_FIELDS:
+            if field not in files:
+                continue
+            key = await self.key(field, files[field])
+            if key is None:
+                continue
+            file_id = await self.get(key)
+            if file_id is None:
+                self.misses += 1
+                uploads.append((field, key))
+            else:
+                self.hits += 1
+                swapped.append((field, key, files.pop(field)))
+                data[field] = file_id
+
+        try:
+            result = await send(method, data, files or None, **kwargs)
+        except STALE_ERRORS:
+            if not swapped:
+                raise
+            for field, key, file in swapped:
+                await self.invalidate(key)
+                files[field] = file
+                del data[field]
+                uploads.append((field, key))
+            result = await send(method, data, files, **kwargs)
+
+        for field, key in uploads:
+            file_id = sent_file_id(result, field)
+            if file_id is not None:
+                await self.set(key, file_id)
+        return result
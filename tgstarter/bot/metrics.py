@@ -0,0 +1,147 @@
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+import bisect
+
+from aiohttp import web
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PAYLOAD_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 10485760, 52428800)
+
+
+def input_file_size(file: Any) -> int:
+    """Size of an upload without reading it, 0 when it can't be told"""
+    file = getattr(file, 'file', file)
+    if isinstance(file, (bytes, bytearray)):
+        return len(file)
+    try:
+        position = file.tell()
+        size = file.seek(0, 2)
+        file.seek(position)
+        return size
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+
+def payload_size(data: Optional[Dict[str, Any]], files: Optional[Dict[str, Any]]) -> int:
+    """Approximate size of the request body: form fields as aiogram encodes them plus the uploaded files"""
+    size = 0
+    if data:
+        size += sum(len(key) + len(str(value).encode()) for key, value in data.items())
+    if files:
+        size += sum(input_file_size(file[1] if isinstance(file, tuple) else file) for file in files.values())
+    return size
+
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = tuple(buckets)
+        # the last count is for values above every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """(le, count) pairs in the Prometheus sense, ending with +Inf"""
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append(('+Inf' if bound == float('inf') else repr(bound), total))
+        return result
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket the quantile falls into"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float('inf')
+
+
+class MethodMetrics:
+    def __init__(self) -> None:
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.payload = Histogram(PAYLOAD_BUCKETS)
+        self.errors: Dict[str, int] = {}
+
+    @property
+    def requests(self) -> int:
+        return self.latency.count
+
+    @property
+    def error_count(self) -> int:
+        return sum(self.errors.values())
+
+
+class RequestMetrics:
+    """Latency, payload size and errors of Bot API requests per method
+
+    Read `methods` directly, or expose `render()` in the Prometheus text format, e.g. with `handle`.
+    """
+
+    def __init__(self, namespace: str = 'tgstarter_bot') -> None:
+        self.namespace = namespace
+        self.methods: Dict[str, MethodMetrics] = {}
+
+    def method(self, method: str) -> MethodMetrics:
+        metrics = self.methods.get(method)
+        if metrics is None:
+            metrics = self.methods[method] = MethodMetrics()
+        return metrics
+
+    def observe(self, method: str, seconds: float, size: int, error: Optional[BaseException] = None) -> None:
+        metrics = self.method(method)
+        metrics.latency.observe(seconds)
+        metrics.payload.observe(size)
+        if error is not None:
+            name = type(error).__name__
+            metrics.errors[name] = metrics.errors.get(name, 0) + 1
+
+    def _histogram_lines(self, name: str, help_text: str, histograms: Dict[str, Histogram]) -> List[str]:
+        lines = [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for method, histogram in sorted(histograms.items()):
+            for le, count in histogram.cumulative():
+                lines.append(f'{name}_bucket{{method="{method}",le="{le}"}} {count}')
+            lines.append(f'{name}_sum{{method="{method}"}} {histogram.sum!r}')
+            lines.append(f'{name}_count{{method="{method}"}} {histogram.count}')
+        return lines
+
+    def render(self) -> str:
+        lines = self._histogram_lines(
+            f'{self.namespace}_request_duration_seconds',
+            'Bot API request latency.',
+            {method: metrics.latency for method, metrics in self.methods.items()}
+        )
+        lines += self._histogram_lines(
+            f'{self.namespace}_request_payload_bytes',
+            'Approximate Bot API request body size.',
+            {method: metrics.payload for method, metrics in self.methods.items()}
+        )
+
+        name = f'{self.namespace}_request_errors_total'
+        lines += [f'# HELP {name} Failed Bot API requests by exception.', f'# TYPE {name} counter']
+        for method, metrics in sorted(self.methods.items()):
+            for error, count in sorted(metrics.errors.items()):
+                lines.append(f'{name}{{method="{method}",error="{error}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """aiohttp handler to mount as a scrape endpoint"""
+        return web.Response(text=self.render(), headers={'Content-Type': CONTENT_TYPE})
@@ -0,0 +1,221 @@
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+from contextlib import contextmanager
+from contextvars import ContextVar
+import asyncio
+import enum
+import heapq
+import itertools
+import time
+
+from tgstarter.storage.cache import LRUCache
+
+
+ChatId = Union[int, str, None]
+# priority, arrival number, future
+Waiter = Tuple[int, int, asyncio.Future]
+
+
+class Priority(enum.IntEnum):
+    INTERACTIVE = 0
+    NORMAL = 1
+    BULK = 2
+
+
+request_priority: ContextVar[Priority] = ContextVar('request_priority', default=Priority.NORMAL)
+
+
+@contextmanager
+def priority(value: Priority) -> Iterator[None]:
+    """Requests made by the Bot inside the block are scheduled with this priority"""
+    token = request_priority.set(value)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float, now: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = now
+        self.paused_until = 0.0
+
+    def refill(self, now: float) -> None:
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def ready_at(self, now: float) -> float:
+        """When the bucket has a whole token"""
+        self.refill(now)
+        ready = now if self.tokens >= 1 else now + (1 - self.tokens) / self.rate
+        return max(ready, self.paused_until)
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+
+class RateLimiter:
+    """Grants requests in priority order within a global bucket and a bucket per chat
+
+    A chat that is out of tokens doesn't hold back requests to other chats.
+    """
+
+    def __init__(
+        self,
+        *,
+        global_rate: float = 30,
+        private_rate: float = 1,
+        group_rate: float = 20 / 60,
+        group_burst: float = 20,
+        max_chats: int = 100_000,
+        clock: Callable[[], float] = time.monotonic
+    ) -> None:
+        self.global_rate = global_rate
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.group_burst = group_burst
+        self.clock = clock
+
+        self.granted = 0
+        self.retries = 0
+
+        self._global = TokenBucket(rate=global_rate, capacity=global_rate, now=clock())
+        self._buckets: LRUCache[ChatId, TokenBucket] = LRUCache(max_size=max_chats)
+        self._waiters: Dict[ChatId, List[Waiter]] = {}
+        # (priority, arrival number, chat) of chats that can be granted as soon as the global bucket allows
+        self._ready: List[Tuple[int, int, ChatId]] = []
+        # (ready at, arrival number, chat) of chats waiting for their own bucket
+        self._sleeping: List[Tuple[float, int, ChatId]] = []
+        self._arrivals = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._scheduler: Optional[asyncio.Future] = None
+
+    @property
+    def queue_depth(self) -> Dict[Priority, int]:
+        depth = {value: 0 for value in Priority}
+        for waiters in self._waiters.values():
+            for waiter_priority, _, future in waiters:
+                if not future.done():
+                    depth[Priority(waiter_priority)] += 1
+        return depth
+
+    @property
+    def waiting_chats(self) -> int:
+        return len(self._waiters)
+
+    def bucket(self, chat_id: ChatId) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(rate=self.private_rate, capacity=1, now=self.clock())
+            else:
+                bucket = TokenBucket(rate=self.group_rate, capacity=self.group_burst, now=self.clock())
+            self._buckets.set(chat_id, bucket)
+        return bucket
+
+    def pause(self, chat_id: ChatId, seconds: float) -> None:
+        """Called on RetryAfter: nothing is sent to the chat (to anyone if chat_id is None) for a while"""
+        until = self.clock() + seconds
+        bucket = self._global if chat_id is None else self.bucket(chat_id)
+        bucket.paused_until = max(bucket.paused_until, until)
+        self.retries += 1
+
+    async def acquire(self, chat_id: ChatId, priority: Priority = Priority.NORMAL) -> None:
+        future = asyncio.get_running_loop().create_future()
+        waiter = (int(priority), next(self._arrivals), future)
+        waiters = self._waiters.setdefault(chat_id, [])
+        heapq.heappush(waiters, waiter)
+        if waiters[0] is waiter:
+            self._schedule(chat_id)
+
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        if self._scheduler is None or self._scheduler.done():
+            self._scheduler = asyncio.ensure_future(self._run())
+        await future
+
+    def _schedule(self, chat_id: ChatId) -> None:
+        """Queues the head waiter of the chat as ready or sleeping"""
+        waiters = self._waiters[chat_id]
+        head_priority, arrival, _ = waiters[0]
+        now = self.clock()
+        ready_at = self.bucket(chat_id).ready_at(now) if chat_id is not None else now
+        if ready_at <= now:
+            heapq.heappush(self._ready, (head_priority, arrival, chat_id))
+        else:
+            heapq.heappush(self._sleeping, (ready_at, arrival, chat_id))
+
+    def _is_head(self, chat_id: ChatId, arrival: int) -> bool:
+        waiters = self._waiters.get(chat_id)
+        return bool(waiters) and waiters[0][1] == arrival
+
+    def _grant(self) -> Optional[float]:
+        """Grants what can be granted now, returns when to look again"""
+        now = self.clock()
+        while self._sleeping and self._sleeping[0][0] <= now:
+            _, arrival, chat_id = heapq.heappop(self._sleeping)
+            if self._is_head(chat_id, arrival):
+                self._schedule(chat_id)
+
+        while self._ready:
+            global_ready_at = self._global.ready_at(now)
+            if global_ready_at > now:
+                return global_ready_at
+
+            _, arrival, chat_id = heapq.heappop(self._ready)
+            if not self._is_head(chat_id, arrival):
+                continue
+            waiters = self._waiters[chat_id]
+            _, _, future = heapq.heappop(waiters)
+            if not future.done():
+                future.set_result(None)
+                self._global.take()
+                if chat_id is not None:
+                    self.bucket(chat_id).take()
+                self.granted += 1
+
+            # cancelled waiters are skipped without using tokens
+            while waiters and waiters[0][2].done():
+                heapq.heappop(waiters)
+            if waiters:
+                self._schedule(chat_id)
+            else:
+                del self._waiters[chat_id]
+
+        return self._sleeping[0][0] if self._sleeping else None
+
+    async def _run(self) -> None:
+        assert self._wakeup is not None
+        while self._waiters:
+            self._wakeup.clear()
+            wake_at = self._grant()
+            timeout = None if wake_at is None else max(0.0, wake_at - self.clock())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def close(self) -> None:
+        if self._scheduler is not None:
+            self._scheduler.cancel()
+        for waiters in self._waiters.values():
+            for _, _, future in waiters:
+                future.cancel()
+        self._waiters.clear()
+
+    async def wait_closed(self) -> None:
+        if self._scheduler is not None:
+            await asyncio.gather(self._scheduler, return_exceptions=True)
+            self._scheduler = None
@@ -1,14 +1,110 @@
-from typing import Callable
+from typing import (
+    Any,
+    Callable,
+    List,
+    Optional,
+)
 
 import aiogram
+from aiogram import types
 
+from tgstarter.dispatcher.routing import IndexedHandler
+from tgstarter.dispatcher.shards import UpdateShards
 from tgstarter.utils.typing import AsyncCallbackVar
 
 
+# event handlers that get a routing index, the handlers of updates and errors are left as they are
+INDEXED_HANDLERS = (
+    'message_handlers',
+    'edited_message_handlers',
+    'channel_post_handlers',
+    'edited_channel_post_handlers',
+    'inline_query_handlers',
+    'chosen_inline_result_handlers',
+    'callback_query_handlers',
+    'shipping_query_handlers',
+    'pre_checkout_query_handlers',
+    'my_chat_member_handlers',
+    'chat_member_handlers',
+    'chat_join_request_handlers',
+)
+
+
 class Dispatcher(aiogram.Dispatcher):
+    def __init__(
+        self,
+        *args: Any,
+        shard_workers: Optional[int] = None,
+        shard_queue_size: int = 100,
+        indexed_routing: bool = True,
+        **kwargs: Any
+    ) -> None:
+        """With shard_workers, updates of a chat are processed in order and different chats in parallel;
+        indexed_routing only tries the handlers whose state, content type and command can match
+
+        aiogram's Executor closes the storage and the bot session before it waits for the dispatcher,
+        so with shard_workers register close_shards as an on_shutdown callback to process the queued
+        updates while both are still open.
+        """
+        # read by _setup_filters, which aiogram calls from __init__
+        self.indexed_routing = indexed_routing
+        super().__init__(*args, **kwargs)
+        # aiogram only resolves the waiter of wait_closed when polling stops, a webhook never does
+        self._polling_started = False
+        self.shards: Optional[UpdateShards] = None
+        if shard_workers is not None:
+            self.shards = UpdateShards(
+                self.updates_handler.notify,
+                workers=shard_workers,
+                queue_size=shard_queue_size
+            )
+
+    def _setup_filters(self) -> None:
+        # the handlers are replaced before aiogram binds filters to them
+        if self.indexed_routing:
+            for name in INDEXED_HANDLERS:
+                # older aiogram 2.x releases lack the member and join request handlers
+                handler = getattr(self, name, None)
+                if handler is None:
+                    continue
+                setattr(self, name, IndexedHandler(self, once=handler.once, middleware_key=handler.middleware_key))
+        super()._setup_filters()
+
     def any_update_handler(self) -> Callable[[AsyncCallbackVar], AsyncCallbackVar]:
         def wrapper(callback: AsyncCallbackVar) -> AsyncCallbackVar:
             self.updates_handler.register(callback, index=0)
             return callback
 
         return wrapper
+
+    async def start_polling(self, *args: Any, **kwargs: Any) -> None:
+        self._polling_started = True
+        await super().start_polling(*args, **kwargs)
+
+    async def process_updates(self, updates: List[types.Update], fast: bool = True) -> List[Any]:
+        """With shard_workers, fast=False still keeps the aiogram meaning: one update after another"""
+        if self.shards is None:
+            return await super().process_updates(updates, fast)
+        if fast:
+            return await self.shards.process_updates(updates)
+        return [await self.notify_update(update) for update in updates]
+
+    async def notify_update(self, update: types.Update) -> Any:
+        """Processes one update the way process_updates does; aiogram's webhook handler calls
+        updates_handler.notify directly and skips the shards, tgstarter's WebhookRequestHandler calls this
+        """
+        if self.shards is None:
+            return await self.updates_handler.notify(update)
+        return await (await self.shards.submit(update))
+
+    async def close_shards(self) -> None:
+        """Processes the updates already queued and stops the shard workers"""
+        if self.shards is not None:
+            await self.shards.join()
+            await self.shards.close()
+            await self.shards.wait_closed()
+
+    async def wait_closed(self) -> None:
+        if self._polling_started:
+            await super().wait_closed()
+        await self.close_shards()
@@ -0,0 +1,426 @@
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+from collections import OrderedDict, deque
+import asyncio
+import functools
+import inspect
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+import struct
+import tempfile
+
+import aiogram
+from aiogram import types
+from aiohttp import web
+
+from tgstarter.dispatcher.shards import UpdateShards
+from tgstarter.storage.partitioned_storage import jump_hash
+from tgstarter.utils import helper
+
+
+DispatcherFactory = Callable[[], Union[aiogram.Dispatcher, Awaitable[aiogram.Dispatcher]]]
+
+HEADER = struct.Struct('>I')
+ACK = struct.Struct('>q')
+DRAIN = b''
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Optional[bytes]:
+    """None when the other side is gone"""
+    try:
+        header = await reader.readexactly(HEADER.size)
+        size, = HEADER.unpack(header)
+        return await reader.readexactly(size)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+
+
+def write_frame(writer: asyncio.StreamWriter, payload: bytes) -> None:
+    writer.write(HEADER.pack(len(payload)) + payload)
+
+
+def update_key(data: Dict[str, Any]) -> Optional[int]:
+    """Same key as the Dispatcher shards use: the chat, or the user when there is no chat"""
+    chat, user = helper.python_update_chat_and_user(data)
+    for holder in (chat, user):
+        if holder is not None and holder.get('id') is not None:
+            return holder['id']
+    return None
+
+
+async def serve_worker(
+    dispatcher: aiogram.Dispatcher,
+    socket_path: str,
+    *,
+    shard_workers: int = 16,
+    shard_queue_size: int = 100
+) -> None:
+    """Processes the updates sent by the front until it asks to drain or goes away"""
+    aiogram.Bot.set_current(dispatcher.bot)
+    aiogram.Dispatcher.set_current(dispatcher)
+    shards = getattr(dispatcher, 'shards', None) or UpdateShards(
+        dispatcher.updates_handler.notify,
+        workers=shard_workers,
+        queue_size=shard_queue_size
+    )
+    finished = asyncio.Event()
+
+    async def acknowledge(future: asyncio.Future, update_id: int, writer: asyncio.StreamWriter) -> None:
+        try:
+            await future
+        except Exception:
+            # failed updates are acknowledged too, or the front would send them forever
+            pass
+        if not writer.is_closing():
+            write_frame(writer, ACK.pack(update_id))
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        acknowledgements: List[asyncio.Future] = []
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                if frame == DRAIN:
+                    await asyncio.gather(*acknowledgements)
+                    write_frame(writer, DRAIN)
+                    await writer.drain()
+                    break
+                update = types.Update(**json.loads(frame))
+                # waits while the shard of the chat is full, which holds back the front
+                future = await shards.submit(update)
+                acknowledgements = [task for task in acknowledgements if not task.done()]
+                acknowledgements.append(asyncio.ensure_future(acknowledge(future, update.update_id, writer)))
+        finally:
+            writer.close()
+            finished.set()
+
+    server = await asyncio.start_unix_server(handle, path=socket_path)
+    try:
+        await finished.wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        await shards.join()
+        await shards.close()
+        await shards.wait_closed()
+        await dispatcher.storage.close()
+        await dispatcher.storage.wait_closed()
+        await dispatcher.bot.close()
+
+
+def run_worker(factory: DispatcherFactory, socket_path: str, shard_workers: int, shard_queue_size: int) -> None:
+    """Entry point of a worker process"""
+    # Ctrl+C reaches the whole process group, the front drains the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    async def main() -> None:
+        dispatcher = factory()
+        if inspect.isawaitable(dispatcher):
+            dispatcher = await dispatcher
+        await serve_worker(
+            dispatcher,
+            socket_path,
+            shard_workers=shard_workers,
+            shard_queue_size=shard_queue_size
+        )
+
+    asyncio.run(main())
+
+
+class WorkerLink:
+    def __init__(self, index: int, socket_path: str) -> None:
+        self.index = index
+        self.socket_path = socket_path
+        self.process: Optional[multiprocessing.process.BaseProcess] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        # updates not sent yet and sent but not acknowledged, both in arrival order
+        self.pending: Deque[Tuple[int, bytes]] = deque()
+        self.in_flight: 'OrderedDict[int, bytes]' = OrderedDict()
+        self.draining = False
+        self.processed = 0
+        self.restarts = 0
+        # the task starting a worker in place of a dead one, and why the last such start failed
+        self.replacement: Optional[asyncio.Future] = None
+        self.last_error: Optional[BaseException] = None
+
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.drained = asyncio.Event()
+        self.tasks: List[asyncio.Future] = []
+
+    @property
+    def depth(self) -> int:
+        return len(self.pending) + len(self.in_flight)
+
+    def requeue(self) -> None:
+        """Unacknowledged updates go back in front of the pending ones, in their order"""
+        self.pending.extendleft(reversed(list(self.in_flight.items())))
+        self.in_flight.clear()
+        self.idle.set()
+
+
+class MultiprocessWebhook:
+    """Receives the webhook and hands every update to a worker process chosen by the chat
+
+    A chat always lands on the same worker, so its updates keep their order. Each worker runs
+    its own Dispatcher, Bot and storage, built by `factory` inside the worker process, so it has
+    to be a picklable module-level callable; it may be a coroutine function.
+
+    Front and worker talk over a Unix socket with length-prefixed frames: the front sends update
+    JSON and an empty frame to ask for a drain, the worker answers with the update_id of every
+    processed update and an empty frame once drained. Updates stay in the front until they are
+    acknowledged, so the updates of a worker that died are sent to the one started in its place.
+    """
+
+    def __init__(
+        self,
+        factory: DispatcherFactory,
+        *,
+        workers: Optional[int] = None,
+        socket_directory: Optional[str] = None,
+        max_pending: int = 1000,
+        max_in_flight: int = 100,
+        shard_workers: int = 16,
+        shard_queue_size: int = 100,
+        start_timeout: float = 30.0
+    ) -> None:
+        self.factory = factory
+        self.max_pending = max_pending
+        self.max_in_flight = max_in_flight
+        self.shard_workers = shard_workers
+        self.shard_queue_size = shard_queue_size
+        self.start_timeout = start_timeout
+        self.rejected = 0
+        # updates left with a worker that died while draining on close
+        self.dropped = 0
+        self.failed_restarts = 0
+
+        self.socket_directory = socket_directory or tempfile.mkdtemp(prefix='tgstarter-')
+        self.links = [
+            WorkerLink(index, os.path.join(self.socket_directory, f'worker-{index}.sock'))
+            for index in range(workers or os.cpu_count() or 1)
+        ]
+        self._context = multiprocessing.get_context('spawn')
+        # updates without a chat or user aren't ordered and are spread evenly
+        self._round_robin = itertools.cycle(range(len(self.links)))
+        self._closing = False
+
+    def worker_for(self, data: Dict[str, Any]) -> WorkerLink:
+        key = update_key(data)
+        # not key % workers: the worker shards by key % shard_workers, which would then only
+        # ever see the keys of one residue and leave most of its shards idle
+        index = next(self._round_robin) if key is None else jump_hash(key, len(self.links))
+        return self.links[index]
+
+    def submit(self, body: bytes) -> bool:
+        """Queues the update for its worker, False when the worker is too far behind"""
+        data = json.loads(body)
+        link = self.worker_for(data)
+        if self._closing or len(link.pending) >= self.max_pending:
+            self.rejected += 1
+            return False
+        link.pending.append((data['update_id'], body))
+        link.wakeup.set()
+        return True
+
+    async def start(self) -> None:
+        os.makedirs(self.socket_directory, exist_ok=True)
+        await asyncio.gather(*[self._start_worker(link) for link in self.links])
+
+    async def _start_worker(self, link: WorkerLink) -> None:
+        if os.path.exists(link.socket_path):
+            os.remove(link.socket_path)
+        link.process = self._context.Process(
+            target=run_worker,
+            args=(self.factory, link.socket_path, self.shard_workers, self.shard_queue_size),
+            name=f'tgstarter-worker-{link.index}',
+            daemon=True
+        )
+        link.process.start()
+
+        reader, link.writer = await self._connect(link)
+        link.draining = False
+        link.drained.clear()
+        link.tasks = [
+            asyncio.ensure_future(self._send(link, link.writer)),
+            asyncio.ensure_future(self._read_acknowledgements(link, reader)),
+        ]
+
+    async def _connect(self, link: WorkerLink) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        assert link.process is not None
+        deadline = asyncio.get_running_loop().time() + self.start_timeout
+        while True:
+            try:
+                return await asyncio.open_unix_connection(link.socket_path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if not link.process.is_alive():
+                    raise RuntimeError(f'worker {link.index} exited with code {link.process.exitcode}')
+                if asyncio.get_running_loop().time() > deadline:
+                    raise TimeoutError(f'worker {link.index} did not start in {self.start_timeout} seconds')
+                await asyncio.sleep(0.05)
+
+    async def _send(self, link: WorkerLink, writer: asyncio.StreamWriter) -> None:
+        while True:
+            while not link.pending or link.draining or len(link.in_flight) >= self.max_in_flight:
+                link.wakeup.clear()
+                await link.wakeup.wait()
+            update_id, body = link.pending.popleft()
+            link.in_flight[update_id] = body
+            link.idle.clear()
+            write_frame(writer, body)
+            await writer.drain()
+
+    async def _read_acknowledgements(self, link: WorkerLink, reader: asyncio.StreamReader) -> None:
+        while True:
+            frame = await read_frame(reader)
+            if frame is None or frame == DRAIN:
+                break
+            update_id, = ACK.unpack(frame)
+            if link.in_flight.pop(update_id, None) is not None:
+                link.processed += 1
+            if not link.in_flight:
+                link.idle.set()
+            link.wakeup.set()
+
+        if frame is None and not link.draining:
+            # the worker died: its updates go to a new one
+            link.requeue()
+            link.restarts += 1
+            link.replacement = asyncio.ensure_future(self._replace(link))
+            link.replacement.add_done_callback(functools.partial(self._replaced, link))
+        else:
+            link.requeue()
+            link.drained.set()
+
+    async def _replace(self, link: WorkerLink) -> None:
+        await self._stop_tasks(link)
+        await self._join(link)
+        # on close a new worker is still needed for the updates the dead one left
+        if not self._closing or link.depth:
+            await self._start_worker(link)
+
+    def _replaced(self, link: WorkerLink, replacement: asyncio.Future) -> None:
+        if not replacement.cancelled() and replacement.exception() is not None:
+            self.failed_restarts += 1
+            link.last_error = replacement.exception()
+
+    async def _stop_tasks(self, link: WorkerLink) -> None:
+        current = asyncio.current_task()
+        tasks = [task for task in link.tasks if task is not current]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if link.writer is not None:
+            link.writer.close()
+            link.writer = None
+
+    async def _join(self, link: WorkerLink) -> None:
+        if link.process is not None:
+            await asyncio.get_running_loop().run_in_executor(None, link.process.join)
+
+    async def drain_worker(self, index: int) -> None:
+        """Stops sending to the worker, lets it finish what it has and waits for it to exit;
+        updates for it keep queueing in the front meanwhile
+        """
+        link = self.links[index]
+        if link.replacement is not None and not link.replacement.done():
+            await asyncio.gather(link.replacement, return_exceptions=True)
+        link.draining = True
+        while link.in_flight and not link.drained.is_set():
+            link.idle.clear()
+            waiters = [asyncio.ensure_future(link.idle.wait()), asyncio.ensure_future(link.drained.wait())]
+            _, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in pending:
+                waiter.cancel()
+        if not link.drained.is_set() and link.writer is not None:
+            write_frame(link.writer, DRAIN)
+            await link.writer.drain()
+            await link.drained.wait()
+        await self._stop_tasks(link)
+        await self._join(link)
+
+    async def restart_worker(self, index: int) -> None:
+        link = self.links[index]
+        await self.drain_worker(index)
+        link.restarts += 1
+        await self._start_worker(link)
+
+    async def restart_workers(self) -> None:
+        """Rolling restart, one worker at a time"""
+        for link in self.links:
+            await self.restart_worker(link.index)
+
+    async def join(self) -> None:
+        """Waits until every update received so far is processed,
+        raises the error of a worker that could not be started in place of a dead one
+        """
+        for link in self.links:
+            while link.depth:
+                replacement = link.replacement
+                if replacement is not None and replacement.done() and not replacement.cancelled():
+                    if replacement.exception() is not None:
+                        raise replacement.exception()
+                    replacement = None
+                link.idle.clear()
+                waiters = [asyncio.ensure_future(link.idle.wait())]
+                if replacement is not None:
+                    waiters.append(replacement)
+                await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+                waiters[0].cancel()
+
+    async def close(self) -> None:
+        """Stops taking updates, sends what is queued, drains the workers"""
+        self._closing = True
+        try:
+            await self.join()
+        finally:
+            await asyncio.gather(*[self.drain_worker(link.index) for link in self.links])
+            for link in self.links:
+                # nothing is left to process them, and Telegram won't send them again
+                self.dropped += link.depth
+                link.pending.clear()
+                link.in_flight.clear()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        # Telegram sends the update again later when the answer isn't a success
+        if not self.submit(await request.read()):
+            return web.Response(status=503)
+        return web.Response()
+
+    def app(self, path: str = '/webhook') -> web.Application:
+        async def on_startup(app: web.Application) -> None:
+            await self.start()
+
+        async def on_cleanup(app: web.Application) -> None:
+            await self.close()
+
+        app = web.Application()
+        app.router.add_post(path, self.handle)
+        app.on_startup.append(on_startup)
+        app.on_cleanup.append(on_cleanup)
+        return app
+
+
+def run_multiprocess_webhook(
+    factory: DispatcherFactory,
+    *,
+    path: str = '/webhook',
+    host: Optional[str] = None,
+    port: Optional[int] = None,
+    **kwargs: Any
+) -> None:
+    """Serves the webhook until interrupted, kwargs go to MultiprocessWebhook"""
+    web.run_app(MultiprocessWebhook(factory, **kwargs).app(path), host=host, port=port)
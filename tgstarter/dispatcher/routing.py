@@ -0,0 +1,239 @@
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    FrozenSet,
+    Hashable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from aiogram import types
+from aiogram.dispatcher.filters import Command, ContentTypeFilter, StateFilter
+from aiogram.dispatcher.handler import (
+    CancelHandler,
+    Handler,
+    SkipHandler,
+    _check_spec,
+    ctx_data,
+    current_handler,
+)
+
+
+# a key that no handler is indexed by, so only handlers that accept anything match it
+MISSING = object()
+# the event has neither chat nor user, so no state filter but '*' can pass
+NO_TARGET = object()
+
+
+class Dimension:
+    """Positions of handlers by the keys they accept; None keys mean the handler accepts anything"""
+
+    def __init__(self) -> None:
+        self.any: Set[int] = set()
+        self.by_key: Dict[Hashable, Set[int]] = {}
+
+    def add(self, position: int, keys: Optional[FrozenSet[Hashable]]) -> None:
+        if keys is None:
+            self.any.add(position)
+        else:
+            for key in keys:
+                self.by_key.setdefault(key, set()).add(position)
+
+    @property
+    def indexed(self) -> bool:
+        return bool(self.by_key)
+
+    def normalize(self, key: Hashable) -> Hashable:
+        return key if key in self.by_key else MISSING
+
+    def positions(self, key: Hashable) -> Set[int]:
+        return self.any | self.by_key.get(key, set())
+
+
+def filter_instances(handler_obj: Handler.HandlerObj) -> List[Any]:
+    return [filter_obj.filter for filter_obj in handler_obj.filters or ()]
+
+
+def state_keys(handler_obj: Handler.HandlerObj) -> Optional[FrozenSet[Hashable]]:
+    keys: Optional[FrozenSet[Hashable]] = None
+    for filter_ in filter_instances(handler_obj):
+        if isinstance(filter_, StateFilter) and '*' not in filter_.states:
+            states = frozenset(filter_.states)
+            keys = states if keys is None else keys & states
+    return keys
+
+
+def content_type_keys(handler_obj: Handler.HandlerObj) -> Optional[FrozenSet[Hashable]]:
+    keys: Optional[FrozenSet[Hashable]] = None
+    for filter_ in filter_instances(handler_obj):
+        if isinstance(filter_, ContentTypeFilter) and types.ContentType.ANY not in filter_.content_types:
+            content_types = frozenset(filter_.content_types)
+            keys = content_types if keys is None else keys & content_types
+    return keys
+
+
+def command_keys(handler_obj: Handler.HandlerObj) -> Optional[FrozenSet[Hashable]]:
+    keys: Optional[FrozenSet[Hashable]] = None
+    for filter_ in filter_instances(handler_obj):
+        if isinstance(filter_, Command):
+            # case insensitive, so the index never rules out what the filter would accept
+            commands = frozenset(command.lower() for command in filter_.commands)
+            keys = commands if keys is None else keys & commands
+    return keys
+
+
+def message_command(message: Any) -> Optional[str]:
+    """The command as Command.check_command reads it, lower-cased"""
+    text = getattr(message, 'text', None) or getattr(message, 'caption', None)
+    words = text.split(maxsplit=1) if isinstance(text, str) else None
+    if not words:
+        return None
+    return words[0][1:].partition('@')[0].lower()
+
+
+def state_target(event: Any) -> Tuple[Optional[int], Optional[int]]:
+    """Chat and user of the event, the way StateFilter.get_target finds them"""
+    chat_holder = event.message if isinstance(event, types.CallbackQuery) else event
+    chat = getattr(getattr(chat_holder, 'chat', None), 'id', None)
+    return chat, getattr(getattr(event, 'from_user', None), 'id', None)
+
+
+class HandlerIndex:
+    def __init__(self, handlers: List[Handler.HandlerObj]) -> None:
+        self.handlers = list(handlers)
+        self.states = Dimension()
+        self.content_types = Dimension()
+        self.commands = Dimension()
+        for position, handler_obj in enumerate(self.handlers):
+            self.states.add(position, state_keys(handler_obj))
+            self.content_types.add(position, content_type_keys(handler_obj))
+            self.commands.add(position, command_keys(handler_obj))
+
+        # (content type, command) -> positions of the handlers that can match, in order
+        self._event_cache: Dict[Tuple[Hashable, Hashable], List[int]] = {}
+
+    def event_candidates(self, event: Any) -> List[int]:
+        content_type: Hashable = MISSING
+        command: Hashable = MISSING
+        if self.content_types.indexed:
+            content_type = self.content_types.normalize(getattr(event, 'content_type', MISSING))
+        if self.commands.indexed:
+            command = self.commands.normalize(message_command(event))
+
+        positions = self._event_cache.get((content_type, command))
+        if positions is None:
+            positions = sorted(self.content_types.positions(content_type) & self.commands.positions(command))
+            self._event_cache[(content_type, command)] = positions
+        return positions
+
+    def state_positions(self, state: Hashable) -> Set[int]:
+        """Positions of the handlers with a state filter that the state passes"""
+        return self.states.by_key.get(state, set())
+
+
+class IndexedHandler(Handler):
+    """Handler that only tries the handlers whose state, content type and command filters can pass
+
+    The index is rebuilt when handlers change. Handlers are still tried in registration order
+    and every filter is still checked, so the result is the same as with a linear scan.
+    """
+
+    def __init__(self, dispatcher: Any, once: bool = True, middleware_key: Optional[str] = None) -> None:
+        super().__init__(dispatcher, once=once, middleware_key=middleware_key)
+        self._index: Optional[HandlerIndex] = None
+
+    def register(self, handler: Any, filters: Any = None, index: Optional[int] = None) -> None:
+        super().register(handler, filters=filters, index=index)
+        self._index = None
+
+    def unregister(self, handler: Any) -> bool:
+        result = super().unregister(handler)
+        self._index = None
+        return result
+
+    @property
+    def index(self) -> HandlerIndex:
+        # handlers appended to the list directly are noticed by the length
+        if self._index is None or len(self._index.handlers) != len(self.handlers):
+            self._index = HandlerIndex(self.handlers)
+        return self._index
+
+    async def current_state(self, event: Any) -> Hashable:
+        """The state the way StateFilter reads it, cached for the following StateFilter checks"""
+        try:
+            return StateFilter.ctx_state.get()
+        except LookupError:
+            chat, user = state_target(event)
+            if not (chat or user):
+                return NO_TARGET
+            state = await self.dispatcher.storage.get_state(chat=chat, user=user)
+            StateFilter.ctx_state.set(state)
+            return state
+
+    async def candidates(self, event: Any) -> AsyncIterator[Handler.HandlerObj]:
+        """The state is only read once a handler with a state filter comes up, as StateFilter would"""
+        index = self.index
+        state_positions: Optional[Set[int]] = None
+        for position in index.event_candidates(event):
+            if position not in index.states.any:
+                if state_positions is None:
+                    state_positions = index.state_positions(await self.current_state(event))
+                if position not in state_positions:
+                    continue
+            yield index.handlers[position]
+
+    async def all_handlers(self) -> AsyncIterator[Handler.HandlerObj]:
+        for handler_obj in self.handlers:
+            yield handler_obj
+
+    async def notify(self, *args: Any) -> List[Any]:
+        """aiogram's Handler.notify, over the candidates instead of every handler"""
+        from aiogram.dispatcher.filters import FilterNotPassed, check_filters
+
+        results: List[Any] = []
+
+        data: Dict[str, Any] = {}
+        ctx_data.set(data)
+
+        if self.middleware_key:
+            try:
+                await self.dispatcher.middleware.trigger(f'pre_process_{self.middleware_key}', args + (data,))
+            except CancelHandler:
+                return results
+
+        try:
+            # after the pre-process middlewares, which may change the state
+            handlers = self.candidates(args[0]) if args else self.all_handlers()
+            async for handler_obj in handlers:
+                try:
+                    data.update(await check_filters(handler_obj.filters, args))
+                except FilterNotPassed:
+                    continue
+                else:
+                    ctx_token = current_handler.set(handler_obj.handler)
+                    try:
+                        if self.middleware_key:
+                            await self.dispatcher.middleware.trigger(f'process_{self.middleware_key}', args + (data,))
+                        partial_data = _check_spec(handler_obj.spec, data)
+                        response = await handler_obj.handler(*args, **partial_data)
+                        if response is not None:
+                            results.append(response)
+                        if self.once:
+                            break
+                    except SkipHandler:
+                        continue
+                    except CancelHandler:
+                        break
+                    finally:
+                        current_handler.reset(ctx_token)
+        finally:
+            if self.middleware_key:
+                await self.dispatcher.middleware.trigger(
+                    f'post_process_{self.middleware_key}',
+                    args + (results, data)
+                )
+
+        return results
@@ -0,0 +1,167 @@
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+from collections import deque
+import asyncio
+import itertools
+import time
+
+from aiogram import types
+
+from tgstarter.utils import helper
+
+
+ProcessUpdate = Callable[[types.Update], Awaitable[Any]]
+# update, when it was queued, future of its result
+Item = Tuple[types.Update, float, asyncio.Future]
+
+
+def update_shard_key(update: types.Update) -> Optional[int]:
+    """Updates with the same key must be processed in order: the chat, or the user when there is no chat"""
+    chat, user = helper.update_chat_and_user(update)
+    if chat is not None and chat.id is not None:
+        return chat.id
+    if user is not None and user.id is not None:
+        return user.id
+    return None
+
+
+class Shard:
+    def __init__(self, queue_size: int) -> None:
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        # when every queued update was queued, oldest first
+        self.queued_at: Deque[float] = deque()
+        self.processed = 0
+        self.failed = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.worker: Optional[asyncio.Future] = None
+
+    @property
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def lag(self, now: float) -> float:
+        """How long the oldest queued update has been waiting"""
+        return now - self.queued_at[0] if self.queued_at else 0.0
+
+
+class UpdateShards:
+    """Processes the updates of one chat in order and the updates of different chats in parallel
+
+    Every chat maps to one of `workers` shards, each a bounded queue served by one task;
+    submitting to a full shard waits, which slows down whoever feeds the updates.
+    Updates are submitted one producer at a time in arrival order, so concurrent producers
+    (polling batches, webhook requests) can't overtake each other while a shard is full.
+    """
+
+    def __init__(
+        self,
+        process: ProcessUpdate,
+        *,
+        workers: int = 16,
+        queue_size: int = 100,
+        clock: Callable[[], float] = time.monotonic
+    ) -> None:
+        if workers < 1:
+            raise ValueError(f'workers must be positive, got {workers}')
+
+        self.process = process
+        self.clock = clock
+        self.shards = [Shard(queue_size) for _ in range(workers)]
+        # updates without a chat or user aren't ordered and are spread evenly
+        self._round_robin = itertools.cycle(range(workers))
+        self._intake: Optional[asyncio.Lock] = None
+
+    def shard_for(self, update: types.Update) -> Shard:
+        key = update_shard_key(update)
+        index = next(self._round_robin) if key is None else key % len(self.shards)
+        return self.shards[index]
+
+    @property
+    def depth(self) -> int:
+        return sum(shard.depth for shard in self.shards)
+
+    def lags(self) -> List[float]:
+        now = self.clock()
+        return [shard.lag(now) for shard in self.shards]
+
+    def _get_intake(self) -> asyncio.Lock:
+        # the lock is bound to the running loop on Python < 3.10, so it's created on first use
+        if self._intake is None:
+            self._intake = asyncio.Lock()
+        return self._intake
+
+    async def submit(self, update: types.Update) -> asyncio.Future:
+        """Queues the update and returns the future of its result, waits while the shard is full"""
+        # asyncio.Lock wakes its waiters first come first served, unlike the putters of a full queue
+        async with self._get_intake():
+            return await self._submit(update)
+
+    async def _submit(self, update: types.Update) -> asyncio.Future:
+        shard = self.shard_for(update)
+        future = asyncio.get_running_loop().create_future()
+        queued_at = self.clock()
+        await shard.queue.put((update, queued_at, future))
+        shard.queued_at.append(queued_at)
+        if shard.worker is None or shard.worker.done():
+            shard.worker = asyncio.ensure_future(self._work(shard))
+        return future
+
+    async def process_updates(self, updates: Iterable[types.Update]) -> List[Any]:
+        # the whole batch goes in before a later batch starts
+        async with self._get_intake():
+            futures = [await self._submit(update) for update in updates]
+        return list(await asyncio.gather(*futures))
+
+    async def _work(self, shard: Shard) -> None:
+        while True:
+            item: Item = await shard.queue.get()
+            update, queued_at, future = item
+            shard.queued_at.popleft()
+            shard.last_lag = self.clock() - queued_at
+            shard.max_lag = max(shard.max_lag, shard.last_lag)
+            try:
+                # a task of its own copies the context, so context variables set by filters
+                # (e.g. the cached state) don't leak into the next update of the shard
+                result = await asyncio.ensure_future(self.process(update))
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as error:
+                shard.failed += 1
+                if not future.done():
+                    future.set_exception(error)
+            else:
+                shard.processed += 1
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                shard.queue.task_done()
+
+    async def join(self) -> None:
+        """Waits until every queued update is processed"""
+        for shard in self.shards:
+            await shard.queue.join()
+
+    async def close(self) -> None:
+        for shard in self.shards:
+            if shard.worker is not None:
+                shard.worker.cancel()
+
+    async def wait_closed(self) -> None:
+        for shard in self.shards:
+            if shard.worker is not None:
+                await asyncio.gather(shard.worker, return_exceptions=True)
+                shard.worker = None
+            while not shard.queue.empty():
+                _, _, future = shard.queue.get_nowait()
+                future.cancel()
+            shard.queued_at.clear()
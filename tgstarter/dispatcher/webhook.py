@@ -0,0 +1,54 @@
+from typing import Any
+import asyncio
+import functools
+
+from aiogram import types
+from aiogram.dispatcher import webhook
+from aiohttp import web
+
+
+class WebhookRequestHandler(webhook.WebhookRequestHandler):
+    """aiogram's webhook handler, with updates going through Dispatcher.notify_update,
+    so a Dispatcher with shard_workers keeps the updates of a chat in order
+    """
+
+    async def process_update(self, update: types.Update) -> Any:
+        """aiogram's WebhookRequestHandler.process_update with notify_update in place of updates_handler.notify"""
+        dispatcher = self.get_dispatcher()
+        loop = asyncio.get_event_loop()
+
+        # Analog of `asyncio.wait_for` but without cancelling task
+        waiter = loop.create_future()
+        timeout_handle = loop.call_later(webhook.RESPONSE_TIMEOUT, asyncio.tasks._release_waiter, waiter)
+        callback = functools.partial(asyncio.tasks._release_waiter, waiter)
+
+        future = asyncio.ensure_future(dispatcher.notify_update(update))
+        future.add_done_callback(callback)
+
+        try:
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                future.remove_done_callback(callback)
+                future.cancel()
+                raise
+
+            if future.done():
+                return future.result()
+            future.remove_done_callback(callback)
+            future.add_done_callback(self.respond_via_request)
+        finally:
+            timeout_handle.cancel()
+
+
+def configure_app(
+    dispatcher: Any,
+    app: web.Application,
+    path: str = webhook.DEFAULT_WEB_PATH,
+    route_name: str = webhook.DEFAULT_ROUTE_NAME
+) -> None:
+    """aiogram's configure_app with tgstarter's WebhookRequestHandler;
+    with aiogram's Executor pass request_handler=WebhookRequestHandler to set_webhook instead
+    """
+    app.router.add_route('*', path, WebhookRequestHandler, name=route_name)
+    app[webhook.BOT_DISPATCHER_KEY] = dispatcher
@@ -1,23 +1,71 @@
-from typing import List, Any
+from typing import (
+    Any,
+    List,
+    Optional,
+    Tuple,
+)
 
 from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.dispatcher.storage import BaseStorage
-from aiogram.types import Update, User, Chat
+from aiogram.types import Update
+
+from tgstarter.storage.mongo_storage import MongoStorage
+from tgstarter.utils import helper
+
+
+# key of the update's middleware data
+ADDRESS_KEY = 'state_switch_address'
 
 
 class StateSwitch(BaseMiddleware):
+    """Switches to the state returned by the last handler
+
+    With MongoStorage the update is processed inside a snapshot that starts with the current state,
+    so the transition is written together with the data and bucket changes of the update, in one write.
+    A transition to the state the user is already in isn't written at all.
+    """
+
     def __init__(self, storage: BaseStorage) -> None:
         super(StateSwitch, self).__init__()
         self.storage = storage
 
-    async def on_post_process_update(self, update: Update, results: List[Any], data: dict):
+    def address(self, update: Update) -> Optional[Tuple[Optional[int], Optional[int]]]:
+        chat, user = helper.update_chat_and_user(update)
+        if chat is None and user is None:
+            return None
+        return chat.id if chat is not None else None, user.id if user is not None else None
+
+    async def on_pre_process_update(self, update: Update, data: dict) -> None:
+        address = self.address(update)
+        data[ADDRESS_KEY] = address
+        if address is None or not isinstance(self.storage, MongoStorage):
+            return
+
+        self.storage.begin_snapshot()
+        chat, user = address
+        # the state at the start of the update, later reads of the document come from memory
+        await self.storage.load_snapshot(chat=chat, user=user)
+
+    async def on_post_process_update(self, update: Update, results: List[Any], data: dict) -> None:
+        address = data.get(ADDRESS_KEY)
+        try:
+            if address is not None:
+                await self.switch(address, results)
+        finally:
+            if address is not None and isinstance(self.storage, MongoStorage):
+                await self.storage.commit_snapshot()
+
+    async def switch(self, address: Tuple[Optional[int], Optional[int]], results: List[Any]) -> None:
         try:
             handler_results, *_ = results
             last_handler_result = handler_results[-1]
         except (IndexError, ValueError):
-            pass
-        else:
-            if isinstance(last_handler_result, str):
-                user = User.get_current()
-                chat = Chat.get_current()
-                await self.storage.set_state(user=user.id, chat=chat.id, state=last_handler_result)
+            return
+        if not isinstance(last_handler_result, str):
+            return
+
+        chat, user = address
+        # handlers may have switched the state themselves, so it's the current state that counts;
+        # inside a snapshot it is read from memory
+        if await self.storage.get_state(chat=chat, user=user) != last_handler_result:
+            await self.storage.set_state(chat=chat, user=user, state=last_handler_result)
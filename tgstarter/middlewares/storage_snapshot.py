@@ -0,0 +1,35 @@
+from typing import List, Any
+
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.storage import BaseStorage
+from aiogram.types import Update
+
+from tgstarter.storage.mongo_storage import MongoStorage
+from tgstarter.utils import helper
+
+
+class StorageSnapshot(BaseMiddleware):
+    """Loads the document of the update's chat and user once and writes its changes in one update_one
+
+    Only MongoStorage has snapshots; with other storages (e.g. SQLiteStorage, which already commits
+    its writes in batches) the middleware does nothing.
+    """
+
+    def __init__(self, storage: BaseStorage) -> None:
+        super(StorageSnapshot, self).__init__()
+        self.storage = storage
+
+    async def on_pre_process_update(self, update: Update, data: dict):
+        if not isinstance(self.storage, MongoStorage):
+            return
+        self.storage.begin_snapshot()
+        chat, user = helper.update_chat_and_user(update)
+        if chat is not None or user is not None:
+            await self.storage.load_snapshot(
+                chat=chat.id if chat is not None else None,
+                user=user.id if user is not None else None
+            )
+
+    async def on_post_process_update(self, update: Update, results: List[Any], data: dict):
+        if isinstance(self.storage, MongoStorage):
+            await self.storage.commit_snapshot()
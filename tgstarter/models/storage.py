@@ -16,6 +16,29 @@ class LogType(str, NamedEnum):
     TASK = auto()
 
 
+class WriteMode(str, NamedEnum):
+    WRITE_THROUGH = auto()
+    WRITE_BEHIND = auto()
+
+
+class Backpressure(str, NamedEnum):
+    BLOCK = auto()
+    DROP_OLDEST = auto()
+    DROP_DEBUG = auto()
+
+
+class LogCollectionMode(str, NamedEnum):
+    REGULAR = auto()
+    TIME_SERIES = auto()
+    CAPPED = auto()
+
+
+class BroadcastStatus(str, NamedEnum):
+    SENT = auto()
+    BLOCKED = auto()
+    FAILED = auto()
+
+
 class LogLevel(str, NamedEnum):
     DEBUG = auto()
     INFO = auto()
@@ -27,7 +50,10 @@ class LogLevel(str, NamedEnum):
 class ExceptionModel(BaseModel):
     type: str
     value: str
-    traceback: str
+    # a deduplicated traceback is stored once in its own collection under the fingerprint
+    traceback: Optional[str]
+    fingerprint: Optional[str]
+    occurrence: Optional[int]
 
 
 class LogUserInfo(BaseModel):
@@ -61,3 +87,27 @@ class Log(BaseModel):
     task: Optional[Dict[str, Any]]
 
     exception: Optional[ExceptionModel]
+
+
+class QueryPlan(BaseModel):
+    collection: str
+    query: str
+    filter: Dict[str, Any]
+    stages: List[str]
+    index_names: List[str]
+
+    @property
+    def uses_index(self) -> bool:
+        return 'COLLSCAN' not in self.stages and bool(self.index_names)
+
+    @property
+    def covered(self) -> bool:
+        return self.uses_index and 'FETCH' not in self.stages
+
+
+class BroadcastResult(BaseModel):
+    broadcast_id: str
+    sent: int = 0
+    blocked: int = 0
+    failed: int = 0
+    skipped: int = 0
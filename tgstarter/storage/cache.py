@@ -0,0 +1,100 @@
+from typing import (
+    Callable,
+    Generic,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+from collections import OrderedDict
+import time
+
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+
+class LRUCache(Generic[K, V]):
+    def __init__(
+        self,
+        *,
+        max_size: int = 10_000,
+        ttl: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic
+    ) -> None:
+        if max_size < 1:
+            raise ValueError(f'max_size must be positive, got {max_size}')
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries: 'OrderedDict[K, Tuple[Optional[float], V]]' = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        return self._lookup(key) is not None
+
+    def _lookup(self, key: K) -> Optional[Tuple[Optional[float], V]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, _ = entry
+        if expires_at is not None and expires_at <= self.clock():
+            del self._entries[key]
+            self.expirations += 1
+            return None
+
+        return entry
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        _, value = entry
+        return value
+
+    def peek(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        entry = self._lookup(key)
+        if entry is None:
+            return default
+        _, value = entry
+        return value
+
+    def set(self, key: K, value: V) -> None:
+        expires_at = self.clock() + self.ttl if self.ttl is not None else None
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+        _, value = entry
+        return value
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def keys(self) -> List[K]:
+        return list(self._entries)
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
@@ -0,0 +1,241 @@
+from typing import (
+    Any,
+    Optional,
+    Dict,
+    Tuple,
+)
+import abc
+import copy
+import functools
+
+from aiogram.dispatcher.storage import BaseStorage
+
+from tgstarter.storage.updates import Unset, Update, field_update, is_path_key
+from tgstarter.utils.typing import AsyncCallbackVar
+
+
+Address = Tuple[int, int]
+Document = Dict[str, Any]
+
+
+def check_address(*args: Any, **kwargs: Any) -> Any:
+    addresses = BaseStorage.check_address(*args, **kwargs)
+    return tuple(map(int, addresses))
+
+
+def resolve_address(function: AsyncCallbackVar) -> AsyncCallbackVar:
+
+    @functools.wraps(function)
+    async def wrapper(self, *, chat: Optional[int], user: Optional[int], **kwargs) -> Tuple[int, int]:
+        chat, user = check_address(chat=chat, user=user)
+        return await function(self, chat=chat, user=user, **kwargs)
+
+    return wrapper
+
+
+class DocumentStorage(BaseStorage, abc.ABC):
+    """Keeps state, state_data and bucket of every (chat, user) in a single document"""
+
+    def has_bucket(self) -> bool:
+        return True
+
+    @abc.abstractmethod
+    async def _load(self, chat: int, user: int) -> Document:
+        raise NotImplementedError('method _load must be implemented')
+
+    @abc.abstractmethod
+    async def _write(self, chat: int, user: int, update: Update, upsert: bool = True) -> None:
+        raise NotImplementedError('method _write must be implemented')
+
+    def _shares_documents(self) -> bool:
+        return False
+
+    async def _get_field(self, chat: int, user: int, field: str, default: Any) -> Any:
+        document = await self._load(chat=chat, user=user)
+        if field not in document:
+            return default
+        value = document[field]
+        return copy.deepcopy(value) if self._shares_documents() else value
+
+    async def _update_fields(self, chat: int, user: int, field: str, operator: str, values: Dict[str, Any]) -> None:
+        if not values:
+            return
+        invalid_keys = [key for key in values if not is_path_key(key)]
+        if invalid_keys:
+            raise ValueError(f'keys {invalid_keys} of {field} cannot be updated in place')
+
+        update = {
+            operator: {
+                f'{field}.{key}': value
+                for key, value in values.items()
+            }
+        }
+        await self._write(chat=chat, user=user, update=update)
+
+    async def _merge_fields(self, chat: int, user: int, field: str, values: Dict[str, Any]) -> None:
+        if not values:
+            return
+        if all(map(is_path_key, values)):
+            await self._write(chat=chat, user=user, update=field_update(field, values))
+            return
+
+        # keys with dots can't be addressed by path, so the whole sub-document is rewritten
+        current = await self._get_field(chat=chat, user=user, field=field, default=None) or {}
+        for key, value in values.items():
+            if value is Unset:
+                current.pop(key, None)
+            else:
+                current[key] = value
+        await self._write(chat=chat, user=user, update={'$set': {field: current}})
+
+    @resolve_address
+    async def get_state(
+        self,
+        *,
+        chat: Optional[int] = None,
+        user: Optional[int] = None,
+        default: Optional[str] = None
+    ) -> Optional[str]:
+
+        return await self._get_field(chat=chat, user=user, field='state', default=default)
+
+    @resolve_address
+    async def set_state(
+        self,
+        *,
+        chat: Optional[int] = None,
+        user: Optional[int] = None,
+        state: Optional[str] = None
+    ) -> None:
+
+        await self._write(chat=chat, user=user, update={'$set': {'state': state}})
+
+    @resolve_address
+    async def get_data(
+        self,
+        *,
+        chat: Optional[int] = None,
+        user: Optional[int] = None,
+        default: Optional[Dict] = None
+    ) -> Optional[Dict[Any, Any]]:
+
+        return await self._get_field(chat=chat, user=user, field='state_data', default=default)
+
+    @resolve_address
+    async def set_data(
+        self,
+        *,
+        data: Optional[Dict],
+        chat: Optional[int] = None,
+        user: Optional[int] = None
+    ) -> None:
+
+        await self._write(
+            chat=chat,
+            user=user,
+            update={
+                '$set': {
+                    'state_data': data if data is not None else {}
+                }
+            }
+        )
+
+    @resolve_address
+    async def update_data(
+        self,
+        *,
+        chat: Optional[int] = None,
+        user: Optional[int] = None,
+        data: Optional[Dict] = None,
+        **kwargs
+    ) -> None:
+
+        kwargs.update({} if data is None else data)
+        await self._merge_fields(chat=chat, user=user, field='state_data', values=kwargs)
+
+    @resolve_address
+    async def increment_data(self, *, chat: Optional[int] = None, user: Optional[int] = None, **kwargs) -> None:
+        await self._update_fields(chat=chat, user=user, field='state_data', operator='$inc', values=kwargs)
+
+    @resolve_address
+    async def push_data(self, *, chat: Optional[int] = None, user: Optional[int] = None, **kwargs) -> None:
+        await self._update_fields(chat=chat, user=user, field='state_data', operator='$push', values=kwargs)
+
+    @resolve_address
+    async def reset_data(self, *, chat: Optional[int] = None, user: Optional[int] = None) -> None:
+        await self._write(chat=chat, user=user, update={'$set': {'state_data': {}}}, upsert=False)
+
+    # # #
+
+    @resolve_address
+    async def reset_state(
+        self,
+        *,
+        chat: Optional[int] = None,
+        user: Optional[int] = None,
+        with_data: bool = True
+    ) -> None:
+
+        fields: Document = {'state': None}
+        if with_data:
+            fields['state_data'] = {}
+        await self._write(chat=chat, user=user, update={'$set': fields}, upsert=False)
+
+    @resolve_address
+    async def finish(self, *, chat: Optional[int] = None, user: Optional[int] = None) -> None:
+        await self.reset_state(chat=chat, user=user, with_data=True)
+
+    @resolve_address
+    async def get_bucket(
+        self,
+        *,
+        chat: Optional[int] = None,
+        user: Optional[int] = None,
+        default: Optional[Dict] = None
+    ) -> Optional[Dict]:
+
+        return await self._get_field(chat=chat, user=user, field='bucket', default=default)
+
+    @resolve_address
+    async def set_bucket(
+        self,
+        *,
+        chat: Optional[int] = None,
+        user: Optional[int] = None,
+        bucket: Optional[Dict] = None
+    ) -> None:
+
+        await self._write(
+            chat=chat,
+            user=user,
+            update={
+                '$set': {
+                    'bucket': bucket if bucket is not None else {}
+                }
+            }
+        )
+
+    @resolve_address
+    async def update_bucket(
+        self,
+        *,
+        chat: Optional[int] = None,
+        user: Optional[int] = None,
+        bucket: Optional[Dict] = None,
+        **kwargs
+    ) -> None:
+
+        kwargs.update({} if bucket is None else bucket)
+        await self._merge_fields(chat=chat, user=user, field='bucket', values=kwargs)
+
+    @resolve_address
+    async def increment_bucket(self, *, chat: Optional[int] = None, user: Optional[int] = None, **kwargs) -> None:
+        await self._update_fields(chat=chat, user=user, field='bucket', operator='$inc', values=kwargs)
+
+    @resolve_address
+    async def push_bucket(self, *, chat: Optional[int] = None, user: Optional[int] = None, **kwargs) -> None:
+        await self._update_fields(chat=chat, user=user, field='bucket', operator='$push', values=kwargs)
+
+    @resolve_address
+    async def reset_bucket(self, *, chat: Optional[int] = None, user: Optional[int] = None) -> None:
+        await self._write(chat=chat, user=user, update={'$set': {'bucket': {}}}, upsert=False)
@@ -0,0 +1,179 @@
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Union,
+)
+import asyncio
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import BulkWriteError
+
+from tgstarter.models.storage import Backpressure, LogLevel
+from tgstarter.storage.log_spool import DUPLICATE_KEY, LogSpool
+
+
+Document = Dict[str, Any]
+
+
+def is_debug(document: Document) -> bool:
+    return document.get('level') == LogLevel.DEBUG.value
+
+
+class LogBuffer:
+    def __init__(
+        self,
+        collection: Union[AsyncIOMotorCollection, LogSpool],
+        *,
+        max_size: int = 10_000,
+        batch_size: int = 500,
+        interval: float = 1.0,
+        backpressure: Backpressure = Backpressure.BLOCK,
+        max_retries: int = 3,
+        retry_interval: float = 0.5
+    ) -> None:
+        self.collection = collection
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.backpressure = backpressure
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+
+        self.inserted = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_error: Optional[BaseException] = None
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._batch_ready: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Future] = None
+        self._draining = 0
+        # debug documents in the queue, so DROP_DEBUG only looks for one when there is one
+        self._queued_debug = 0
+
+    def __len__(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _start(self) -> asyncio.Queue:
+        # the queue is bound to the running loop, so it's created on first use
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_size)
+            self._batch_ready = asyncio.Event()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.ensure_future(self._run())
+        return self._queue
+
+    async def put(self, document: Document) -> bool:
+        """Returns False if the document was dropped because the buffer is full;
+        documents dropped to make room for it are only counted in `dropped`
+        """
+        queue = self._start()
+        if queue.full():
+            if self.backpressure == Backpressure.DROP_OLDEST:
+                self._taken(queue.get_nowait())
+                queue.task_done()
+                self.dropped += 1
+            elif self.backpressure == Backpressure.DROP_DEBUG:
+                if is_debug(document):
+                    self.dropped += 1
+                    return False
+                # a queued debug document makes room, otherwise the put waits like BLOCK
+                if self._queued_debug:
+                    self._evict_debug(queue)
+                    self.dropped += 1
+
+        await queue.put(document)
+        if is_debug(document):
+            self._queued_debug += 1
+        if queue.qsize() >= self.batch_size:
+            assert self._batch_ready is not None
+            self._batch_ready.set()
+        return True
+
+    def _taken(self, document: Document) -> Document:
+        if is_debug(document):
+            self._queued_debug -= 1
+        return document
+
+    def _evict_debug(self, queue: asyncio.Queue) -> None:
+        """Removes the oldest queued debug document, the others keep their order"""
+        documents = [queue.get_nowait() for _ in range(queue.qsize())]
+        for _ in documents:
+            queue.task_done()
+        evicted = next(index for index, document in enumerate(documents) if is_debug(document))
+        self._taken(documents.pop(evicted))
+        for document in documents:
+            queue.put_nowait(document)
+
+    async def _run(self) -> None:
+        assert self._queue is not None and self._batch_ready is not None
+        queue, batch_ready = self._queue, self._batch_ready
+        while True:
+            batch = [self._taken(await queue.get())]
+            if not self._draining and queue.qsize() < self.batch_size - 1:
+                batch_ready.clear()
+                try:
+                    await asyncio.wait_for(batch_ready.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(self._taken(queue.get_nowait()))
+            try:
+                await self._insert(batch)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def _insert(self, batch: List[Document]) -> None:
+        """Retries what wasn't inserted with backoff; while it does, the queue fills up and backpressure applies"""
+        delay = self.retry_interval
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(delay)
+                delay *= 2
+            try:
+                await self.collection.insert_many(batch, ordered=False)
+            except BulkWriteError as error:
+                self.last_error = error
+                # documents carry their _id, so a duplicate was inserted by an earlier attempt
+                failed = {
+                    write_error['index']
+                    for write_error in error.details['writeErrors']
+                    if write_error['code'] != DUPLICATE_KEY
+                }
+                self.inserted += len(batch) - len(failed)
+                batch = [document for index, document in enumerate(batch) if index in failed]
+                if not batch:
+                    return
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                self.last_error = error
+            else:
+                self.inserted += len(batch)
+                return
+        self.failed += len(batch)
+
+    async def flush(self) -> None:
+        if self._queue is None:
+            return
+        assert self._batch_ready is not None
+        self._draining += 1
+        self._batch_ready.set()
+        try:
+            await self._queue.join()
+        finally:
+            self._draining -= 1
+
+    async def close(self) -> None:
+        await self.flush()
+        if self._worker is not None:
+            self._worker.cancel()
+
+    async def wait_closed(self) -> None:
+        if self._worker is not None:
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
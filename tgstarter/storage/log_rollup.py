@@ -0,0 +1,137 @@
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+import asyncio
+import datetime
+
+import pymongo
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+
+RollupKey = Tuple[datetime.datetime, str, str, str]
+ROLLUP_FIELDS = ('minute', 'level', 'type', 'came_from')
+
+
+def truncate_to_minute(date_time: datetime.datetime) -> datetime.datetime:
+    return date_time.replace(second=0, microsecond=0)
+
+
+class LogRollup:
+    """Per-minute log counters by level, type and came_from, flushed to Mongo with $inc upserts"""
+
+    def __init__(
+        self,
+        collection: AsyncIOMotorCollection,
+        *,
+        interval: float = 60.0,
+        max_retry_interval: float = 300.0,
+        expire_after: Optional[datetime.timedelta] = None
+    ) -> None:
+        self.collection = collection
+        self.interval = interval
+        self.max_retry_interval = max_retry_interval
+        self.expire_after = expire_after
+
+        self.failed_flushes = 0
+        self.last_error: Optional[BaseException] = None
+
+        self._counters: Dict[RollupKey, int] = {}
+        self._flusher: Optional[asyncio.Future] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    def __len__(self) -> int:
+        return len(self._counters)
+
+    def _get_lock(self) -> asyncio.Lock:
+        # the lock is bound to the running loop on Python < 3.10, so it's created on first use
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def add(self, date_time: datetime.datetime, level: str, type: str, came_from: str) -> None:
+        key = (truncate_to_minute(date_time), level, type, came_from)
+        self._counters[key] = self._counters.get(key, 0) + 1
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush_later())
+
+    async def ensure_indexes(self) -> List[str]:
+        indexes = [
+            await self.collection.create_index(
+                [(field, pymongo.ASCENDING) for field in ROLLUP_FIELDS],
+                unique=True
+            ),
+        ]
+        if self.expire_after is not None:
+            indexes.append(
+                await self.collection.create_index(
+                    [('expire_at', pymongo.ASCENDING)],
+                    expireAfterSeconds=0
+                )
+            )
+        return indexes
+
+    async def _flush_later(self) -> None:
+        # flush puts the counters of a failed write back, they are retried with backoff
+        # rather than waiting for the next add()
+        delay = self.interval
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.flush()
+                return
+            except PyMongoError as error:
+                self.failed_flushes += 1
+                self.last_error = error
+                delay = min(delay * 2, self.max_retry_interval)
+
+    async def flush(self) -> None:
+        async with self._get_lock():
+            counters, self._counters = self._counters, {}
+            if not counters:
+                return
+
+            requests = []
+            for key, count in counters.items():
+                update: Dict[str, Any] = {'$inc': {'count': count}}
+                if self.expire_after is not None:
+                    update['$setOnInsert'] = {'expire_at': key[0] + self.expire_after}
+                requests.append(UpdateOne(dict(zip(ROLLUP_FIELDS, key)), update, upsert=True))
+            try:
+                await self.collection.bulk_write(requests, ordered=False)
+            except BaseException:
+                # counted again on the next flush; a partially applied batch may count some twice
+                for key, count in counters.items():
+                    self._counters[key] = self._counters.get(key, 0) + count
+                raise
+
+    async def counts(
+        self,
+        since: datetime.datetime,
+        until: Optional[datetime.datetime] = None,
+        **match: str
+    ) -> List[Dict[str, Any]]:
+
+        minute: Dict[str, datetime.datetime] = {'$gte': truncate_to_minute(since)}
+        if until is not None:
+            minute['$lt'] = until
+        cursor = self.collection.find(
+            {'minute': minute, **match},
+            projection={'_id': False, 'expire_at': False}
+        ).sort('minute', pymongo.ASCENDING)
+        return [document async for document in cursor]
+
+    async def close(self) -> None:
+        if self._flusher is not None and not self._get_lock().locked():
+            self._flusher.cancel()
+        await self.flush()
+
+    async def wait_closed(self) -> None:
+        if self._flusher is not None:
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
@@ -0,0 +1,298 @@
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import json
+import os
+import struct
+
+import bson
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
+
+
+Document = Dict[str, Any]
+Offset = Tuple[int, int]
+
+SEGMENT_SUFFIX = '.spool'
+OFFSET_FILE = 'offset.json'
+# documents Mongo keeps refusing, e.g. failing validation, moved aside so the spool goes on
+REJECTED_FILE = 'rejected.bson'
+DUPLICATE_KEY = 11000
+
+
+def segment_name(sequence: int) -> str:
+    return f'{sequence:012d}{SEGMENT_SUFFIX}'
+
+
+def append_data(path: str, data: bytes) -> None:
+    with open(path, 'ab') as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def save_offset(directory: str, offset: Offset) -> None:
+    path = os.path.join(directory, OFFSET_FILE)
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w') as file:
+        json.dump({'segment': offset[0], 'position': offset[1]}, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+def read_documents(path: str, position: int, limit: int) -> Tuple[List[Document], int]:
+    """Reads up to `limit` complete documents, a document cut short by a crash is left for later"""
+    documents: List[Document] = []
+    with open(path, 'rb') as file:
+        file.seek(position)
+        while len(documents) < limit:
+            header = file.read(4)
+            if len(header) < 4:
+                break
+            size, = struct.unpack('<i', header)
+            body = file.read(size - 4)
+            if len(body) < size - 4:
+                break
+            documents.append(bson.decode(header + body))
+            position += size
+    return documents, position
+
+
+class LogSpool:
+    """Inserts log documents into Mongo, or appends them to local segment files when Mongo is slow or down
+
+    Spooled documents are replayed in order by a background task; documents keep their
+    client-side _id, so a replayed document that did reach Mongo is skipped as a duplicate.
+    Documents Mongo refuses `max_attempts` times in a row are appended to REJECTED_FILE instead.
+    File I/O runs on a single thread of its own, in the order it was issued, so fsync never blocks the loop.
+    """
+
+    def __init__(
+        self,
+        collection: AsyncIOMotorCollection,
+        directory: str,
+        *,
+        latency_budget: float = 0.2,
+        segment_size: int = 16 * 2 ** 20,
+        max_size: int = 256 * 2 ** 20,
+        batch_size: int = 500,
+        replay_interval: float = 1.0,
+        max_attempts: int = 5
+    ) -> None:
+        self.collection = collection
+        self.directory = directory
+        self.latency_budget = latency_budget
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.replay_interval = replay_interval
+        self.max_attempts = max_attempts
+
+        self.spooled = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.last_error: Optional[BaseException] = None
+
+        os.makedirs(directory, exist_ok=True)
+        self._segments = sorted(
+            int(name[:-len(SEGMENT_SUFFIX)])
+            for name in os.listdir(directory)
+            if name.endswith(SEGMENT_SUFFIX)
+        )
+        self._offset = self._load_offset()
+        # sizes include appends that are issued but not on disk yet
+        self._segment_sizes = {sequence: os.path.getsize(self._path(sequence)) for sequence in self._segments}
+        self._size = sum(self._segment_sizes.values())
+        if self._segments:
+            self._truncate_partial(self._segments[-1])
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tgstarter-spool')
+        self._replayer: Optional[asyncio.Future] = None
+        # replays of the batch at the offset that Mongo refused
+        self._attempts = 0
+        self._lock: Optional[asyncio.Lock] = None
+
+    def __len__(self) -> int:
+        """Bytes waiting on disk"""
+        return self._size - self._offset[1] if self._segments else 0
+
+    def _get_lock(self) -> asyncio.Lock:
+        # the lock is bound to the running loop on Python < 3.10, so it's created on first use
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._segments) and not (
+            len(self._segments) == 1 and self._offset == (self._segments[0], self._segment_size(self._segments[0]))
+        )
+
+    def _path(self, sequence: int) -> str:
+        return os.path.join(self.directory, segment_name(sequence))
+
+    def _segment_size(self, sequence: int) -> int:
+        return self._segment_sizes[sequence]
+
+    async def _run(self, function: Any, *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def _load_offset(self) -> Offset:
+        try:
+            with open(os.path.join(self.directory, OFFSET_FILE)) as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return (self._segments[0], 0) if self._segments else (0, 0)
+        offset = (data['segment'], data['position'])
+        if self._segments and offset[0] < self._segments[0]:
+            return self._segments[0], 0
+        return offset
+
+    async def _save_offset(self) -> None:
+        await self._run(save_offset, self.directory, self._offset)
+
+    def _truncate_partial(self, sequence: int) -> None:
+        path = self._path(sequence)
+        position = self._offset[1] if self._offset[0] == sequence else 0
+        while True:
+            documents, position = read_documents(path, position, self.batch_size)
+            if not documents:
+                break
+        size = self._segment_size(sequence)
+        if position < size:
+            with open(path, 'r+b') as file:
+                file.truncate(position)
+            self._size -= size - position
+            self._segment_sizes[sequence] = position
+
+    async def _append(self, documents: List[Document]) -> None:
+        data = b''.join(bson.encode(document) for document in documents)
+        if self._size + len(data) > self.max_size:
+            self.dropped += len(documents)
+            return
+
+        if not self._segments or self._segment_size(self._segments[-1]) >= self.segment_size:
+            self._segments.append(self._segments[-1] + 1 if self._segments else self._offset[0])
+            self._segment_sizes[self._segments[-1]] = 0
+        # accounted for before the write, so documents inserted meanwhile queue up behind these
+        sequence = self._segments[-1]
+        self._segment_sizes[sequence] += len(data)
+        self._size += len(data)
+        self.spooled += len(documents)
+        await self._run(append_data, self._path(sequence), data)
+
+    async def insert_many(self, documents: List[Document], ordered: bool = False) -> None:
+        # while anything is spooled new documents queue up behind it to keep the order
+        if not self.pending:
+            try:
+                await asyncio.wait_for(self._insert(documents), timeout=self.latency_budget)
+                return
+            except (asyncio.TimeoutError, PyMongoError) as error:
+                self.last_error = error
+
+        await self._append(documents)
+        self._start()
+
+    async def _insert(self, documents: List[Document]) -> None:
+        try:
+            await self.collection.insert_many(documents, ordered=False)
+        except DuplicateKeyError:
+            pass
+        except BulkWriteError as error:
+            if any(write_error['code'] != DUPLICATE_KEY for write_error in error.details['writeErrors']):
+                raise
+
+    def _start(self) -> None:
+        if self._replayer is None or self._replayer.done():
+            self._replayer = asyncio.ensure_future(self._replay_later())
+
+    async def _replay_later(self) -> None:
+        while self.pending:
+            await asyncio.sleep(self.replay_interval)
+            try:
+                await self.replay()
+            except PyMongoError as error:
+                self.last_error = error
+
+    async def replay(self) -> int:
+        """Inserts spooled documents in order, returns how many were replayed"""
+        replayed = 0
+        async with self._get_lock():
+            while self.pending:
+                sequence, position = self._offset
+                # behind every append issued so far on the I/O thread
+                documents, end = await self._run(read_documents, self._path(sequence), position, self.batch_size)
+                if documents:
+                    rejected = await self._replay_batch(documents)
+                    replayed += len(documents) - rejected
+                    self.replayed += len(documents) - rejected
+                    self._offset = (sequence, end)
+                elif sequence != self._segments[-1]:
+                    path = self._drop_segment(sequence)
+                    self._offset = (self._segments[0], 0)
+                    await self._run(os.remove, path)
+                else:
+                    break
+                await self._save_offset()
+
+            if self._segments and not self.pending:
+                # everything was replayed, the next spooled document starts a new segment;
+                # the offset moves on before anything is awaited, so an append meanwhile already does
+                path = self._drop_segment(self._segments[-1])
+                self._offset = (self._offset[0] + 1, 0)
+                await self._run(os.remove, path)
+                await self._save_offset()
+        return replayed
+
+    async def _replay_batch(self, documents: List[Document]) -> int:
+        """Inserts the batch, returns how many of its documents were moved aside"""
+        try:
+            await self._insert(documents)
+        except BulkWriteError as error:
+            self.last_error = error
+            self._attempts += 1
+            if self._attempts < self.max_attempts:
+                raise
+            # the insert is unordered, so everything but the refused documents is in already
+            rejected = [
+                documents[write_error['index']]
+                for write_error in error.details['writeErrors']
+                if write_error['code'] != DUPLICATE_KEY
+            ]
+            data = b''.join(bson.encode(document) for document in rejected)
+            await self._run(append_data, os.path.join(self.directory, REJECTED_FILE), data)
+            self.rejected += len(rejected)
+            self._attempts = 0
+            return len(rejected)
+        self._attempts = 0
+        return 0
+
+    def _drop_segment(self, sequence: int) -> str:
+        """Forgets the segment, returns the path of its file to remove"""
+        self._size -= self._segment_sizes.pop(sequence)
+        self._segments.remove(sequence)
+        return self._path(sequence)
+
+    def start(self) -> None:
+        """Starts replaying documents spooled by a previous run"""
+        if self.pending:
+            self._start()
+
+    async def close(self) -> None:
+        if self._replayer is not None:
+            self._replayer.cancel()
+
+    async def wait_closed(self) -> None:
+        if self._replayer is not None:
+            await asyncio.gather(self._replayer, return_exceptions=True)
+            self._replayer = None
+        await asyncio.get_running_loop().run_in_executor(None, functools.partial(self._executor.shutdown, wait=True))
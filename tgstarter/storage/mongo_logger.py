@@ -3,22 +3,35 @@ from typing import (
     Callable,
     Optional,
     Dict,
+    List,
     Tuple,
     Union,
     Any,
     Mapping,
     Sequence,
 )
+import asyncio
 import datetime
+import hashlib
+import os
+import random
 import traceback
 
+import pymongo
 import pytz
+from pymongo.errors import PyMongoError
 from aiogram import types
 from bson.objectid import ObjectId
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase, AsyncIOMotorCollection
 import jinja2
 
 from tgstarter.models import storage as models
+from tgstarter.storage.cache import LRUCache
+from tgstarter.storage.log_buffer import LogBuffer
+from tgstarter.storage.log_rollup import LogRollup
+from tgstarter.storage.log_spool import LogSpool
+from tgstarter.storage.query_plan import explain_query, unindexed
+from tgstarter.utils import helper
 from tgstarter.utils.typing import ExcInfo
 
 
@@ -30,6 +43,27 @@ def filter_parameters(params: Mapping[str, Any], ignore: Sequence[str]) -> Dict[
     }
 
 
+LEVEL_ORDER = {level: index for index, level in enumerate(models.LogLevel)}
+
+
+def chat_sampled(chat_id: int, rate: float) -> bool:
+    # Knuth's multiplicative hash: the same chat gets the same decision in every process
+    return (chat_id * 2654435761) % 2 ** 32 < rate * 2 ** 32
+
+
+def exception_fingerprint(exception: traceback.TracebackException) -> str:
+    """Hash of the exception types and frames; messages and line numbers are left out, so they can change"""
+    digest = hashlib.sha1()
+    chained: Optional[traceback.TracebackException] = exception
+    while chained is not None:
+        digest.update(f'{chained.exc_type.__module__}.{chained.exc_type.__qualname__}\n'.encode())
+        for frame in chained.stack:
+            path = os.path.normpath(frame.filename).split(os.sep)
+            digest.update(f'{"/".join(path[-2:])}:{frame.name}:{(frame.line or "").strip()}\n'.encode())
+        chained = chained.__cause__ or chained.__context__
+    return digest.hexdigest()
+
+
 def get_level_logger(level: models.LogLevel) -> Callable[..., Awaitable]:
     async def appropriate_logger(
         self,
@@ -62,17 +96,209 @@ class MongoLogger:
         timezone: pytz.tzinfo.DstTzInfo,
         collection_name: str = 'logs',
         default_level: models.LogLevel = models.LogLevel.INFO,
-        default_type: models.LogType = models.LogType.EVENT
+        default_type: models.LogType = models.LogType.EVENT,
+        buffered: bool = False,
+        buffer_max_size: int = 10_000,
+        buffer_batch_size: int = 500,
+        buffer_interval: float = 1.0,
+        backpressure: models.Backpressure = models.Backpressure.BLOCK,
+        buffer_max_retries: int = 3,
+        validate: bool = True,
+        min_level: models.LogLevel = models.LogLevel.DEBUG,
+        level_sample_rates: Optional[Mapping[models.LogLevel, float]] = None,
+        type_sample_rates: Optional[Mapping[models.LogType, float]] = None,
+        chat_sample_rate: Optional[float] = None,
+        spool_directory: Optional[str] = None,
+        spool_latency_budget: float = 0.2,
+        spool_max_size: int = 256 * 2 ** 20,
+        deduplicate_tracebacks: bool = False,
+        tracebacks_collection_name: str = 'tracebacks',
+        tracebacks_cache_size: int = 10_000,
+        collection_mode: models.LogCollectionMode = models.LogCollectionMode.REGULAR,
+        capped_size: int = 512 * 2 ** 20,
+        capped_max: Optional[int] = None,
+        expire_after: Optional[datetime.timedelta] = None,
+        rollup: bool = False,
+        rollup_interval: float = 60.0,
+        rollup_collection_name: str = 'logs_rollup',
+        rollup_expire_after: Optional[datetime.timedelta] = None
     ) -> None:
         self.client = mongo_client
         self.database = mongo_database
         self.collection_name = collection_name
         self.logs: AsyncIOMotorCollection = self.database[collection_name]
+        self.tracebacks: Optional[AsyncIOMotorCollection] = None
+        if deduplicate_tracebacks:
+            self.tracebacks = self.database[tracebacks_collection_name]
+        # fingerprints known to be stored with their text, the least recently seen are forgotten
+        self._stored_fingerprints: LRUCache[str, bool] = LRUCache(max_size=tracebacks_cache_size)
+
+        self.collection_mode = collection_mode
+        self.capped_size = capped_size
+        self.capped_max = capped_max
+        self.expire_after = expire_after
+
+        self.rollup: Optional[LogRollup] = None
+        if rollup:
+            self.rollup = LogRollup(
+                self.database[rollup_collection_name],
+                interval=rollup_interval,
+                expire_after=rollup_expire_after
+            )
 
         self.message_format = message_format
         self.timezone = timezone
         self.default_level = default_level
         self.default_type = default_type
+        # pydantic validation of every document is only worth it while developing
+        self.validate = validate
+
+        self.min_level = min_level
+        self.level_sample_rates = dict(level_sample_rates or {})
+        self.type_sample_rates = dict(type_sample_rates or {})
+        self.chat_sample_rate = chat_sample_rate
+        self.suppressed = 0
+
+        self.spool: Optional[LogSpool] = None
+        if spool_directory is not None:
+            self.spool = LogSpool(
+                self.logs,
+                spool_directory,
+                latency_budget=spool_latency_budget,
+                max_size=spool_max_size
+            )
+
+        self._started = False
+
+        self.buffer: Optional[LogBuffer] = None
+        if buffered:
+            self.buffer = LogBuffer(
+                self.spool if self.spool is not None else self.logs,
+                max_size=buffer_max_size,
+                batch_size=buffer_batch_size,
+                interval=buffer_interval,
+                backpressure=backpressure,
+                max_retries=buffer_max_retries
+            )
+
+    def should_log(
+        self,
+        level: models.LogLevel,
+        type: models.LogType,
+        update: Optional[types.Update]
+    ) -> bool:
+
+        if LEVEL_ORDER[level] < LEVEL_ORDER[self.min_level]:
+            return False
+
+        rate = self.level_sample_rates.get(level, 1.0) * self.type_sample_rates.get(type, 1.0)
+        if rate < 1.0 and random.random() >= rate:
+            return False
+
+        if self.chat_sample_rate is not None and update is not None:
+            chat, user = helper.update_chat_and_user(update)
+            address = chat or user
+            if address is not None and not chat_sampled(address.id, self.chat_sample_rate):
+                return False
+        return True
+
+    @property
+    def dropped(self) -> int:
+        """Documents lost to backpressure or to a full spool"""
+        dropped = self.buffer.dropped if self.buffer is not None else 0
+        if self.spool is not None:
+            dropped += self.spool.dropped
+        return dropped
+
+    def start(self) -> None:
+        """Starts replaying logs spooled by a previous run; called by the first log() otherwise"""
+        self._started = True
+        if self.spool is not None:
+            self.spool.start()
+
+    async def flush(self) -> None:
+        if self.buffer is not None:
+            await self.buffer.flush()
+        if self.rollup is not None:
+            await self.rollup.flush()
+
+    async def close(self) -> None:
+        if self.buffer is not None:
+            await self.buffer.close()
+        if self.spool is not None:
+            await self.spool.close()
+        if self.rollup is not None:
+            await self.rollup.close()
+
+    async def wait_closed(self) -> None:
+        if self.buffer is not None:
+            await self.buffer.wait_closed()
+        if self.spool is not None:
+            await self.spool.wait_closed()
+        if self.rollup is not None:
+            await self.rollup.wait_closed()
+
+    async def create_collection(self) -> bool:
+        """Creates the logs collection in the configured mode, returns False if it already exists"""
+        if self.collection_name in await self.database.list_collection_names():
+            return False
+
+        options: Dict[str, Any] = {}
+        if self.collection_mode == models.LogCollectionMode.TIME_SERIES:
+            options['timeseries'] = {
+                'timeField': 'datetime',
+                'metaField': 'meta',
+                'granularity': 'seconds',
+            }
+            if self.expire_after is not None:
+                options['expireAfterSeconds'] = int(self.expire_after.total_seconds())
+        elif self.collection_mode == models.LogCollectionMode.CAPPED:
+            options['capped'] = True
+            options['size'] = self.capped_size
+            if self.capped_max is not None:
+                options['max'] = self.capped_max
+
+        await self.database.create_collection(self.collection_name, **options)
+        return True
+
+    async def ensure_indexes(self) -> List[str]:
+        indexes = [
+            await self.logs.create_index([('datetime', pymongo.DESCENDING)]),
+            await self.logs.create_index(
+                [
+                    ('level', pymongo.ASCENDING),
+                    ('datetime', pymongo.DESCENDING),
+                ]
+            ),
+        ]
+        if self.rollup is not None:
+            indexes.extend(await self.rollup.ensure_indexes())
+        return indexes
+
+    async def explain_queries(self) -> List[models.QueryPlan]:
+        since = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        return [
+            await explain_query(
+                self.logs,
+                query='latest',
+                filter={},
+                sort=[('datetime', pymongo.DESCENDING)]
+            ),
+            await explain_query(
+                self.logs,
+                query='since',
+                filter={'datetime': {'$gte': since}}
+            ),
+            await explain_query(
+                self.logs,
+                query='latest_by_level',
+                filter={'level': models.LogLevel.ERROR.value},
+                sort=[('datetime', pymongo.DESCENDING)]
+            ),
+        ]
+
+    async def audit_queries(self) -> List[models.QueryPlan]:
+        return unindexed(await self.explain_queries())
 
     def render_message(
         self,
@@ -99,11 +325,64 @@ class MongoLogger:
         else:
             type_, value, tb = exc_info
             tb = traceback.TracebackException(type_, value, tb)
-            return {
+            exception = {
                 'type': type_.__name__,
                 'value': str(value),
                 'traceback': ''.join(tb.format()),
             }
+            if self.tracebacks is not None:
+                exception['fingerprint'] = exception_fingerprint(tb)
+            return exception
+
+    async def store_traceback(self, exception: Dict[str, Any], date_time: datetime.datetime) -> Dict[str, Any]:
+        """Stores the traceback once per fingerprint, returns what the log document keeps of the exception
+
+        The log document references the occurrence count, so this is a round trip to Mongo of its own
+        on every logged exception, bounded by the spool's latency budget, even when the logs are buffered.
+        """
+        assert self.tracebacks is not None
+        fingerprint = exception['fingerprint']
+        update: Dict[str, Any] = {
+            '$set': {'last_seen': date_time},
+            '$inc': {'count': 1},
+        }
+        text = {
+            'type': exception['type'],
+            'traceback': exception['traceback'],
+            'first_seen': date_time,
+        }
+        if fingerprint not in self._stored_fingerprints:
+            update['$setOnInsert'] = text
+
+        budget = self.spool.latency_budget if self.spool is not None else None
+        try:
+            stored = await asyncio.wait_for(
+                self.tracebacks.find_one_and_update(
+                    {'_id': fingerprint},
+                    update,
+                    projection={'count': True, 'first_seen': True},
+                    upsert=True,
+                    return_document=pymongo.ReturnDocument.AFTER
+                ),
+                timeout=budget
+            )
+            if 'first_seen' not in stored:
+                # the stored traceback expired or was deleted, so the upsert recreated it without the text
+                await asyncio.wait_for(
+                    self.tracebacks.update_one({'_id': fingerprint}, {'$set': text}),
+                    timeout=budget
+                )
+        except (asyncio.TimeoutError, PyMongoError):
+            # the log keeps the whole traceback rather than referencing one that may not exist
+            return exception
+
+        self._stored_fingerprints.set(fingerprint, True)
+        return {
+            'type': exception['type'],
+            'value': exception['value'],
+            'fingerprint': fingerprint,
+            'occurrence': stored['count'],
+        }
 
     def prepare_task(self, task: Optional[models.LogTask]) -> Optional[models.LogTask]:
         # TODO: make serialization deeper
@@ -117,50 +396,56 @@ class MongoLogger:
             }
         return task
 
-    def chat_and_user_from_update(self, update: Optional[types.Message]) -> Tuple[types.Chat, types.User]:
-        chat = types.Chat()
-        user = types.User()
+    def chat_and_user_from_update(self, update: Optional[types.Update]) -> Tuple[types.Chat, types.User]:
         if update is None:
-            return chat, user
-
-        if update.message:
-            user = update.message.from_user
-            chat = update.message.chat
-
-        elif update.edited_message:
-            user = update.edited_message.from_user
-            chat = update.edited_message.chat
-
-        elif update.channel_post:
-            chat = update.channel_post.chat
-
-        elif update.edited_channel_post:
-            chat = update.edited_channel_post.chat
-
-        elif update.inline_query:
-            user = update.inline_query.from_user
-
-        elif update.chosen_inline_result:
-            user = update.chosen_inline_result.from_user
+            return types.Chat(), types.User()
+        chat, user = helper.update_chat_and_user(update)
+        return chat or types.Chat(), user or types.User()
 
-        elif update.callback_query:
-            if update.callback_query.message:
-                chat = update.callback_query.message.chat
-            user = update.callback_query.from_user
-
-        elif update.shipping_query:
-            user = update.shipping_query.from_user
-
-        elif update.pre_checkout_query:
-            user = update.pre_checkout_query.from_user
-
-        elif update.poll:
-            pass
+    def build_document(
+        self,
+        *,
+        date_time: datetime.datetime,
+        level: models.LogLevel,
+        type: models.LogType,
+        from_bot: bool,
+        update: Optional[types.Update],
+        task: Optional[models.LogTask],
+        exception: Optional[Dict[str, Any]]
+    ) -> Dict[str, Any]:
 
-        elif update.poll_answer:
-            pass
+        if self.validate:
+            chat, user = self.chat_and_user_from_update(update=update)
+            return models.Log(
+                datetime=date_time,
+                level=level.value,
+                type=type.value,
+                came_from=models.EventFrom.USER if not from_bot else models.EventFrom.BOT,
+                user_info=models.LogUserInfo(
+                    user=user.to_python(),
+                    chat=chat.to_python()
+                ),
+                update=update.to_python() if update is not None else None,
+                task=task,
+                exception=exception
+            ).dict(exclude_unset=True)
 
-        return chat, user
+        # the update is exported once and chat and user are taken out of the exported dict
+        update_data = update.to_python() if update is not None else None
+        chat_data, user_data = helper.python_update_chat_and_user(update_data) if update_data else (None, None)
+        return {
+            'datetime': date_time,
+            'level': level.value,
+            'type': type.value,
+            'came_from': models.EventFrom.BOT.value if from_bot else models.EventFrom.USER.value,
+            'user_info': {
+                'chat': chat_data or {},
+                'user': user_data or {},
+            },
+            'update': update_data,
+            'task': task.dict() if task is not None else None,
+            'exception': exception,
+        }
 
     async def log(
         self,
@@ -171,30 +456,55 @@ class MongoLogger:
         from_bot: bool = False,
         exc_info: Optional[ExcInfo] = None
     ) -> Optional[str]:
+        """Returns None without touching the arguments if the log is filtered out or sampled away"""
+        if not self._started:
+            self.start()
+        level = level or self.default_level
+        type = type or self.default_type
+        if self.rollup is not None:
+            # counted before filtering, so the counters show real rates even when logs are sampled
+            self.rollup.add(
+                date_time=datetime.datetime.utcnow(),
+                level=level.value,
+                type=type.value,
+                came_from=models.EventFrom.BOT.value if from_bot else models.EventFrom.USER.value
+            )
+        if not self.should_log(level=level, type=type, update=update):
+            self.suppressed += 1
+            return None
 
         date_time = datetime.datetime.utcnow()
-        chat, user = self.chat_and_user_from_update(update=update)
         task = self.prepare_task(task)
         exception = self.prepare_exception(exc_info) if exc_info is not None else None
-        model = models.Log(
-            datetime=date_time,
-            level=level.value if level else self.default_level.value,
-            type=type.value if type else self.default_type.value,
-            came_from=models.EventFrom.USER if not from_bot else models.EventFrom.BOT,
-            user_info=models.LogUserInfo(
-                user=user.to_python(),
-                chat=chat.to_python()
-            ),
-            update=update.to_python() if update is not None else None,
+        stored_exception = exception
+        if exception is not None and 'fingerprint' in exception:
+            stored_exception = await self.store_traceback(exception, date_time=date_time)
+
+        document = self.build_document(
+            date_time=date_time,
+            level=level,
+            type=type,
+            from_bot=from_bot,
+            update=update,
             task=task,
-            exception=exception
+            exception=stored_exception
         )
-        document = model.dict()
-        insert_result = await self.logs.insert_one(document)
+        if self.collection_mode == models.LogCollectionMode.TIME_SERIES:
+            document['meta'] = {'level': level.value, 'type': type.value}
+        # the id is known before the document reaches Mongo, so buffered errors can still reference it
+        document['_id'] = object_id = ObjectId()
+        if self.buffer is not None:
+            if not await self.buffer.put(document):
+                return None
+        elif self.spool is not None:
+            await self.spool.insert_many([document])
+        else:
+            await self.logs.insert_one(document)
+
         if exception is not None:
             return self.render_message(
                 utc_datetime=date_time,
-                object_id=insert_result.inserted_id,
+                object_id=object_id,
                 exception=exception
             )
 
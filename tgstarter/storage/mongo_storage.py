@@ -1,43 +1,75 @@
 from typing import (
-    Any,
+    AsyncIterator,
     Optional,
     Dict,
-    Tuple,
+    List,
+    Sequence,
+    Set,
 )
-import functools
+from contextvars import ContextVar
+import asyncio
+import copy
+import datetime
+import heapq
 
 import addict
-from aiogram.dispatcher.storage import BaseStorage
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
-
-from tgstarter.utils.typing import AsyncCallbackVar
-
-
-def check_address(*args: Any, **kwargs: Any) -> Any:
-    addresses = BaseStorage.check_address(*args, **kwargs)
-    return tuple(map(int, addresses))
-
+import pymongo
+from motor.motor_asyncio import (
+    AsyncIOMotorClient,
+    AsyncIOMotorCollection,
+    AsyncIOMotorCursor,
+    AsyncIOMotorDatabase,
+)
 
-def resolve_address(function: AsyncCallbackVar) -> AsyncCallbackVar:
+from tgstarter.models.storage import QueryPlan, WriteMode
+from tgstarter.storage.cache import LRUCache
+from tgstarter.storage.document_storage import (  # noqa: F401
+    Address,
+    Document,
+    DocumentStorage,
+    check_address,
+    resolve_address,
+)
+from tgstarter.storage.query_plan import explain_query, unindexed
+from tgstarter.storage.snapshot import Snapshot, SnapshotScope
+from tgstarter.storage.updates import Update, apply_update, partial_paths
+from tgstarter.storage.write_buffer import WriteBuffer
 
-    @functools.wraps(function)
-    async def wrapper(self, *, chat: Optional[int], user: Optional[int], **kwargs) -> Tuple[int, int]:
-        chat, user = check_address(chat=chat, user=user)
-        return await function(self, chat=chat, user=user, **kwargs)
 
-    return wrapper
+DOCUMENT_PROJECTION = {
+    '_id': False,
+    'state': True,
+    'state_data': True,
+    'bucket': True,
+    'archived': True,
+}
+ARCHIVED_FIELDS = ('state_data', 'bucket')
 
 
 def filter_chat_user(chat: Optional[int], user: Optional[int]) -> Dict[str, Optional[int]]:
     return dict(chat_id=chat, user_id=user)
 
 
-class MongoStorage(BaseStorage):
+async def next_document(cursor: AsyncIOMotorCursor) -> Optional[Document]:
+    async for document in cursor:
+        return document
+    return None
+
+
+class MongoStorage(DocumentStorage):
     def __init__(
         self,
         mongo_client: AsyncIOMotorClient,
         mongo_database: AsyncIOMotorDatabase,
-        collection_name: str = 'users'
+        collection_name: str = 'users',
+        *,
+        cache: Optional[LRUCache[Address, Document]] = None,
+        write_mode: WriteMode = WriteMode.WRITE_THROUGH,
+        write_behind_interval: float = 0.5,
+        write_behind_max_size: int = 1000,
+        expire_after: Optional[datetime.timedelta] = None,
+        archive_after: Optional[datetime.timedelta] = None,
+        archive_suffix: str = '_archive'
     ) -> None:
         self.client = mongo_client
         self.database = mongo_database
@@ -46,198 +78,419 @@ class MongoStorage(BaseStorage):
             dict(users=self.database[collection_name])
         )
 
-    async def close(self) -> None:
-        pass
-
-    async def wait_closed(self) -> None:
-        pass
-
-    def has_bucket(self) -> bool:
-        return True
-
-    @resolve_address
-    async def get_state(
-        self,
-        *,
-        chat: Optional[int] = None,
-        user: Optional[int] = None,
-        default: Optional[str] = None
-    ) -> Optional[str]:
-
-        result = await self.db.users.find_one(
-            filter=filter_chat_user(
-                chat=chat,
-                user=user
-            ),
-            projection={
-                '_id': False,
-                'state': True
-            }
-        )
-        return result['state'] if result else default
-
-    @resolve_address
-    async def set_state(
-        self,
-        *,
-        chat: Optional[int] = None,
-        user: Optional[int] = None,
-        state: Optional[str] = None
-    ) -> None:
-
-        await self.db.users.update_one(
-            filter=filter_chat_user(
-                chat=chat,
-                user=user
-            ),
-            update={
-                '$set': {'state': state}
-            },
-            upsert=True
+        self.cache = cache
+        self.write_mode = write_mode
+        self.expire_after = expire_after
+        self.archive_after = archive_after
+        self.archive_suffix = archive_suffix
+        self.write_buffer: Optional[WriteBuffer] = None
+        if write_mode == WriteMode.WRITE_BEHIND:
+            self.write_buffer = WriteBuffer(
+                lambda address: self.collection_for(*address),
+                max_size=write_behind_max_size,
+                interval=write_behind_interval
+            )
+
+        self._loading: Dict[Address, asyncio.Future] = {}
+        self._stale: Set[Address] = set()
+        self._snapshots: ContextVar[Optional[SnapshotScope]] = ContextVar(
+            f'{type(self).__name__}_snapshots_{id(self)}',
+            default=None
         )
-
-    @resolve_address
-    async def get_data(
-        self,
-        *,
-        chat: Optional[int] = None,
-        user: Optional[int] = None,
-        default: Optional[Dict] = None
-    ) -> Optional[Dict[Any, Any]]:
-
-        result = await self.db.users.find_one(
-            filter=filter_chat_user(
-                chat=chat,
-                user=user
-            ),
-            projection={
-                '_id': False,
-                'state_data': True
-            }
+        # begin_snapshot calls made while a snapshot was already open
+        self._snapshot_depth: ContextVar[int] = ContextVar(
+            f'{type(self).__name__}_snapshot_depth_{id(self)}',
+            default=0
         )
-        return result['state_data'] if result else default
 
-    @resolve_address
-    async def set_data(
-        self,
-        *,
-        data: Optional[Dict],
-        chat: Optional[int] = None,
-        user: Optional[int] = None
-    ) -> None:
-
-        await self.db.users.update_one(
-            filter=filter_chat_user(
-                chat=chat,
-                user=user
-            ),
-            update={
-                '$set': {'state_data': data}
-            },
-            upsert=True
-        )
-
-    update_data = set_data
-
-    @resolve_address
-    async def reset_data(self, *, chat: Optional[int] = None, user: Optional[int] = None) -> None:
-        await self.db.users.update_one(
-            filter=filter_chat_user(
-                chat=chat,
-                user=user
-            ),
-            update={
-                '$set': {
-                    'state_data': {}
-                }
-            }
-        )
-
-    # # #
-
-    @resolve_address
-    async def reset_state(self, *, chat: Optional[int] = None, user: Optional[int] = None) -> None:
-        raise NotImplementedError
-
-    @resolve_address
-    async def finish(self, *, chat: Optional[int] = None, user: Optional[int] = None) -> None:
-        raise NotImplementedError
+    async def close(self) -> None:
+        if self.write_buffer is not None:
+            await self.write_buffer.close()
 
-    @resolve_address
-    async def get_bucket(
-        self,
-        *,
-        chat: Optional[int] = None,
-        user: Optional[int] = None,
-        default: Optional[Dict] = None
-    ) -> Optional[Dict]:
-
-        result = await self.db.users.find_one(
-            filter=filter_chat_user(
-                user=user,
-                chat=chat
-            ),
-            projection={
-                '_id': False,
-                'bucket': True
+    async def wait_closed(self) -> None:
+        if self.write_buffer is not None:
+            await self.write_buffer.wait_closed()
+
+    async def flush(self) -> None:
+        if self.write_buffer is not None:
+            await self.write_buffer.flush()
+
+    def _shares_documents(self) -> bool:
+        return self.cache is not None or self._open_snapshots() is not None
+
+    def _open_snapshots(self) -> Optional[SnapshotScope]:
+        snapshots = self._snapshots.get()
+        return snapshots if snapshots is not None and not snapshots.closed else None
+
+    @property
+    def collections(self) -> List[AsyncIOMotorCollection]:
+        return [self.db.users]
+
+    def collection_for(self, chat: int, user: int) -> AsyncIOMotorCollection:
+        return self.db.users
+
+    def archive_for(self, collection: AsyncIOMotorCollection) -> AsyncIOMotorCollection:
+        return collection.database[f'{collection.name}{self.archive_suffix}']
+
+    async def ensure_indexes(self) -> List[str]:
+        expiration = {}
+        if self.expire_after is not None:
+            expiration['expireAfterSeconds'] = int(self.expire_after.total_seconds())
+
+        indexes = []
+        for collection in self.collections:
+            indexes.append(
+                await collection.create_index(
+                    [
+                        ('chat_id', pymongo.ASCENDING),
+                        ('user_id', pymongo.ASCENDING),
+                    ],
+                    unique=True
+                )
+            )
+            indexes.append(await collection.create_index([('last_seen', pymongo.ASCENDING)], **expiration))
+
+            if self.archive_after is not None:
+                archive = self.archive_for(collection)
+                indexes.append(
+                    await archive.create_index(
+                        [
+                            ('chat_id', pymongo.ASCENDING),
+                            ('user_id', pymongo.ASCENDING),
+                        ],
+                        unique=True
+                    )
+                )
+                indexes.append(await archive.create_index([('last_seen', pymongo.ASCENDING)], **expiration))
+        return indexes
+
+    async def explain_queries(self) -> List[QueryPlan]:
+        return [
+            await explain_query(
+                collection,
+                query='find_document',
+                filter=filter_chat_user(chat=0, user=0),
+                projection=DOCUMENT_PROJECTION
+            )
+            for collection in self.collections
+        ]
+
+    async def audit_queries(self) -> List[QueryPlan]:
+        return unindexed(await self.explain_queries())
+
+    async def _find_document(self, chat: int, user: int) -> Document:
+        async def find_one() -> Document:
+            result = await self.collection_for(chat, user).find_one(
+                filter=filter_chat_user(
+                    chat=chat,
+                    user=user
+                ),
+                projection=DOCUMENT_PROJECTION
+            )
+            if result is not None and result.pop('archived', False):
+                await self._restore(chat=chat, user=user, document=result)
+            return result or {}
+
+        if self.write_buffer is None:
+            return await find_one()
+        return await self.write_buffer.read(key=(chat, user), load=find_one)
+
+    async def _restore(self, chat: int, user: int, document: Document) -> None:
+        collection = self.collection_for(chat, user)
+        archive = self.archive_for(collection)
+        address_filter = filter_chat_user(chat=chat, user=user)
+        archived = await archive.find_one(filter=address_filter, projection={'_id': False}) or {}
+        while True:
+            # fields written since the document was archived are newer than the archived ones
+            restored = {
+                field: archived[field]
+                for field in ARCHIVED_FIELDS
+                if field in archived and field not in document
             }
-        )
-        return result['bucket'] if result else default
-
-    @resolve_address
-    async def set_bucket(
-        self,
-        *,
-        chat: Optional[int] = None,
-        user: Optional[int] = None,
-        bucket: Optional[Dict] = None
-    ) -> None:
 
-        await self.db.users.update_one(
-            filter=filter_chat_user(
-                chat=chat,
-                user=user
-            ),
-            update={
-                '$set': {
-                    'bucket': bucket if bucket is not None else {}
-                }
-            },
-            upsert=True
+            update: Update = {'$unset': {'archived': ''}}
+            if restored:
+                update['$set'] = restored
+            # only applies if nobody restored the document or wrote the restored fields since it was read
+            result = await collection.update_one(
+                filter={
+                    **address_filter,
+                    'archived': True,
+                    **{field: {'$exists': False} for field in restored},
+                },
+                update=update
+            )
+            if result.matched_count:
+                document.update(restored)
+                break
+
+            current = await collection.find_one(filter=address_filter, projection=DOCUMENT_PROJECTION) or {}
+            still_archived = current.pop('archived', False)
+            document.clear()
+            document.update(current)
+            if not still_archived:
+                break
+
+        await archive.delete_one(filter=address_filter)
+
+    async def iter_chats(self, private_only: bool = False, batch_size: int = 500) -> AsyncIterator[int]:
+        """Streams distinct chat ids in ascending order, without loading them all into memory"""
+        await self.flush()
+        cursors = [
+            collection.find(
+                filter={'chat_id': {'$gt': 0}} if private_only else {},
+                projection={'_id': False, 'chat_id': True},
+                batch_size=batch_size
+            ).sort([('chat_id', pymongo.ASCENDING), ('user_id', pymongo.ASCENDING)])
+            for collection in self.collections
+        ]
+        # the users of a chat may live in several partitions, so the sorted cursors are merged
+        heads = []
+        for index, cursor in enumerate(cursors):
+            document = await next_document(cursor)
+            if document is not None:
+                heads.append((document['chat_id'], index))
+        heapq.heapify(heads)
+
+        last_chat = None
+        while heads:
+            chat, index = heads[0]
+            if chat != last_chat:
+                last_chat = chat
+                yield chat
+            document = await next_document(cursors[index])
+            if document is not None:
+                heapq.heapreplace(heads, (document['chat_id'], index))
+            else:
+                heapq.heappop(heads)
+
+    async def delete_chats(self, chats: Sequence[int]) -> int:
+        """Deletes the records of every user in the chats, e.g. chats that blocked the bot"""
+        await self.flush()
+        collections = list(self.collections)
+        if self.archive_after is not None:
+            collections.extend(self.archive_for(collection) for collection in self.collections)
+
+        deleted = 0
+        for collection in collections:
+            result = await collection.delete_many({'chat_id': {'$in': list(chats)}})
+            deleted += result.deleted_count
+
+        if self.cache is not None:
+            chat_set = set(chats)
+            for address in self.cache.keys():
+                if address[0] in chat_set:
+                    self.cache.pop(address)
+        return deleted
+
+    async def compact(self, idle_for: Optional[datetime.timedelta] = None, batch_size: int = 500) -> int:
+        idle_for = idle_for or self.archive_after
+        if idle_for is None:
+            raise ValueError('idle_for or archive_after is required to compact')
+
+        # a buffered partial write landing on an archived document would shadow its archived fields
+        await self.flush()
+        cutoff = datetime.datetime.utcnow() - idle_for
+        archived = 0
+        for collection in self.collections:
+            cursor = collection.find(
+                filter={
+                    'last_seen': {'$lt': cutoff},
+                    'archived': {'$ne': True},
+                    '$or': [{field: {'$exists': True}} for field in ARCHIVED_FIELDS],
+                },
+                batch_size=batch_size
+            )
+            batch: List[Document] = []
+            async for document in cursor:
+                batch.append(document)
+                if len(batch) >= batch_size:
+                    archived += await self._archive(collection, batch)
+                    batch = []
+            if batch:
+                archived += await self._archive(collection, batch)
+        return archived
+
+    async def _archive(self, collection: AsyncIOMotorCollection, documents: List[Document]) -> int:
+        await self.archive_for(collection).bulk_write(
+            [
+                pymongo.ReplaceOne(
+                    filter=filter_chat_user(chat=document['chat_id'], user=document['user_id']),
+                    replacement={
+                        key: value
+                        for key, value in document.items()
+                        if key in ARCHIVED_FIELDS or key in ('chat_id', 'user_id', 'last_seen')
+                    },
+                    upsert=True
+                )
+                for document in documents
+            ],
+            ordered=False
         )
-
-    @resolve_address
-    async def update_bucket(
-        self,
-        *,
-        chat: Optional[int] = None,
-        user: Optional[int] = None,
-        bucket: Optional[Dict] = None,
-        **kwargs
-    ) -> None:
-
-        kwargs.update({} if bucket is None else bucket)
-        await self.db.users.update_one(
-            filter=filter_chat_user(
-                chat=chat,
-                user=user
-            ),
-            update={
-                '$set': {'bucket': kwargs}
-            },
-            upsert=True
+        # documents touched since they were read keep their fields and are skipped
+        result = await collection.bulk_write(
+            [
+                pymongo.UpdateOne(
+                    filter={'_id': document['_id'], 'last_seen': document['last_seen']},
+                    update={
+                        '$unset': {field: '' for field in ARCHIVED_FIELDS},
+                        '$set': {'archived': True},
+                    }
+                )
+                for document in documents
+            ],
+            ordered=False
         )
+        # and their archive copies would go stale, so they are removed
+        archived_ids = {
+            document['_id']
+            async for document in collection.find(
+                filter={'_id': {'$in': [document['_id'] for document in documents]}, 'archived': True},
+                projection={'_id': True}
+            )
+        }
+        skipped = [document for document in documents if document['_id'] not in archived_ids]
+        if skipped:
+            await self.archive_for(collection).bulk_write(
+                [
+                    pymongo.DeleteOne(filter_chat_user(chat=document['chat_id'], user=document['user_id']))
+                    for document in skipped
+                ],
+                ordered=False
+            )
+
+        for document in documents:
+            if self.cache is not None:
+                self.cache.pop((document['chat_id'], document['user_id']))
+        return result.modified_count
+
+    @property
+    def in_snapshot(self) -> bool:
+        return self._open_snapshots() is not None
+
+    def begin_snapshot(self) -> None:
+        """Snapshots nest: inside an open one nothing is written until the outermost commit"""
+        if self._open_snapshots() is not None:
+            self._snapshot_depth.set(self._snapshot_depth.get() + 1)
+            return
+        self._snapshots.set(SnapshotScope())
+        self._snapshot_depth.set(0)
 
     @resolve_address
-    async def reset_bucket(self, *, chat: Optional[int] = None, user: Optional[int] = None) -> None:
-        await self.db.users.update_one(
-            filter=filter_chat_user(
-                chat=chat,
-                user=user
-            ),
-            update={
-                '$set': {
-                    'bucket': {}
-                }
-            }
-        )
+    async def load_snapshot(self, *, chat: Optional[int] = None, user: Optional[int] = None) -> Snapshot:
+        snapshots = self._open_snapshots()
+        if snapshots is None:
+            raise RuntimeError('begin_snapshot must be called before load_snapshot')
+
+        await self._load(chat=chat, user=user)
+        return snapshots[chat, user]
+
+    async def commit_snapshot(self) -> None:
+        snapshots = self._open_snapshots()
+        if snapshots is None:
+            return
+        depth = self._snapshot_depth.get()
+        if depth:
+            self._snapshot_depth.set(depth - 1)
+            return
+
+        # closed before writing, so whatever still holds the scope writes through from now on
+        snapshots.closed = True
+        self._snapshots.set(None)
+        for (chat, user), snapshot in snapshots.items():
+            update = snapshot.pending_update()
+            if update:
+                await self._write(chat=chat, user=user, update=update, upsert=snapshot.upsert)
+
+    async def _load(self, chat: int, user: int) -> Document:
+        snapshots = self._open_snapshots()
+        if snapshots is None:
+            return await self._load_shared(chat=chat, user=user)
+
+        snapshot = snapshots.get((chat, user))
+        if snapshot is None:
+            document = await self._load_shared(chat=chat, user=user)
+            snapshot = Snapshot(copy.deepcopy(document) if self.cache is not None else document)
+            snapshots[chat, user] = snapshot
+        return snapshot.document
+
+    async def _load_shared(self, chat: int, user: int) -> Document:
+        if self.cache is None:
+            return await self._find_document(chat=chat, user=user)
+
+        address = (chat, user)
+        document = self.cache.get(address)
+        if document is not None:
+            return document
+
+        loading = self._loading.get(address)
+        if loading is not None:
+            return await asyncio.shield(loading)
+
+        loading = asyncio.get_running_loop().create_future()
+        self._loading[address] = loading
+        try:
+            document = await self._find_document(chat=chat, user=user)
+        except BaseException as error:
+            loading.set_exception(error)
+            # mark the exception as retrieved in case nobody else is waiting
+            loading.exception()
+            raise
+        finally:
+            del self._loading[address]
+
+        if address in self._stale:
+            self._stale.discard(address)
+        else:
+            self.cache.set(address, document)
+
+        loading.set_result(document)
+        return document
+
+    async def _write(self, chat: int, user: int, update: Update, upsert: bool = True) -> None:
+        address = (chat, user)
+        snapshots = self._open_snapshots()
+        if snapshots is not None and address in snapshots:
+            snapshots[address].update(update=copy.deepcopy(update), upsert=upsert)
+            return
+
+        if self.archive_after is not None and partial_paths(update):
+            # archived fields have to be restored before they are updated in place
+            await self._load_shared(chat=chat, user=user)
+
+        update = copy.deepcopy(update)
+        update.setdefault('$set', {})['last_seen'] = datetime.datetime.utcnow()
+        if self.write_buffer is not None:
+            await self.write_buffer.add(key=address, update=update, upsert=upsert)
+        else:
+            try:
+                await self.collection_for(chat, user).update_one(
+                    filter=filter_chat_user(
+                        chat=chat,
+                        user=user
+                    ),
+                    update=update,
+                    upsert=upsert
+                )
+            except BaseException:
+                if self.cache is not None:
+                    self.cache.pop(address)
+                raise
+
+        self._update_cached(address=address, update=update, upsert=upsert)
+
+    def _update_cached(self, address: Address, update: Update, upsert: bool) -> None:
+        if self.cache is None:
+            return
+
+        if address in self._loading:
+            self._stale.add(address)
+        document = self.cache.peek(address)
+        if document is not None and not document and not upsert:
+            # an empty cached document can't tell whether the update matched anything
+            self.cache.pop(address)
+        elif document is not None:
+            try:
+                apply_update(document, update)
+            except ValueError:
+                self.cache.pop(address)
@@ -0,0 +1,145 @@
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+import hashlib
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pymongo import DeleteOne, UpdateOne
+
+from tgstarter.storage.mongo_storage import MongoStorage, filter_chat_user
+
+
+def address_hash(chat: int, user: int) -> int:
+    digest = hashlib.blake2b(f'{chat}:{user}'.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash: growing from n to n + 1 buckets only moves 1 / (n + 1) of the keys"""
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return bucket
+
+
+def partition_index(chat: int, user: int, partitions: int) -> int:
+    return jump_hash(address_hash(chat, user), partitions)
+
+
+def collection_id(collection: AsyncIOMotorCollection) -> Tuple[str, str]:
+    return collection.database.name, collection.name
+
+
+def archive_collection(collection: AsyncIOMotorCollection, archive_suffix: str) -> AsyncIOMotorCollection:
+    return collection.database[f'{collection.name}{archive_suffix}']
+
+
+class PartitionedMongoStorage(MongoStorage):
+    def __init__(
+        self,
+        mongo_client: AsyncIOMotorClient,
+        partitions: Sequence[AsyncIOMotorCollection],
+        **kwargs: Any
+    ) -> None:
+        if not partitions:
+            raise ValueError('at least one partition is required')
+
+        first = partitions[0]
+        super().__init__(mongo_client, first.database, first.name, **kwargs)
+        self.partitions = list(partitions)
+
+    @property
+    def collections(self) -> List[AsyncIOMotorCollection]:
+        return self.partitions
+
+    def collection_for(self, chat: int, user: int) -> AsyncIOMotorCollection:
+        return self.partitions[partition_index(chat, user, len(self.partitions))]
+
+
+async def migrate_partitions(
+    source: Sequence[AsyncIOMotorCollection],
+    target: Sequence[AsyncIOMotorCollection],
+    batch_size: int = 500,
+    archive_suffix: str = '_archive'
+) -> int:
+    """Move documents of the source layout to the collections the target layout routes them to
+
+    The archived fields of compacted documents move along with them, from the archive of the source
+    collection to the archive of the target one; `archive_suffix` has to match the storage's.
+    """
+    moved = 0
+    for collection in source:
+        cursor = collection.find({}, batch_size=batch_size)
+        batch: List[dict] = []
+        async for document in cursor:
+            destination = target[partition_index(document['chat_id'], document['user_id'], len(target))]
+            if collection_id(destination) != collection_id(collection):
+                batch.append(document)
+            if len(batch) >= batch_size:
+                moved += await _move(collection, batch, target, archive_suffix)
+                batch = []
+        if batch:
+            moved += await _move(collection, batch, target, archive_suffix)
+    return moved
+
+
+async def _move(
+    source: AsyncIOMotorCollection,
+    documents: List[dict],
+    target: Sequence[AsyncIOMotorCollection],
+    archive_suffix: str
+) -> int:
+
+    def set_on_insert(document: dict) -> Optional[UpdateOne]:
+        fields = {
+            key: value
+            for key, value in document.items()
+            if key not in ('_id', 'chat_id', 'user_id')
+        }
+        if not fields:
+            return None
+        # a document already written through the target layout is newer, so it is never overwritten
+        return UpdateOne(
+            filter=filter_chat_user(chat=document['chat_id'], user=document['user_id']),
+            update={'$setOnInsert': fields},
+            upsert=True
+        )
+
+    async def write(
+        copies: List[dict],
+        collection_of: Callable[[AsyncIOMotorCollection], AsyncIOMotorCollection]
+    ) -> None:
+        requests: Dict[int, List[UpdateOne]] = {}
+        for document in copies:
+            request = set_on_insert(document)
+            if request is not None:
+                index = partition_index(document['chat_id'], document['user_id'], len(target))
+                requests.setdefault(index, []).append(request)
+        for index, partition_requests in requests.items():
+            await collection_of(target[index]).bulk_write(partition_requests, ordered=False)
+
+    source_archive = archive_collection(source, archive_suffix)
+    archived_filters = [
+        filter_chat_user(chat=document['chat_id'], user=document['user_id'])
+        for document in documents
+        if document.get('archived')
+    ]
+    archived: List[dict] = []
+    if archived_filters:
+        archived = [document async for document in source_archive.find({'$or': archived_filters})]
+
+    # the archive copies go first, so an archived document is never found without them
+    await write(archived, lambda collection: archive_collection(collection, archive_suffix))
+    await write(documents, lambda collection: collection)
+    await source.bulk_write([DeleteOne({'_id': document['_id']}) for document in documents], ordered=False)
+    if archived:
+        await source_archive.bulk_write([DeleteOne({'_id': document['_id']}) for document in archived], ordered=False)
+    return len(documents)
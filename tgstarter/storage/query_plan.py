@@ -0,0 +1,55 @@
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from tgstarter.models.storage import QueryPlan
+
+
+Sort = Sequence[Tuple[str, int]]
+
+
+def walk_plan(plan: Any) -> Iterator[Dict[str, Any]]:
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            yield plan
+        for value in plan.values():
+            yield from walk_plan(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from walk_plan(item)
+
+
+async def explain_query(
+    collection: AsyncIOMotorCollection,
+    *,
+    query: str,
+    filter: Dict[str, Any],
+    projection: Optional[Dict[str, Any]] = None,
+    sort: Optional[Sort] = None,
+    limit: int = 1
+) -> QueryPlan:
+
+    cursor = collection.find(filter=filter, projection=projection, limit=limit)
+    if sort:
+        cursor = cursor.sort(list(sort))
+    explanation = await cursor.explain()
+    stages = list(walk_plan(explanation.get('queryPlanner', {}).get('winningPlan', {})))
+    return QueryPlan(
+        collection=collection.name,
+        query=query,
+        filter=filter,
+        stages=[stage['stage'] for stage in stages],
+        index_names=[stage['indexName'] for stage in stages if 'indexName' in stage],
+    )
+
+
+def unindexed(plans: Sequence[QueryPlan]) -> List[QueryPlan]:
+    return [plan for plan in plans if not plan.uses_index]
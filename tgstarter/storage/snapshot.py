@@ -0,0 +1,55 @@
+from typing import (
+    Any,
+    Dict,
+    Hashable,
+    Optional,
+    Set,
+)
+
+from tgstarter.storage.updates import Update, apply_update, merge_updates, top_level_fields
+
+
+class Snapshot:
+    def __init__(self, document: Dict[str, Any]) -> None:
+        self.document = document
+        self.dirty: Set[str] = set()
+        self.upsert = False
+        self._pending: Optional[Update] = None
+        self._overwrite = False
+
+    def update(self, update: Update, upsert: bool = True) -> None:
+        apply_update(self.document, update)
+        self.dirty.update(top_level_fields(update))
+        self.upsert = self.upsert or upsert
+
+        if not self._overwrite:
+            merged = update if self._pending is None else merge_updates(self._pending, update)
+            # conflicting partial updates fall back to rewriting the touched fields as a whole
+            self._overwrite = merged is None
+            self._pending = merged
+
+    def pending_update(self) -> Optional[Update]:
+        if not self.dirty:
+            return None
+        if not self._overwrite:
+            return self._pending
+
+        update: Update = {}
+        for field in self.dirty:
+            if field in self.document:
+                update.setdefault('$set', {})[field] = self.document[field]
+            else:
+                update.setdefault('$unset', {})[field] = ''
+        return update
+
+
+class SnapshotScope(Dict[Hashable, Snapshot]):
+    """Snapshots of one update by address
+
+    Tasks spawned by handlers inherit the scope with the context, so it is closed when committed
+    and writes made through it afterwards go straight to storage instead of being lost.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.closed = False
@@ -0,0 +1,191 @@
+from typing import (
+    Any,
+    AsyncIterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import json
+import re
+import sqlite3
+
+from tgstarter.storage.document_storage import Document, DocumentStorage
+from tgstarter.storage.updates import Update, apply_update
+
+
+PendingWrite = Tuple[int, int, Update, bool]
+
+
+class SQLiteStorage(DocumentStorage):
+    def __init__(
+        self,
+        path: str = 'tgstarter.sqlite3',
+        table_name: str = 'users',
+        *,
+        max_batch_size: int = 500
+    ) -> None:
+        if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', table_name):
+            raise ValueError(f'invalid table name {table_name!r}')
+
+        self.path = path
+        self.table_name = table_name
+        self.max_batch_size = max_batch_size
+
+        # sqlite3 connections belong to the thread that created them, so every query runs on this one
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='tgstarter-sqlite')
+        self._connection: Optional[sqlite3.Connection] = None
+        self._executor.submit(self._connect).result()
+
+        self._batch: List[Tuple[PendingWrite, asyncio.Future]] = []
+        self._committer: Optional[asyncio.Future] = None
+
+    def _connect(self) -> None:
+        connection = sqlite3.connect(self.path, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute(
+            f'CREATE TABLE IF NOT EXISTS {self.table_name} ('
+            'chat_id INTEGER NOT NULL, '
+            'user_id INTEGER NOT NULL, '
+            'document TEXT NOT NULL, '
+            'PRIMARY KEY (chat_id, user_id)'
+            ') WITHOUT ROWID'
+        )
+        self._connection = connection
+
+    def _select(self, chat: int, user: int) -> Optional[Document]:
+        assert self._connection is not None
+        row = self._connection.execute(
+            f'SELECT document FROM {self.table_name} WHERE chat_id = ? AND user_id = ?',
+            (chat, user)
+        ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def _commit(self, writes: List[PendingWrite]) -> List[Optional[Exception]]:
+        assert self._connection is not None
+        errors: List[Optional[Exception]] = []
+        self._connection.execute('BEGIN IMMEDIATE')
+        try:
+            for chat, user, update, upsert in writes:
+                document = self._select(chat=chat, user=user)
+                if document is None and not upsert:
+                    errors.append(None)
+                    continue
+
+                try:
+                    document = apply_update(document or {}, update)
+                    encoded = json.dumps(document, ensure_ascii=False, separators=(',', ':'))
+                except (ValueError, TypeError) as error:
+                    errors.append(error)
+                    continue
+
+                self._connection.execute(
+                    f'INSERT OR REPLACE INTO {self.table_name} (chat_id, user_id, document) VALUES (?, ?, ?)',
+                    (chat, user, encoded)
+                )
+                errors.append(None)
+        except BaseException:
+            self._connection.execute('ROLLBACK')
+            raise
+        else:
+            self._connection.execute('COMMIT')
+        return errors
+
+    def _select_chats(self, after: Optional[int], private_only: bool, limit: int) -> List[int]:
+        assert self._connection is not None
+        lowest = 0 if private_only else None
+        if after is not None:
+            lowest = after if lowest is None else max(lowest, after)
+        where = 'WHERE chat_id > ? ' if lowest is not None else ''
+        parameters = (lowest, limit) if lowest is not None else (limit,)
+        rows = self._connection.execute(
+            f'SELECT DISTINCT chat_id FROM {self.table_name} {where}ORDER BY chat_id LIMIT ?',
+            parameters
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def _delete_chats(self, chats: List[int]) -> int:
+        assert self._connection is not None
+        placeholders = ', '.join('?' for _ in chats)
+        cursor = self._connection.execute(
+            f'DELETE FROM {self.table_name} WHERE chat_id IN ({placeholders})',
+            chats
+        )
+        return cursor.rowcount
+
+    def _disconnect(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    async def _run(self, function: Any, *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, function, *args)
+
+    async def _load(self, chat: int, user: int) -> Document:
+        document = await self._run(self._select, chat, user)
+        return document or {}
+
+    async def _write(self, chat: int, user: int, update: Update, upsert: bool = True) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self._batch.append(((chat, user, update, upsert), future))
+        if self._committer is None or self._committer.done():
+            self._committer = asyncio.ensure_future(self._commit_batches())
+        await future
+
+    async def _commit_batches(self) -> None:
+        # writes queued while a transaction is running are committed together in the next one
+        while self._batch:
+            batch = self._batch[:self.max_batch_size]
+            del self._batch[:self.max_batch_size]
+            writes = [write for write, _ in batch]
+            try:
+                errors = await self._run(self._commit, writes)
+            except Exception as error:
+                errors = [error] * len(batch)
+
+            for (_, future), error in zip(batch, errors):
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+    async def iter_chats(self, private_only: bool = False, batch_size: int = 500) -> AsyncIterator[int]:
+        """Streams distinct chat ids in ascending order, a batch at a time"""
+        await self.flush()
+        after = None
+        while True:
+            chats = await self._run(self._select_chats, after, private_only, batch_size)
+            for chat in chats:
+                yield chat
+            if len(chats) < batch_size:
+                return
+            after = chats[-1]
+
+    async def delete_chats(self, chats: Sequence[int]) -> int:
+        """Deletes the records of every user in the chats, e.g. chats that blocked the bot"""
+        await self.flush()
+        deleted = 0
+        # sqlite limits the number of parameters of a statement
+        for start in range(0, len(chats), self.max_batch_size):
+            deleted += await self._run(self._delete_chats, list(chats[start:start + self.max_batch_size]))
+        return deleted
+
+    async def flush(self) -> None:
+        if self._committer is not None:
+            await asyncio.gather(self._committer, return_exceptions=True)
+
+    async def close(self) -> None:
+        await self.flush()
+        if self._connection is not None:
+            await self._run(self._disconnect)
+
+    async def wait_closed(self) -> None:
+        # shutdown(wait=True) blocks until the queries still running finish, so not on the loop
+        await asyncio.get_running_loop().run_in_executor(None, functools.partial(self._executor.shutdown, wait=True))
@@ -0,0 +1,167 @@
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+)
+import copy
+
+
+Document = Dict[str, Any]
+Update = Dict[str, Dict[str, Any]]
+Operation = Tuple[str, str, Any]
+
+SET = '$set'
+UNSET = '$unset'
+INC = '$inc'
+PUSH = '$push'
+OPERATORS = (SET, UNSET, INC, PUSH)
+
+
+class _Unset:
+    def __repr__(self) -> str:
+        return 'Unset'
+
+
+Unset: Any = _Unset()
+
+
+def is_path_key(key: Any) -> bool:
+    return isinstance(key, str) and bool(key) and '.' not in key and not key.startswith('$')
+
+
+def field_update(field: str, values: Mapping[str, Any]) -> Update:
+    update: Update = {}
+    for key, value in values.items():
+        operator = UNSET if value is Unset else SET
+        update.setdefault(operator, {})[f'{field}.{key}'] = '' if value is Unset else value
+    return update
+
+
+def operations(update: Update) -> Iterator[Operation]:
+    for operator, fields in update.items():
+        if operator not in OPERATORS:
+            raise ValueError(f'unsupported update operator {operator}')
+        for path, value in fields.items():
+            if operator == PUSH:
+                value = list(value['$each']) if isinstance(value, dict) and '$each' in value else [value]
+            yield operator, path, value
+
+
+def build_update(items: Iterable[Operation]) -> Update:
+    update: Update = {}
+    for operator, path, value in items:
+        if operator == PUSH:
+            value = {'$each': value}
+        elif operator == UNSET:
+            value = ''
+        update.setdefault(operator, {})[path] = value
+    return update
+
+
+def partial_paths(update: Update) -> List[str]:
+    return [path for _, path, _ in operations(update) if '.' in path]
+
+
+def top_level_fields(update: Update) -> List[str]:
+    return list({path.split('.', 1)[0] for _, path, _ in operations(update)})
+
+
+def apply_operation(document: Document, operator: str, path: str, value: Any) -> None:
+    *parents, last = path.split('.')
+    target = document
+    for key in parents:
+        child = target.get(key)
+        if child is None:
+            if operator == UNSET:
+                return
+            child = target[key] = {}
+        elif not isinstance(child, dict):
+            raise ValueError(f'cannot apply {operator} to {path}: {key} is not a document')
+        target = child
+
+    apply_to_key(target, last, operator, value)
+
+
+def apply_to_key(target: Document, key: str, operator: str, value: Any) -> None:
+    if operator == SET:
+        target[key] = copy.deepcopy(value)
+    elif operator == UNSET:
+        target.pop(key, None)
+    elif operator == INC:
+        current = target.get(key, 0)
+        if not isinstance(current, (int, float)):
+            raise ValueError(f'cannot apply {operator} to {key}: it is not a number')
+        target[key] = current + value
+    elif operator == PUSH:
+        items = target.setdefault(key, [])
+        if not isinstance(items, list):
+            raise ValueError(f'cannot apply {operator} to {key}: it is not an array')
+        items.extend(copy.deepcopy(value))
+    else:
+        raise ValueError(f'unsupported update operator {operator}')
+
+
+def apply_update(document: Document, update: Update) -> Document:
+    for operator, path, value in operations(update):
+        apply_operation(document, operator, path, value)
+    return document
+
+
+def related(first: str, second: str) -> bool:
+    return first == second or first.startswith(second + '.') or second.startswith(first + '.')
+
+
+def fold_operation(base: Operation, operator: str, path: str, value: Any) -> Operation:
+    base_operator, base_path, base_value = base
+    container: Document = {}
+    if base_operator == SET:
+        container[base_path] = copy.deepcopy(base_value)
+
+    relative = path[len(base_path) + 1:]
+    if not relative:
+        apply_to_key(container, base_path, operator, value)
+    else:
+        nested = container.get(base_path)
+        if nested is None and operator != UNSET:
+            nested = container[base_path] = {}
+        if nested is not None:
+            if not isinstance(nested, dict):
+                raise ValueError(f'cannot apply {operator} to {path}: {base_path} is not a document')
+            apply_operation(nested, operator, relative, value)
+
+    if base_path in container:
+        return SET, base_path, container[base_path]
+    return UNSET, base_path, ''
+
+
+def merge_updates(first: Update, second: Update) -> Optional[Update]:
+    """Combine two updates into one, or return None if they touch paths Mongo can't update together"""
+    merged: List[Operation] = list(operations(first))
+    for operator, path, value in operations(second):
+        conflicts = [item for item in merged if related(item[1], path)]
+        ancestors = [item for item in conflicts if path == item[1] or path.startswith(item[1] + '.')]
+        overwritten = [item for item in ancestors if item[0] in (SET, UNSET)]
+
+        if not conflicts:
+            merged.append((operator, path, value))
+        elif overwritten:
+            # the pending value of this path (or of its parent) is known, apply the operation to it
+            try:
+                folded = fold_operation(overwritten[0], operator, path, value)
+            except ValueError:
+                return None
+            merged[merged.index(overwritten[0])] = folded
+        elif operator in (SET, UNSET) and not ancestors:
+            merged = [item for item in merged if item not in conflicts]
+            merged.append((operator, path, value))
+        elif len(conflicts) == 1 and conflicts[0][:2] == (operator, path):
+            merged[merged.index(conflicts[0])] = (operator, path, conflicts[0][2] + value)
+        else:
+            return None
+
+    return build_update(merged)
@@ -0,0 +1,185 @@
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+)
+import asyncio
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from tgstarter.storage.updates import Document, Update, apply_update, merge_updates
+
+
+Key = Tuple[Hashable, ...]
+PendingWrite = Tuple[Update, bool]
+
+
+class WriteBuffer:
+    def __init__(
+        self,
+        route: Callable[[Key], AsyncIOMotorCollection],
+        *,
+        key_fields: Tuple[str, ...] = ('chat_id', 'user_id'),
+        max_size: int = 1000,
+        interval: float = 0.5,
+        max_retry_interval: float = 30.0
+    ) -> None:
+        self.route = route
+        self.key_fields = key_fields
+        self.max_size = max_size
+        self.interval = interval
+        self.max_retry_interval = max_retry_interval
+
+        self.flushes = 0
+        self.flushed_writes = 0
+        self.coalesced_writes = 0
+        self.failed_flushes = 0
+        self.last_error: Optional[BaseException] = None
+
+        # writes to one key that can't be merged into a single update stay queued in order
+        self._pending: Dict[Key, List[PendingWrite]] = {}
+        self._flushing: Dict[Key, PendingWrite] = {}
+        self._timer: Optional[asyncio.Future] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def _get_lock(self) -> asyncio.Lock:
+        # the lock is bound to the running loop on Python < 3.10, so it's created on first use
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def add(self, key: Key, update: Update, upsert: bool = True) -> None:
+        queue = self._pending.setdefault(key, [])
+        merged = merge_updates(queue[-1][0], update) if queue else None
+        if merged is None:
+            queue.append((update, upsert))
+        else:
+            queue[-1] = (merged, queue[-1][1] or upsert)
+            self.coalesced_writes += 1
+
+        if len(self._pending) >= self.max_size:
+            await self.flush()
+        elif self._timer is None or self._timer.done():
+            self._timer = asyncio.ensure_future(self._flush_later())
+
+    async def read(self, key: Key, load: Callable[[], Awaitable[Document]]) -> Document:
+        while True:
+            if key in self._flushing:
+                async with self._get_lock():
+                    pass
+
+            flushes = self.flushes
+            document = await load()
+            # retry if the key was written to Mongo while it was being read
+            if flushes == self.flushes and key not in self._flushing:
+                break
+
+        for update, upsert in self._pending.get(key, []):
+            if document or upsert:
+                apply_update(document, update)
+        return document
+
+    async def _flush_later(self) -> None:
+        # nobody awaits the timer, so a failed flush is recorded and retried with backoff
+        # instead of leaving the requeued writes in memory until the next add()
+        delay = self.interval
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                await self.flush()
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                self.failed_flushes += 1
+                self.last_error = error
+                delay = min(delay * 2, self.max_retry_interval)
+
+    async def flush(self) -> None:
+        async with self._get_lock():
+            while self._pending:
+                await self._flush_pending()
+
+    async def _flush_pending(self) -> None:
+        batch = {
+            key: queue.pop(0)
+            for key, queue in self._pending.items()
+        }
+        self._pending = {
+            key: queue
+            for key, queue in self._pending.items()
+            if queue
+        }
+        self._flushing = batch
+
+        groups: Dict[int, Tuple[AsyncIOMotorCollection, List[Key]]] = {}
+        for key in batch:
+            collection = self.route(key)
+            groups.setdefault(id(collection), (collection, []))[1].append(key)
+
+        try:
+            results = await asyncio.gather(
+                *[
+                    self._bulk_write(collection=collection, batch=batch, keys=keys)
+                    for collection, keys in groups.values()
+                ],
+                return_exceptions=True
+            )
+        finally:
+            self._flushing = {}
+            self.flushes += 1
+
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            raise errors[0]
+
+    async def _bulk_write(
+        self,
+        collection: AsyncIOMotorCollection,
+        batch: Dict[Key, PendingWrite],
+        keys: List[Key]
+    ) -> None:
+
+        requests = [
+            UpdateOne(
+                filter=dict(zip(self.key_fields, key)),
+                update=batch[key][0],
+                upsert=batch[key][1]
+            )
+            for key in keys
+        ]
+        try:
+            await collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as error:
+            failed = [keys[write_error['index']] for write_error in error.details['writeErrors']]
+            self._requeue(batch=batch, keys=failed)
+            self.flushed_writes += len(keys) - len(failed)
+            raise
+        except BaseException:
+            self._requeue(batch=batch, keys=keys)
+            raise
+
+        self.flushed_writes += len(keys)
+
+    def _requeue(self, batch: Dict[Key, PendingWrite], keys: List[Key]) -> None:
+        for key in keys:
+            self._pending.setdefault(key, []).insert(0, batch[key])
+
+    async def close(self) -> None:
+        if self._timer is not None and not self._get_lock().locked():
+            self._timer.cancel()
+        await self.flush()
+
+    async def wait_closed(self) -> None:
+        if self._timer is not None:
+            await asyncio.gather(self._timer, return_exceptions=True)
+            self._timer = None
@@ -5,6 +5,7 @@ from typing import (
     Optional,
     Union,
     Dict,
+    Tuple,
 )
 import enum
 from enum import Enum
@@ -17,6 +18,30 @@ from aiogram import types
 
 auto: Callable[..., Enum] = enum.auto
 
+AttributePath = Optional[Tuple[str, ...]]
+
+# update field -> (path to chat, path to user), in the order aiogram checks them
+UPDATE_CHAT_USER_PATHS: Tuple[Tuple[str, AttributePath, AttributePath], ...] = (
+    ('message', ('chat',), ('from_user',)),
+    ('edited_message', ('chat',), ('from_user',)),
+    ('channel_post', ('chat',), None),
+    ('edited_channel_post', ('chat',), None),
+    ('inline_query', None, ('from_user',)),
+    ('chosen_inline_result', None, ('from_user',)),
+    ('callback_query', ('message', 'chat'), ('from_user',)),
+    ('shipping_query', None, ('from_user',)),
+    ('pre_checkout_query', None, ('from_user',)),
+    ('poll', None, None),
+    ('poll_answer', None, ('user',)),
+    ('my_chat_member', ('chat',), ('from_user',)),
+    ('chat_member', ('chat',), ('from_user',)),
+    ('chat_join_request', ('chat',), ('from_user',)),
+)
+# attribute names that aiogram exports under a different key by to_python()
+PYTHON_ALIASES = {
+    'from_user': 'from',
+}
+
 
 def delete_indentation(text: str) -> str:
     text = dedent(text)
@@ -36,6 +61,45 @@ def string_fits(source: str, max_length: int = 4096) -> bool:
     return len(text) <= max_length
 
 
+def follow_path(obj: Any, path: AttributePath) -> Any:
+    if path is None:
+        return None
+    for name in path:
+        obj = getattr(obj, name, None)
+        if obj is None:
+            return None
+    return obj
+
+
+def update_chat_and_user(update: types.Update) -> Tuple[Optional[types.Chat], Optional[types.User]]:
+    for field, chat_path, user_path in UPDATE_CHAT_USER_PATHS:
+        event = getattr(update, field, None)
+        if event is not None:
+            return follow_path(event, chat_path), follow_path(event, user_path)
+    return None, None
+
+
+def follow_key_path(data: Dict[str, Any], path: AttributePath) -> Optional[Dict[str, Any]]:
+    if path is None:
+        return None
+    for name in path:
+        data = data.get(PYTHON_ALIASES.get(name, name))
+        if data is None:
+            return None
+    return data
+
+
+def python_update_chat_and_user(
+    data: Dict[str, Any]
+) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """Same as update_chat_and_user, for an update already exported by to_python()"""
+    for field, chat_path, user_path in UPDATE_CHAT_USER_PATHS:
+        event = data.get(field)
+        if event is not None:
+            return follow_key_path(event, chat_path), follow_key_path(event, user_path)
+    return None, None
+
+
 def user_fullname(first_name: str, last_name: Optional[str] = None) -> str:
     if not last_name:
         return first_name
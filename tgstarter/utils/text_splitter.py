@@ -0,0 +1,282 @@
+"""Splits long texts into Telegram-sized messages without breaking HTML or MarkdownV2 markup
+
+Telegram limits the length of the parsed text, not of the markup, and counts it in UTF-16 code units.
+Chunks are cut at the best boundary in their second half (paragraph, line, sentence, word)
+and formatting open at a cut is closed at the end of the chunk and reopened in the next one.
+"""
+from typing import (
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+import html
+import re
+
+from aiogram.types import ParseMode
+
+
+# name, markup that opens it, markup that closes it
+Tag = Tuple[str, str, str]
+Stack = Tuple[Tag, ...]
+# kind, source, visible length in UTF-16 code units, tag
+Token = Tuple[int, str, int, Optional[Tag]]
+# priority, index of the token, position in its source, length of the separator, tags open, visible length
+Boundary = Tuple[int, int, int, int, Stack, int]
+
+# text runs can be cut anywhere, atoms (entities and escapes) can't
+TEXT, ATOM, OPEN, CLOSE = range(4)
+
+# separator, priority, offset of the cut in the separator; the rest of the separator is dropped
+SEPARATORS = (
+    ('\n\n', 4, 0),
+    ('\n', 3, 0),
+    ('. ', 2, 1),
+    ('! ', 2, 1),
+    ('? ', 2, 1),
+    ('… ', 2, 1),
+    (' ', 1, 0),
+)
+
+HTML_TOKEN = re.compile(
+    r'(?P<tag><(?P<closing>/)?(?P<name>[a-zA-Z][\w-]*)[^>]*>)'
+    r'|(?P<entity>&#?\w+;)'
+    r'|(?P<text>[^<&]+|.)',
+    re.DOTALL
+)
+MARKDOWN_TOKEN = re.compile(
+    r'(?P<escape>\\.)'
+    r'|(?P<pre>```[^\n`]*\n?)'
+    r'|(?P<code>`)'
+    r'|(?P<underline>__)'
+    r'|(?P<italic>_)'
+    r'|(?P<bold>\*)'
+    r'|(?P<strikethrough>~)'
+    r'|(?P<spoiler>\|\|)'
+    r'|(?P<link>\[)'
+    r'|(?P<link_end>\]\((?:[^)\\]|\\.)*\))'
+    r'|(?P<text>[^\\`_*~|\[\]]+|.)',
+    re.DOTALL
+)
+# inside code and pre blocks everything but escapes and backticks is text
+MARKDOWN_CODE_TOKEN = re.compile(
+    r'(?P<escape>\\.)'
+    r'|(?P<pre>```)'
+    r'|(?P<code>`)'
+    r'|(?P<text>[^\\`]+|.)',
+    re.DOTALL
+)
+MARKDOWN_LINK_END = re.compile(r'\]\((?:[^)\\]|\\.)*\)')
+MARKDOWN_MARKERS = ('underline', 'italic', 'bold', 'strikethrough', 'spoiler')
+
+
+def utf16_length(text: str) -> int:
+    if text.isascii():
+        return len(text)
+    return len(text.encode('utf-16-le')) // 2
+
+
+def cut_utf16(text: str, length: int) -> int:
+    """Index of the longest prefix of text not longer than length UTF-16 code units"""
+    if text.isascii():
+        return min(len(text), length)
+    units = 0
+    for index, char in enumerate(text):
+        units += 2 if ord(char) > 0xFFFF else 1
+        if units > length:
+            return index
+    return len(text)
+
+
+def text_token(source: str) -> Token:
+    return TEXT, source, utf16_length(source), None
+
+
+def tokenize_html(text: str) -> Iterator[Token]:
+    for match in HTML_TOKEN.finditer(text):
+        kind, source = match.lastgroup, match.group()
+        if kind == 'tag':
+            name = match.group('name').lower()
+            if match.group('closing'):
+                yield CLOSE, source, 0, (name, '', source)
+            else:
+                yield OPEN, source, 0, (name, source, f'</{name}>')
+        elif kind == 'entity':
+            yield ATOM, source, utf16_length(html.unescape(source)), None
+        else:
+            yield text_token(source)
+
+
+def tokenize_markdown(text: str) -> Iterator[Token]:
+    stack: List[Tag] = []
+    position = 0
+    while position < len(text):
+        in_code = bool(stack) and stack[-1][0] in ('code', 'pre')
+        match = (MARKDOWN_CODE_TOKEN if in_code else MARKDOWN_TOKEN).match(text, position)
+        assert match is not None
+        kind, source = match.lastgroup, match.group()
+        position = match.end()
+
+        if kind == 'escape':
+            yield ATOM, source, utf16_length(source[1:]), None
+        elif kind in ('pre', 'code'):
+            if in_code and stack[-1][0] == kind:
+                yield CLOSE, source, 0, stack.pop()
+            elif in_code:
+                yield text_token(source)
+            else:
+                tag = (kind, source, '```' if kind == 'pre' else '`')
+                stack.append(tag)
+                yield OPEN, source, 0, tag
+        elif kind in MARKDOWN_MARKERS or kind == 'link_end':
+            name = 'link' if kind == 'link_end' else kind
+            opened = [tag for tag in stack if tag[0] == name]
+            if opened:
+                stack.remove(opened[-1])
+                yield CLOSE, source, 0, opened[-1]
+            elif kind == 'link_end':
+                yield text_token(source)
+            else:
+                tag = (kind, source, source)
+                stack.append(tag)
+                yield OPEN, source, 0, tag
+        elif kind == 'link':
+            end = MARKDOWN_LINK_END.search(text, position)
+            if end is None:
+                yield text_token(source)
+            else:
+                tag = ('link', source, end.group())
+                stack.append(tag)
+                yield OPEN, source, 0, tag
+        else:
+            yield text_token(source)
+
+
+def tokenize(text: str, parse_mode: Optional[str], max_size: int) -> List[Token]:
+    """Text runs longer than max_size are cut in pieces, so cutting a chunk off one is never quadratic"""
+    if parse_mode is not None and parse_mode.lower() == ParseMode.HTML.lower():
+        tokens: Iterator[Token] = tokenize_html(text)
+    elif parse_mode is not None and parse_mode.lower() == ParseMode.MARKDOWN_V2.lower():
+        tokens = tokenize_markdown(text)
+    else:
+        tokens = iter([text_token(text)] if text else [])
+
+    result = []
+    for token in tokens:
+        source = token[1]
+        if token[0] == TEXT and len(source) > max_size:
+            result.extend(text_token(source[start:start + max_size]) for start in range(0, len(source), max_size))
+        else:
+            result.append(token)
+    return result
+
+
+def close_tag(stack: Stack, tag: Tag) -> Stack:
+    for index in range(len(stack) - 1, -1, -1):
+        if stack[index][0] == tag[0]:
+            return stack[:index] + stack[index + 1:]
+    return stack
+
+
+def find_boundaries(
+    source: str,
+    end: int,
+    index: int,
+    stack: Stack,
+    length: int,
+    min_length: int
+) -> Iterator[Boundary]:
+    """The last boundary of every priority in source[:end] that leaves at least min_length before it"""
+    for separator, priority, offset in SEPARATORS:
+        position = source.rfind(separator, 0, end + len(separator) - offset)
+        if position == -1:
+            continue
+        position += offset
+        before = length + utf16_length(source[:position])
+        if before >= min_length and before > 0:
+            yield priority, index, position, len(separator) - offset, stack, before
+
+
+def render(tokens: List[Token], start: int, end: int, opened: Stack, closed: Stack, tail: str = '') -> str:
+    return ''.join([
+        ''.join(tag[1] for tag in opened),
+        ''.join(token[1] for token in tokens[start:end]),
+        tail,
+        ''.join(tag[2] for tag in reversed(closed)),
+    ])
+
+
+def split_text(
+    text: str,
+    max_length: int = 4096,
+    parse_mode: Optional[str] = None,
+    min_fill: float = 0.5
+) -> List[str]:
+    """Splits text into chunks of at most max_length visible UTF-16 code units
+
+    A chunk ends at the best boundary found after min_fill of max_length,
+    otherwise it is cut as close to max_length as possible. Chunks with nothing but
+    whitespace are left out, Telegram refuses to send them.
+    """
+    tokens = tokenize(text, parse_mode, max_size=max_length)
+    chunks: List[str] = []
+    min_length = int(max_length * min_fill)
+
+    index = 0
+    stack: Stack = ()
+    while index < len(tokens):
+        start, opened = index, stack
+        length = 0
+        boundaries: Dict[int, Boundary] = {}
+
+        while index < len(tokens):
+            kind, source, width, tag = tokens[index]
+            if length + width > max_length:
+                break
+
+            if kind == OPEN:
+                assert tag is not None
+                stack = stack + (tag,)
+            elif kind == CLOSE:
+                assert tag is not None
+                stack = close_tag(stack, tag)
+            elif kind == TEXT and length + width >= min_length:
+                for boundary in find_boundaries(source, len(source), index, stack, length, min_length):
+                    boundaries[boundary[0]] = boundary
+            length += width
+            index += 1
+        else:
+            if length:
+                chunks.append(render(tokens, start, index, opened, stack))
+            break
+
+        kind, source, width, tag = tokens[index]
+        cut = cut_utf16(source, max_length - length) if kind == TEXT else 0
+        if kind == TEXT:
+            for boundary in find_boundaries(source, cut, index, stack, length, min_length):
+                boundaries[boundary[0]] = boundary
+
+        if boundaries:
+            _, index, position, skipped, stack, _ = boundaries[max(boundaries)]
+            kind, source, width, tag = tokens[index]
+            chunks.append(render(tokens, start, index, opened, stack, tail=source[:position]))
+            # the separator the chunk was cut at is dropped
+            rest = source[position + skipped:]
+        elif cut:
+            chunks.append(render(tokens, start, index, opened, stack, tail=source[:cut]))
+            rest = source[cut:]
+        elif length:
+            chunks.append(render(tokens, start, index, opened, stack))
+            continue
+        else:
+            raise ValueError(f'max_length {max_length} is too small to fit {source!r}')
+        tokens[index] = text_token(rest)
+    return [chunk for chunk in chunks if not is_blank(chunk, parse_mode)]
+
+
+def is_blank(chunk: str, parse_mode: Optional[str]) -> bool:
+    return all(
+        kind != TEXT or not source.strip()
+        for kind, source, _, _ in tokenize(chunk, parse_mode, max_size=len(chunk) or 1)
+    )